@@ -9,6 +9,7 @@ from .frequencias import api as frequencias_namespace
 from .presencas import api as presencas_namespace
 from .anotacao_erros import api as erros_namespace
 from .frontend_variaveis import api as frontend_namespace
+from .saude import api as saude_namespace
 from flask_restx import Api
 
 authorizations = {
@@ -37,4 +38,5 @@ api.add_namespace(frequencias_namespace, path='/turmas')
 api.add_namespace(presencas_namespace, path='/turmas')
 api.add_namespace(erros_namespace, path='/turmas')
 api.add_namespace(frontend_namespace)
+api.add_namespace(saude_namespace)
 
@@ -2,9 +2,12 @@ from flask_restx import Namespace, Resource, fields, reqparse
 from werkzeug.datastructures import FileStorage
 import numpy as np
 import io
+import csv
+import zipfile
 from flask import abort
-from core.models import db, Aluno, AlunoSchema
+from core.models import db, Aluno, AlunoSchema, AlunoTemplate, AlunoTemplateSchema, SuspeitaDuplicidade, SuspeitaDuplicidadeSchema
 from core.utils import *
+from core.idempotencia import idempotente, PARAMETRO_IDEMPOTENCIA
 
 api = Namespace('alunos', description='Operações relacionadas aos alunos', decorators=[token_required()])
 
@@ -14,6 +17,23 @@ aluno_post_parser.add_argument('matricula', type=str, required=True, help='Matri
 aluno_post_parser.add_argument('curso', type=str, required=True, help='Curso de origem do Aluno na Universidade')
 aluno_post_parser.add_argument('imagem_aluno', location='files', type=FileStorage, required=True, help='Imagem do Aluno a ser utilizada para extrair embedding')
 
+aluno_lote_parser = api.parser()
+aluno_lote_parser.add_argument('arquivo', location='files', type=FileStorage, help="Arquivo zip com as fotos e o arquivo 'alunos.csv' (colunas matricula, nome, curso e imagem)")
+aluno_lote_parser.add_argument('matricula', location='form', type=str, action='append', help='Matricula de cada Aluno (alternativa ao zip)')
+aluno_lote_parser.add_argument('nome', location='form', type=str, action='append', help='Nome de cada Aluno (alternativa ao zip)')
+aluno_lote_parser.add_argument('curso', location='form', type=str, action='append', help='Curso de cada Aluno (alternativa ao zip)')
+aluno_lote_parser.add_argument('imagem_aluno', location='files', type=FileStorage, action='append', help='Imagem de cada Aluno, na mesma ordem das matrículas (alternativa ao zip)')
+
+aluno_template_parser = api.parser()
+aluno_template_parser.add_argument('imagem_aluno', location='files', type=FileStorage, required=True, help='Nova imagem do Aluno a ser utilizada como template adicional')
+
+aluno_identificar_parser = api.parser()
+aluno_identificar_parser.add_argument('imagem_aluno', location='files', type=FileStorage, required=True, help='Imagem da pessoa a ser identificada')
+aluno_identificar_parser.add_argument('k', type=int, default=5, help='Quantidade de alunos mais similares retornados')
+
+aluno_varredura_parser = api.parser()
+aluno_varredura_parser.add_argument('threshold', location='args', type=float, help='Similaridade mínima para considerar dois alunos a mesma pessoa (padrão: DUPLICATE_IDENTITY_THRESHOLD)')
+
 aluno_get_parser = api.parser()
 aluno_get_parser.add_argument('nome', type=str, help='Nome do Aluno')
 aluno_get_parser.add_argument('matricula', type=str, help='Matricula do Aluno')
@@ -26,6 +46,73 @@ aluno_field = api.model('AlunoField', {
     'curso': fields.String
 })
 
+template_field = api.model('AlunoTemplateField', {
+    'id': fields.Integer,
+    'timestamp': fields.DateTime,
+})
+
+identificacao_field = api.model('IdentificacaoField', {
+    'resultados': fields.List(fields.Nested(api.model('IdentificacaoAlunoField', {
+        'matricula': fields.String,
+        'similaridade': fields.Float,
+    }))),
+})
+
+duplicata_field = api.model('DuplicataField', {
+    'matricula': fields.String,
+    'matricula_semelhante': fields.String,
+    'similaridade': fields.Float,
+})
+
+suspeita_field = api.inherit('SuspeitaDuplicidadeField', duplicata_field, {
+    'timestamp': fields.DateTime,
+})
+
+cadastro_lote_field = api.model('CadastroLoteField', {
+    'registrados': fields.Integer,
+    'alunos': fields.List(fields.Nested(api.model('CadastroAlunoField', {
+        'matricula': fields.String,
+        'status': fields.String(enum=['ok', 'dados_invalidos', 'matricula_duplicada', 'imagem_invalida', 'sem_face', 'varias_faces', 'possivel_duplicata']),
+    }))),
+})
+
+
+def ler_lote_zip(arquivo):
+    '''
+    Lê as entradas do cadastro em lote a partir do zip enviado; as fotos só são extraídas do zip quando forem processadas
+    '''
+    try:
+        arquivo_zip = zipfile.ZipFile(arquivo.stream)
+    except zipfile.BadZipFile:
+        abort(400, 'O arquivo enviado não é um zip válido.')
+
+    arquivos = set(arquivo_zip.namelist())
+
+    if 'alunos.csv' not in arquivos:
+        abort(400, "O arquivo zip deve conter o arquivo 'alunos.csv'.")
+
+    linhas = list(csv.DictReader(io.StringIO(arquivo_zip.read('alunos.csv').decode('utf-8-sig'))))
+
+    if linhas and not {'matricula', 'nome', 'curso', 'imagem'} <= set(linhas[0]):
+        abort(400, "O arquivo 'alunos.csv' deve conter as colunas matricula, nome, curso e imagem.")
+
+    def leitor(nome_arquivo):
+        return lambda: arquivo_zip.read(nome_arquivo) if nome_arquivo in arquivos else None
+
+    return [dict(matricula=linha['matricula'], nome=linha['nome'], curso=linha['curso'], ler_imagem=leitor(linha['imagem'])) for linha in linhas]
+
+
+def ler_lote_formulario(args):
+    '''
+    Lê as entradas do cadastro em lote enviadas como listas de campos do formulário, alinhadas pela ordem de envio
+    '''
+    campos = [args.matricula or [], args.nome or [], args.curso or [], args.imagem_aluno or []]
+
+    if not campos[0] or len({len(valores) for valores in campos}) != 1:
+        abort(400, 'Os campos matricula, nome, curso e imagem_aluno devem ter a mesma quantidade de valores.')
+
+    return [dict(matricula=matricula, nome=nome, curso=curso, ler_imagem=imagem.read) for matricula, nome, curso, imagem in zip(*campos)]
+
 @api.doc(responses={401: 'Token inválida. \n' 
                          'Token já expirou. \n'
                          'O header de autorização não está presente.'})
@@ -47,12 +134,17 @@ class rota_acesso_todos_alunos(Resource):
         return AlunoSchema(many=True, only=('nome', 'matricula', 'curso')).dump(alunos)
     
     @api.response(400, 'Já existe aluno com essa matrícula. \n'
-                       'Foram detectadas nenhuma ou mais de uma face na imagem enviada.')
+                       'Foram detectadas nenhuma ou mais de uma face na imagem enviada. \n'
+                       'A face enviada é semelhante à de um aluno já cadastrado.')
     @api.response(201, 'Success', api.model('matricula', {'aluno.matricula': fields.String}))
+    @api.response(409, 'Uma requisição com essa Idempotency-Key ainda está em processamento.')
+    @api.response(422, 'Essa Idempotency-Key já foi usada em uma requisição diferente.')
     @api.expect(aluno_post_parser)
+    @api.doc(params=PARAMETRO_IDEMPOTENCIA)
+    @idempotente()
     def post(self):
         '''
-        Registra um aluno no banco de dados
+        Registra um aluno no banco de dados (cadastros com face semelhante à de outro aluno são sinalizados ou rejeitados, conforme DUPLICATE_IDENTITY_ACTION)
         '''
         parser = reqparse.RequestParser(bundle_errors=True)
         parser.add_argument('nome', type=str, required=True, help='Nome do Aluno')
@@ -65,29 +157,127 @@ class rota_acesso_todos_alunos(Resource):
             abort(400, 'Já existe aluno com essa matrícula.')
 
         # Processa foto do aluno para pegar o array/embedding de features
-        img_bytes = args.imagem_aluno.read()
+        imagem = ImagemProcessada(args.imagem_aluno.read())
 
-        face_embedding = np.array(process_faces(img_bytes))
+        face_embedding = process_faces(imagem)
 
         if len(face_embedding) != 1:
             abort(400, 'Foram detectadas nenhuma ou mais de uma face na imagem enviada.')
 
-        # Obtem o binario desse array
-        face_binary = io.BytesIO()
-        np.save(face_binary, face_embedding)
-        face_binary.seek(0)
-        
+        acao = obter_configuracao('DUPLICATE_IDENTITY_ACTION', DUPLICATE_IDENTITY_ACTION)
+        duplicatas = buscar_duplicatas(face_embedding)[0] if acao != 'desativado' else []
+
+        if duplicatas and acao == 'rejeitar':
+            abort(400, 'A face enviada é semelhante à de um aluno já cadastrado.')
+
         aluno_selected = Aluno(nome=args.nome, 
                                matricula=args.matricula, 
                                curso=args.curso, 
-                               embedding=face_binary.read())
+                               embedding=serializar_embedding(face_embedding))
         
         db.session.add(aluno_selected)
+        db.session.flush() # O aluno precisa existir antes das suspeitas que o referenciam
+        registrar_suspeitas_de_duplicidade(aluno_selected.matricula, duplicatas)
         db.session.commit()
+        sincronizar_indice_alunos([aluno_selected.matricula])
 
         return {'aluno.matricula': aluno_selected.matricula}, 201
 
 
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_cadastro_lote_alunos(Resource):
+    @api.response(400, 'O arquivo enviado não é um zip válido. \n'
+                       "O arquivo zip deve conter o arquivo 'alunos.csv'. \n"
+                       "O arquivo 'alunos.csv' deve conter as colunas matricula, nome, curso e imagem. \n"
+                       'Os campos matricula, nome, curso e imagem_aluno devem ter a mesma quantidade de valores.')
+    @api.response(200, 'Success', cadastro_lote_field)
+    @api.response(409, 'Uma requisição com essa Idempotency-Key ainda está em processamento.')
+    @api.response(422, 'Essa Idempotency-Key já foi usada em uma requisição diferente.')
+    @api.expect(aluno_lote_parser)
+    @api.doc(params=PARAMETRO_IDEMPOTENCIA)
+    @idempotente()
+    def post(self):
+        '''
+        Registra vários alunos de uma só vez a partir de um arquivo zip ou de listas de campos no formulário, retornando o resultado de cada aluno (os alunos com uma única face na foto são registrados em uma única transação).
+        '''
+        args = aluno_lote_parser.parse_args(strict=True)
+
+        entradas = ler_lote_zip(args.arquivo) if args.arquivo else ler_lote_formulario(args)
+
+        status = cadastrar_alunos(entradas)
+        sincronizar_indice_alunos(entrada['matricula'] for entrada, status_aluno in zip(entradas, status) if status_aluno == 'ok')
+
+        return {'registrados': status.count('ok'),
+                'alunos': [{'matricula': entrada['matricula'], 'status': status_aluno} for entrada, status_aluno in zip(entradas, status)]}, 200
+
+
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_identificacao_alunos(Resource):
+    @api.response(400, 'Não foram detectadas faces na imagem enviada. \n'
+                       'O valor de k deve estar entre 1 e 50.')
+    @api.response(200, 'Success', identificacao_field)
+    @api.expect(aluno_identificar_parser)
+    def post(self):
+        '''
+        Identifica a pessoa na imagem entre todos os alunos cadastrados, retornando as matrículas mais similares (a maior face da imagem é a considerada).
+        '''
+        args = aluno_identificar_parser.parse_args(strict=True)
+
+        if not 1 <= args.k <= 50:
+            abort(400, 'O valor de k deve estar entre 1 e 50.')
+
+        embeddings, caixas = extrair_faces(ImagemProcessada(args.imagem_aluno.read()))
+
+        if len(embeddings) < 1:
+            abort(400, 'Não foram detectadas faces na imagem enviada.')
+
+        # Em um totem a pessoa identificada é a mais próxima da câmera
+        areas = (caixas[:, 2] - caixas[:, 0]) * (caixas[:, 3] - caixas[:, 1])
+        embedding = normalizar_embeddings(embeddings[np.argmax(areas)])[0]
+
+        resultados = obter_indice_alunos().buscar(embedding, args.k)
+
+        return {'resultados': [{'matricula': matricula, 'similaridade': similaridade} for matricula, similaridade in resultados]}, 200
+
+
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_duplicatas_alunos(Resource):
+    @api.response(200, 'Success', suspeita_field)
+    def get(self):
+        '''
+        Retorna os cadastros sinalizados por terem face semelhante à de outro aluno, da maior para a menor similaridade.
+        '''
+        suspeitas = SuspeitaDuplicidade.query.order_by(SuspeitaDuplicidade.similaridade.desc(), SuspeitaDuplicidade.id)
+
+        return SuspeitaDuplicidadeSchema(many=True).dump(suspeitas)
+
+
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_varredura_duplicatas_alunos(Resource):
+    @api.response(200, 'Success', duplicata_field)
+    @api.response(400, 'O threshold deve estar entre 0 e 1.')
+    @api.expect(aluno_varredura_parser)
+    def get(self):
+        '''
+        Compara todos os alunos entre si e retorna os pares de matrículas com faces semelhantes, da maior para a menor similaridade.
+        '''
+        args = aluno_varredura_parser.parse_args(strict=True)
+
+        if args.threshold is not None and not 0 <= args.threshold <= 1:
+            return abort(400, 'O threshold deve estar entre 0 e 1.')
+
+        return [{'matricula': matricula, 'matricula_semelhante': matricula_semelhante, 'similaridade': similaridade}
+                for matricula, matricula_semelhante, similaridade in varrer_duplicatas(args.threshold)]
+
+
 @api.doc(responses={401: 'Token inválida. \n' 
                          'Token já expirou. \n'
                          'O header de autorização não está presente.'})
@@ -136,19 +326,22 @@ class rota_acesso_unico_alunos(Resource):
             aluno_selected.update(dict(curso=args.curso))
 
         if args.imagem_aluno:
-            face_embedding = np.array(process_faces(args.imagem_aluno.read()))
+            face_embedding = process_faces(ImagemProcessada(args.imagem_aluno.read()))
             
             if len(face_embedding) != 1:
                 abort(400, 'Foram detectadas nenhuma ou mais de uma face na imagem enviada.')
 
-            face_binary = io.BytesIO()
-            np.save(face_binary, face_embedding)
-            face_binary.seek(0)
-            
-            aluno_selected.update(dict(embedding=face_binary.read()))
+            aluno_selected.update(dict(embedding=serializar_embedding(face_embedding)))
+
+        if args.matricula or args.imagem_aluno:
+            marcar_galerias_alteradas(matricula=args.matricula or matricula)
         
         db.session.commit()
 
+        if args.matricula or args.imagem_aluno:
+            cache_galerias.invalidar_matricula(matricula)
+            sincronizar_indice_alunos([args.matricula or matricula], removidas=[matricula])
+
         return {}, 204
 
     @api.response(400, 'Não existe aluno com essa matrícula no banco de dados.')
@@ -162,12 +355,100 @@ class rota_acesso_unico_alunos(Resource):
         if not aluno_selected.first():
             return abort(400, 'Não existe aluno com essa matricula no banco de dados.')
 
+        marcar_galerias_alteradas(matricula=matricula)
         aluno_selected.delete()
 
         db.session.commit()
+        cache_galerias.invalidar_matricula(matricula)
+        sincronizar_indice_alunos([], removidas=[matricula])
+
+        return {}, 204
+
+
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_templates_alunos(Resource):
+    @api.response(200, 'Success', template_field)
+    @api.response(400, 'Não existe aluno com essa matricula no banco de dados.')
+    def get(self, matricula):
+        '''
+        Retorna os templates adicionais (além da imagem do cadastro) de um aluno com determinada matrícula.
+        '''
+        if not Aluno.query.filter_by(matricula=matricula).first():
+            return abort(400, 'Não existe aluno com essa matricula no banco de dados.')
+
+        templates = AlunoTemplate.query.filter_by(matricula=matricula).order_by(AlunoTemplate.id)
+
+        return AlunoTemplateSchema(many=True).dump(templates)
+
+    @api.response(400, 'Não existe aluno com essa matricula no banco de dados. \n'
+                       'O aluno já possui a quantidade máxima de templates. \n'
+                       'Foram detectadas nenhuma ou mais de uma face na imagem enviada.')
+    @api.response(201, 'Success', api.model('template.id', {'template.id': fields.Integer}))
+    @api.response(409, 'Uma requisição com essa Idempotency-Key ainda está em processamento.')
+    @api.response(422, 'Essa Idempotency-Key já foi usada em uma requisição diferente.')
+    @api.expect(aluno_template_parser)
+    @api.doc(params=PARAMETRO_IDEMPOTENCIA)
+    @idempotente()
+    def post(self, matricula):
+        '''
+        Adiciona uma imagem do aluno como template de referência; na chamada, cada aluno é comparado pela maior similaridade entre todos os seus templates.
+        '''
+        args = aluno_template_parser.parse_args(strict=True)
+
+        if not Aluno.query.filter_by(matricula=matricula).first():
+            return abort(400, 'Não existe aluno com essa matricula no banco de dados.')
+
+        if AlunoTemplate.query.filter_by(matricula=matricula).count() >= obter_configuracao('STUDENT_MAX_TEMPLATES', 10):
+            return abort(400, 'O aluno já possui a quantidade máxima de templates.')
+
+        face_embedding = process_faces(ImagemProcessada(args.imagem_aluno.read()))
+
+        if len(face_embedding) != 1:
+            abort(400, 'Foram detectadas nenhuma ou mais de uma face na imagem enviada.')
+
+        template = AlunoTemplate(matricula=matricula, embedding=serializar_embedding(face_embedding))
+
+        db.session.add(template)
+        marcar_galerias_alteradas(matricula=matricula)
+        db.session.commit()
+        cache_galerias.invalidar_matricula(matricula)
+        sincronizar_indice_alunos([matricula])
+
+        return {'template.id': template.id}, 201
+
+
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_template_unico_alunos(Resource):
+    @api.response(400, 'Não existe template com esse ID para esse aluno.')
+    @api.response(204, 'Success')
+    def delete(self, matricula, template_id):
+        '''
+        Remove um template adicional de um aluno com determinada matrícula.
+        '''
+        template_selected = AlunoTemplate.query.filter_by(id=template_id, matricula=matricula)
+
+        if not template_selected.first():
+            return abort(400, 'Não existe template com esse ID para esse aluno.')
+
+        template_selected.delete()
+        marcar_galerias_alteradas(matricula=matricula)
+
+        db.session.commit()
+        cache_galerias.invalidar_matricula(matricula)
+        sincronizar_indice_alunos([matricula])
 
         return {}, 204
 
 
 api.add_resource(rota_acesso_todos_alunos, '/')
-api.add_resource(rota_acesso_unico_alunos, '/<string:matricula>/')
\ No newline at end of file
+api.add_resource(rota_cadastro_lote_alunos, '/lote/')
+api.add_resource(rota_identificacao_alunos, '/identificar/')
+api.add_resource(rota_duplicatas_alunos, '/duplicatas/')
+api.add_resource(rota_varredura_duplicatas_alunos, '/duplicatas/varredura/')
+api.add_resource(rota_acesso_unico_alunos, '/<string:matricula>/')
+api.add_resource(rota_templates_alunos, '/<string:matricula>/templates/')
+api.add_resource(rota_template_unico_alunos, '/<string:matricula>/templates/<int:template_id>/')
\ No newline at end of file
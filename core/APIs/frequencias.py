@@ -1,8 +1,10 @@
-from flask_restx import Namespace, Resource, fields, reqparse
+from flask_restx import Namespace, Resource, fields, reqparse, inputs
 from werkzeug.datastructures import FileStorage
 from flask import abort
 from core.models import *
 from core.utils import *
+from core.jobs import executor_de_jobs
+from core.idempotencia import idempotente, PARAMETRO_IDEMPOTENCIA
 
 api = Namespace('frequencias', description='Operações relacionadas ao registro da frequência', decorators=[token_required()])
 
@@ -12,7 +14,22 @@ frequencia_field = api.model('FrequenciaField', {
 })
 
 frequencia_post_parser = reqparse.RequestParser()
-frequencia_post_parser.add_argument('imagem_turma', location='files', type=FileStorage, required=True, help='Imagem da turma')
+frequencia_post_parser.add_argument('imagem_turma', location='files', type=FileStorage, required=True, action='append', help='Imagem da turma (pode ser enviada mais de uma foto da mesma aula)')
+frequencia_post_parser.add_argument('assincrono', location='args', type=inputs.boolean, default=False, help='Processa a imagem em segundo plano e retorna o ID do job')
+
+frequencia_imagens_parser = reqparse.RequestParser()
+frequencia_imagens_parser.add_argument('imagem_turma', location='files', type=FileStorage, required=True, action='append', help='Foto adicional da turma')
+
+frequencia_rematch_parser = reqparse.RequestParser()
+frequencia_rematch_parser.add_argument('threshold', location='args', type=float, default=0.49, help='Similaridade mínima para considerar o aluno presente')
+
+job_field = api.model('JobFrequenciaField', {
+    'id': fields.Integer,
+    'status': fields.String(enum=['queued', 'running', 'done', 'failed']),
+    'frequencia_id': fields.Integer,
+    'erro': fields.String,
+    'timestamp': fields.DateTime,
+})
 
 @api.doc(responses={401: 'Token inválida. \n' 
                          'Token já expirou. \n'
@@ -35,12 +52,18 @@ class rota_acesso_todas_frequencias(Resource):
 
     @api.response(400, 'Não existe turma com esse codigo no banco de dados. \n'
                        'Não existem participantes registrados na turma. \n' 
+                       'Foram enviadas mais imagens do que o permitido. \n'
                        'Não foram detectadas faces na imagem enviada.')
     @api.response(201, 'Success', api.model('frequencia.id', {'frequencia.id': fields.Integer}))
+    @api.response(202, 'Accepted', api.model('job.id', {'job.id': fields.Integer}))
+    @api.response(409, 'Uma requisição com essa Idempotency-Key ainda está em processamento.')
+    @api.response(422, 'Essa Idempotency-Key já foi usada em uma requisição diferente.')
     @api.expect(frequencia_post_parser)
+    @api.doc(params=PARAMETRO_IDEMPOTENCIA)
+    @idempotente()
     def post(self, codigo):
         '''
-        Registra uma frequencia de alunos para determinada turma no banco de dados.
+        Registra uma frequencia de alunos para determinada turma no banco de dados a partir de uma ou mais fotos da aula (com 'assincrono=true' o processamento é feito em segundo plano e o resultado é consultado na rota de jobs).
         '''
         args = frequencia_post_parser.parse_args(strict=True)
 
@@ -50,25 +73,15 @@ class rota_acesso_todas_frequencias(Resource):
         if not Participante.query.filter_by(turma_codigo=codigo).first():
             return abort(400, 'Não existem participantes registrados na turma.')
 
-        img_bytes = args.imagem_turma.read()
+        if len(args.imagem_turma) > obter_configuracao('ATTENDANCE_MAX_IMAGES', 4):
+            return abort(400, 'Foram enviadas mais imagens do que o permitido.')
 
-        alunos_presenca_status = checar_presenca_da_turma(turma_codigo=codigo, img_turma=img_bytes)
-
-        frequencia_do_dia = Frequencia(turma_codigo=codigo, imagem_turma=resize_img_bytes(img_bytes))
-        
-        db.session.add(frequencia_do_dia)
-        db.session.commit()
-        db.session.refresh(frequencia_do_dia)
+        img_bytes = [arquivo.read() for arquivo in args.imagem_turma]
 
-        for matricula in alunos_presenca_status.keys():
-            participante_id = Participante.query.filter_by(turma_codigo=codigo, matricula=matricula).all()[0].id
-            presenca = Presenca(frequencia_id=frequencia_do_dia.id, participante_id=participante_id, status=alunos_presenca_status[matricula])
-            db.session.add(presenca)
-        
-        db.session.add(AnotacaoErros(frequencia_id=frequencia_do_dia.id, falsos_positivos=0, falsos_negativos=0)) # Criando instância para registro dos erros das frequências
-        db.session.commit()
+        if args.assincrono:
+            return {'job.id': executor_de_jobs.enfileirar(codigo, img_bytes)}, 202
 
-        return {'frequencia.id': frequencia_do_dia.id}, 201
+        return {'frequencia.id': registrar_frequencia(codigo, img_bytes)}, 201
 
 
 @api.doc(responses={401: 'Token inválida. \n' 
@@ -78,6 +91,7 @@ class rota_acesso_unico_frequencias(Resource):
 
     @api.response(400, 'Não existe turma com esse codigo no banco de dados. \n'
                        'Não existe frequencia com esse ID no banco de dados. \n' 
+                       'Foram enviadas mais imagens do que o permitido. \n'
                        'Não foram detectadas faces na imagem enviada.')
     @api.response(204, 'Success')
     @api.expect(frequencia_post_parser)
@@ -94,25 +108,32 @@ class rota_acesso_unico_frequencias(Resource):
             return abort(400, 'Não existe frequencia com esse ID no banco de dados.')
 
         parser = reqparse.RequestParser()
-        parser.add_argument('imagem_turma', location='files', type=FileStorage, required=True, help='Imagem da turma')
+        parser.add_argument('imagem_turma', location='files', type=FileStorage, required=True, action='append', help='Imagem da turma')
         args = parser.parse_args(strict=True)
 
-        img_bytes = args.imagem_turma.read()
+        if len(args.imagem_turma) > obter_configuracao('ATTENDANCE_MAX_IMAGES', 4):
+            return abort(400, 'Foram enviadas mais imagens do que o permitido.')
+
+        imagens = abrir_imagens_da_frequencia([arquivo.read() for arquivo in args.imagem_turma])
+
+        galeria = obter_galeria_da_turma(codigo)
         
-        alunos_presenca_status = checar_presenca_da_turma(turma_codigo=codigo, img_turma=img_bytes)
+        embeddings, caixas, origens = reconhecer_faces_do_dia(imagens)
+        alunos_presenca_status, similaridades = comparar_com_galeria(galeria, embeddings, origens)
         
-        frequencia_selected.update(dict(imagem_turma=resize_img_bytes(img_bytes)))
+        frequencia_selected.update(dict(imagem_turma=imagens[0].miniatura()))
 
         # Novo registro de presença
-        Presenca.query.filter_by(frequencia_id=frequencia_selected.all()[0].id).delete()
-        for matricula in alunos_presenca_status.keys():
-            participante_id = Participante.query.filter_by(turma_codigo=codigo, matricula=matricula).all()[0].id
-            presenca = Presenca(frequencia_id=frequencia_selected.all()[0].id, participante_id=participante_id, status=alunos_presenca_status[matricula])
-            db.session.add(presenca)
+        Presenca.query.filter_by(frequencia_id=frequencia_id).delete()
+        registrar_presencas(frequencia_id, galeria, alunos_presenca_status, similaridades)
+
+        # Faces da nova imagem
+        FaceFrequencia.query.filter_by(frequencia_id=frequencia_id).delete()
+        registrar_faces(frequencia_id, embeddings, caixas, origens)
         
         # Inicializando nova contagem de erros
-        AnotacaoErros.query.filter_by(frequencia_id=frequencia_selected.all()[0].id).delete()
-        db.session.add(AnotacaoErros(frequencia_id=frequencia_selected.all()[0].id, falsos_positivos=0, falsos_negativos=0)) # Criando instância para registro dos erros das frequências
+        AnotacaoErros.query.filter_by(frequencia_id=frequencia_id).delete()
+        db.session.add(AnotacaoErros(frequencia_id=frequencia_id, falsos_positivos=0, falsos_negativos=0)) # Criando instância para registro dos erros das frequências
 
         db.session.commit()
 
@@ -140,5 +161,94 @@ class rota_acesso_unico_frequencias(Resource):
         return {}, 204
 
 
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_acesso_imagens_frequencias(Resource):
+    @api.response(400, 'Não existe turma com esse codigo no banco de dados. \n'
+                       'Não existe frequencia com esse ID no banco de dados. \n'
+                       'Foram enviadas mais imagens do que o permitido. \n'
+                       'Não foram detectadas faces na imagem enviada.')
+    @api.response(200, 'Success', api.model('presencas.atualizadas', {'matriculas': fields.List(fields.String)}))
+    @api.response(409, 'Uma requisição com essa Idempotency-Key ainda está em processamento.')
+    @api.response(422, 'Essa Idempotency-Key já foi usada em uma requisição diferente.')
+    @api.expect(frequencia_imagens_parser)
+    @api.doc(params=PARAMETRO_IDEMPOTENCIA)
+    @idempotente()
+    def post(self, codigo, frequencia_id):
+        '''
+        Adiciona uma ou mais fotos a uma frequencia já registrada, marcando como presentes apenas os alunos ausentes reconhecidos nelas (as demais presenças e as anotações de erros não são alteradas).
+        '''
+        args = frequencia_imagens_parser.parse_args(strict=True)
+
+        if not Turma.query.filter_by(codigo=codigo).first():
+            return abort(400, 'Não existe turma com esse codigo no banco de dados.')
+
+        if not Frequencia.query.filter_by(id=frequencia_id, turma_codigo=codigo).first():
+            return abort(400, 'Não existe frequencia com esse ID no banco de dados.')
+
+        if len(args.imagem_turma) > obter_configuracao('ATTENDANCE_MAX_IMAGES', 4):
+            return abort(400, 'Foram enviadas mais imagens do que o permitido.')
+
+        matriculas = adicionar_imagens_a_frequencia(codigo, frequencia_id, [arquivo.read() for arquivo in args.imagem_turma])
+
+        return {'matriculas': matriculas}, 200
+
+
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_rematch_frequencias(Resource):
+    @api.response(400, 'Não existe turma com esse codigo no banco de dados. \n'
+                       'Não existe frequencia com esse ID no banco de dados. \n'
+                       'O threshold deve estar entre 0 e 1. \n'
+                       'Não existem faces armazenadas para essa frequencia.')
+    @api.response(204, 'Success')
+    @api.expect(frequencia_rematch_parser)
+    def post(self, codigo, frequencia_id):
+        '''
+        Refaz o registro de presença de uma frequencia a partir das faces já armazenadas, com outro threshold ou com os participantes atuais da turma (sem processar a imagem novamente).
+        '''
+        args = frequencia_rematch_parser.parse_args(strict=True)
+
+        if not Turma.query.filter_by(codigo=codigo).first():
+            return abort(400, 'Não existe turma com esse codigo no banco de dados.')
+
+        if not Frequencia.query.filter_by(id=frequencia_id, turma_codigo=codigo).first():
+            return abort(400, 'Não existe frequencia com esse ID no banco de dados.')
+
+        if not 0 <= args.threshold <= 1:
+            return abort(400, 'O threshold deve estar entre 0 e 1.')
+
+        recomparar_frequencia(codigo, frequencia_id, threshold=args.threshold)
+
+        return {}, 204
+
+
+@api.doc(responses={401: 'Token inválida. \n' 
+                         'Token já expirou. \n'
+                         'O header de autorização não está presente.'})
+class rota_acesso_jobs_frequencias(Resource):
+    @api.response(400, 'Não existe turma com esse codigo no banco de dados. \n'
+                       'Não existe job com esse ID no banco de dados.')
+    @api.response(200, 'Success', job_field)
+    def get(self, codigo, job_id):
+        '''
+        Retorna o estado de um job de registro de frequência (queued, running, done ou failed) e o ID da frequência gerada.
+        '''
+        if not Turma.query.filter_by(codigo=codigo).first():
+            return abort(400, 'Não existe turma com esse codigo no banco de dados.')
+
+        job_selected = JobFrequencia.query.filter_by(id=job_id, turma_codigo=codigo).first()
+
+        if not job_selected:
+            return abort(400, 'Não existe job com esse ID no banco de dados.')
+
+        return JobFrequenciaSchema().dump(job_selected)
+
+
 api.add_resource(rota_acesso_todas_frequencias, '/<string:codigo>/frequencias/')
 api.add_resource(rota_acesso_unico_frequencias, '/<string:codigo>/frequencias/<int:frequencia_id>/')
+api.add_resource(rota_acesso_imagens_frequencias, '/<string:codigo>/frequencias/<int:frequencia_id>/imagens/')
+api.add_resource(rota_rematch_frequencias, '/<string:codigo>/frequencias/<int:frequencia_id>/rematch/')
+api.add_resource(rota_acesso_jobs_frequencias, '/<string:codigo>/frequencias/jobs/<int:job_id>/')
@@ -63,7 +63,9 @@ class rota_acesso_todos_participantes(Resource):
         aluno_participante = Participante(matricula=args.matricula, turma_codigo=codigo)
 
         db.session.add(aluno_participante)
+        marcar_galerias_alteradas(turma_codigo=codigo)
         db.session.commit()
+        cache_galerias.invalidar(codigo)
         db.session.refresh(aluno_participante)
         
         return {'participante.id': aluno_participante.id}, 201
@@ -106,8 +108,10 @@ class rota_acesso_unico_participantes(Resource):
             return abort(400, 'Não existe participante com esse ID no banco de dados dessa turma.')
 
         aluno_participante.delete()
+        marcar_galerias_alteradas(turma_codigo=codigo)
 
         db.session.commit()
+        cache_galerias.invalidar(codigo)
 
         return {}, 204
 
@@ -0,0 +1,31 @@
+from flask_restx import Namespace, Resource, fields
+from core.modelos import modelos
+from core.inferencia import servico_inferencia
+
+api = Namespace('saude', description='Estado do servidor e da configuração de reconhecimento facial')
+
+saude_field = api.model('SaudeField', {
+    'status': fields.String,
+    'modelos_carregados': fields.Boolean,
+    'precisao': fields.String,
+    'pesos_locais': fields.Boolean,
+    'torchscript': fields.Boolean,
+    'workers_inferencia': fields.Integer,
+})
+
+
+class rota_saude(Resource):
+    @api.response(200, 'Success', saude_field)
+    def get(self):
+        '''
+        Retorna o estado do servidor e a configuração das redes de reconhecimento facial (não requer autenticação).
+        '''
+        return {'status': 'ok',
+                'modelos_carregados': modelos.carregado,
+                'precisao': modelos.precisao,
+                'pesos_locais': bool(modelos.diretorio_pesos),
+                'torchscript': bool(modelos.diretorio_torchscript),
+                'workers_inferencia': servico_inferencia.num_workers}
+
+
+api.add_resource(rota_saude, '/')
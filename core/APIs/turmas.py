@@ -111,8 +111,10 @@ class rota_acesso_unico_turmas(Resource):
                 return abort(400, 'Não existe professor com esse ID no banco de dados.')
             
         if args:
+            marcar_galerias_alteradas(turma_codigo=codigo)
             turma_selected.update(dict(**args))
             db.session.commit()
+            cache_galerias.invalidar(codigo)
         
         return {}, 204
 
@@ -130,6 +132,7 @@ class rota_acesso_unico_turmas(Resource):
         turma_selected.delete()
 
         db.session.commit()
+        cache_galerias.invalidar(codigo)
 
         return {}, 204
 
@@ -0,0 +1,130 @@
+'''
+Cache em disco dos resultados do reconhecimento facial (caixas e embeddings das faces) de cada imagem enviada.
+
+A chave é o SHA-256 dos bytes da imagem junto com a versão da pipeline (pesos, precisão e configurações de detecção), de forma que
+reenvios da mesma foto não passam de novo pela MTCNN e pela Inception. O armazenamento é um arquivo SQLite compartilhado por todos os
+processos do servidor, com descarte LRU baseado em um limite de tamanho.
+'''
+
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+from threading import Lock
+import numpy as np
+
+from core.embeddings import EMBEDDING_DIM
+
+_ESQUEMA = '''
+CREATE TABLE IF NOT EXISTS resultado (
+    chave TEXT PRIMARY KEY,
+    embeddings BLOB NOT NULL,
+    caixas BLOB NOT NULL,
+    tamanho INTEGER NOT NULL,
+    acesso REAL NOT NULL
+)
+'''
+_INDICE = 'CREATE INDEX IF NOT EXISTS resultado_acesso ON resultado (acesso)'
+
+
+class CacheDeResultados:
+    '''
+    Resultados da detecção e da extração de características indexados pelo conteúdo da imagem
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self.caminho = None
+        self.limite_bytes = 0
+        self.versao = ''
+
+    @property
+    def ativo(self):
+        return bool(self.caminho) and self.limite_bytes > 0
+
+    def configurar(self, caminho=None, limite_bytes=256 * 1024 * 1024, versao=''):
+        '''
+        Define o arquivo do cache (sem caminho o cache fica desativado), o tamanho máximo dos resultados armazenados e a versão da pipeline
+        '''
+        with self._lock:
+            self.caminho = caminho
+            self.limite_bytes = limite_bytes
+            self.versao = versao
+
+            if self.ativo:
+                with self._conectar() as conexao:
+                    # WAL permite leituras de outros processos durante uma escrita
+                    conexao.execute('PRAGMA journal_mode=WAL')
+                    conexao.execute(_ESQUEMA)
+                    conexao.execute(_INDICE)
+
+    def chave(self, img_bytes):
+        return hashlib.sha256(self.versao.encode() + b'\0' + img_bytes).hexdigest()
+
+    def obter(self, img_bytes):
+        '''
+        Retorna os embeddings (N, 512) e as caixas (N, 4) armazenados para a imagem, ou None quando ela não está no cache
+        '''
+        if not self.ativo:
+            return None
+
+        chave = self.chave(img_bytes)
+
+        with self._conectar() as conexao:
+            linha = conexao.execute('SELECT embeddings, caixas FROM resultado WHERE chave = ?', (chave,)).fetchone()
+            if linha is None:
+                return None
+            conexao.execute('UPDATE resultado SET acesso = ? WHERE chave = ?', (time.time(), chave))
+
+        embeddings, caixas = linha
+        return (np.frombuffer(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM),
+                np.frombuffer(caixas, dtype=np.float32).reshape(-1, 4))
+
+    def adicionar(self, img_bytes, embeddings, caixas):
+        '''
+        Armazena o resultado da imagem e descarta os resultados usados há mais tempo até que o total caiba no limite
+        '''
+        if not self.ativo:
+            return
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).tobytes()
+        caixas = np.ascontiguousarray(caixas, dtype=np.float32).tobytes()
+        tamanho = len(embeddings) + len(caixas)
+
+        # Resultados maiores que o limite não são armazenados
+        if tamanho > self.limite_bytes:
+            return
+
+        with self._conectar() as conexao:
+            conexao.execute('INSERT OR REPLACE INTO resultado (chave, embeddings, caixas, tamanho, acesso) VALUES (?, ?, ?, ?, ?)',
+                            (self.chave(img_bytes), embeddings, caixas, tamanho, time.time()))
+
+            excedente = conexao.execute('SELECT COALESCE(SUM(tamanho), 0) FROM resultado').fetchone()[0] - self.limite_bytes
+            if excedente <= 0:
+                return
+
+            descartadas = []
+            for chave, tamanho in conexao.execute('SELECT chave, tamanho FROM resultado ORDER BY acesso'):
+                if excedente <= 0:
+                    break
+                descartadas.append((chave,))
+                excedente -= tamanho
+
+            conexao.executemany('DELETE FROM resultado WHERE chave = ?', descartadas)
+
+    def limpar(self):
+        if self.ativo:
+            with self._conectar() as conexao:
+                conexao.execute('DELETE FROM resultado')
+
+    @contextmanager
+    def _conectar(self):
+        # Uma conexão por operação, já que as requisições chegam de threads diferentes; o commit é feito ao final do bloco
+        conexao = sqlite3.connect(self.caminho, timeout=30)
+        try:
+            with conexao:
+                yield conexao
+        finally:
+            conexao.close()
+
+
+cache_resultados = CacheDeResultados()
@@ -0,0 +1,75 @@
+'''
+Medição do compromisso entre latência e recall da detecção de faces para diferentes limites de resolução (DETECTION_MAX_SIDE).
+
+A referência de cada imagem é a detecção na resolução original; uma face conta como encontrada quando alguma caixa
+detectada na imagem reduzida (já reescalada para a resolução original) tem IoU acima de 0.5 com ela.
+
+Uso (a partir da raiz do repositório):
+    python core/deteccao.py [--imagens tests/test_images] [--lados 640 960 1280 1600] [--pesos <MODEL_WEIGHTS_DIR>]
+'''
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from core.modelos import modelos
+from core.imagem import ImagemProcessada
+from core.utils import from_img_dir_to_bytes, detectar_caixas, iou
+
+
+def _detectar(imagem, lado_maximo):
+    inicio = time.perf_counter()
+    caixas = detectar_caixas(imagem, lado_maximo=lado_maximo)
+    return (np.zeros((0, 4)) if caixas is None else caixas), time.perf_counter() - inicio
+
+
+def avaliar_deteccao(diretorio_imagens, lados_maximos):
+    '''
+    Retorna, por imagem, o número de faces e o tempo da detecção em resolução original e, para cada limite de resolução,
+    o tempo de detecção e o recall em relação à resolução original
+    '''
+    modelos.carregar()
+
+    resultados = {}
+
+    for arquivo in sorted(os.listdir(diretorio_imagens)):
+        # A imagem é decodificada antes das medições, que cobrem apenas a redução e a detecção
+        imagem = ImagemProcessada(from_img_dir_to_bytes(os.path.join(diretorio_imagens, arquivo)))
+        imagem.imagem
+
+        referencia, tempo_referencia = _detectar(imagem, 0)
+        resultado = dict(faces=len(referencia), tempo=tempo_referencia, limites={})
+
+        for lado_maximo in lados_maximos:
+            caixas, tempo = _detectar(imagem, lado_maximo)
+
+            encontradas = int((iou(referencia, caixas) > 0.5).any(axis=1).sum()) if len(caixas) else 0
+            recall = encontradas / len(referencia) if len(referencia) else 1.0
+
+            resultado['limites'][lado_maximo] = dict(faces=len(caixas), tempo=tempo, recall=recall)
+
+        resultados[arquivo] = resultado
+
+    return resultados
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Mede latência e recall da detecção de faces para diferentes limites de resolução.')
+    parser.add_argument('--imagens', default='tests/test_images', help='Diretório com as imagens de teste')
+    parser.add_argument('--lados', type=int, nargs='+', default=[640, 960, 1280, 1600], help='Limites de resolução (DETECTION_MAX_SIDE) avaliados')
+    parser.add_argument('--minimo', type=int, default=20, help='Tamanho mínimo de face (DETECTION_MIN_FACE_SIZE)')
+    parser.add_argument('--pesos', default=os.getenv('MODEL_WEIGHTS_DIR'), help='Diretório local dos pesos (MODEL_WEIGHTS_DIR)')
+    args = parser.parse_args()
+
+    modelos.configurar(diretorio_pesos=args.pesos, tamanho_minimo_face=args.minimo)
+
+    for arquivo, resultado in avaliar_deteccao(args.imagens, args.lados).items():
+        print(f"{arquivo}: {resultado['faces']} face(s) em resolução original, {resultado['tempo'] * 1000:.1f} ms")
+        for lado_maximo, limite in resultado['limites'].items():
+            print(f"    {lado_maximo} px: {limite['faces']} face(s), recall {limite['recall']:.2f}, {limite['tempo'] * 1000:.1f} ms")
@@ -0,0 +1,62 @@
+'''
+Formato compacto de armazenamento dos embeddings (coluna aluno.embedding):
+
+    cabeçalho de 4 bytes: b'FE' + versão (uint8) + código do dtype (uint8)
+    seguido pelos valores little-endian do vetor já normalizado (norma L2 unitária)
+
+Blobs antigos gerados com np.save continuam sendo lidos normalmente.
+'''
+
+import io
+import struct
+import numpy as np
+
+EMBEDDING_DIM = 512
+VERSAO_FORMATO = 1
+
+_MAGIC = b'FE'
+_MAGIC_NPY = b'\x93NUMPY'
+_CABECALHO = struct.Struct('<2sBB')
+_DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<f2')}
+_CODIGOS = {'float32': 0, 'float16': 1}
+
+
+def codificar_embedding(embedding, dtype='float32'):
+    '''
+    Normaliza o embedding e o converte para o formato compacto de armazenamento
+    '''
+    if dtype not in _CODIGOS:
+        raise ValueError(f"Tipo de armazenamento de embedding inválido: '{dtype}'.")
+
+    vetor = np.asarray(embedding, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    vetor = vetor / np.maximum(np.linalg.norm(vetor, axis=1, keepdims=True), np.finfo(np.float32).eps)
+
+    codigo = _CODIGOS[dtype]
+    return _CABECALHO.pack(_MAGIC, VERSAO_FORMATO, codigo) + vetor.astype(_DTYPES[codigo]).tobytes()
+
+
+def decodificar_embedding(dados):
+    '''
+    Lê um embedding armazenado, retornando um array float32 de formato (N, 512). Para float32 o array é uma visão somente leitura dos bytes, sem cópia.
+    '''
+    if dados[:len(_MAGIC_NPY)] == _MAGIC_NPY:
+        return np.load(io.BytesIO(dados)).astype(np.float32, copy=False).reshape(-1, EMBEDDING_DIM)
+
+    magic, versao, codigo = _CABECALHO.unpack_from(dados)
+
+    if magic != _MAGIC or versao != VERSAO_FORMATO or codigo not in _DTYPES:
+        raise ValueError('Formato de embedding desconhecido.')
+
+    vetor = np.frombuffer(dados, dtype=_DTYPES[codigo], offset=_CABECALHO.size)
+    return vetor.astype(np.float32, copy=False).reshape(-1, EMBEDDING_DIM)
+
+
+def formato_compacto(dados, dtype=None):
+    '''
+    Indica se o blob já está no formato compacto na versão atual e, quando 'dtype' é informado, armazenado com essa precisão
+    '''
+    if len(dados) < _CABECALHO.size or dados[:len(_MAGIC)] != _MAGIC:
+        return False
+
+    _, versao, codigo = _CABECALHO.unpack_from(dados)
+    return versao == VERSAO_FORMATO and (dtype is None or codigo == _CODIGOS.get(dtype))
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from core.embeddings import EMBEDDING_DIM
+
+
+AGREGACOES = ('max', 'centroide')
+
+
+class Galeria:
+    '''
+    Embeddings normalizados dos participantes de uma turma e os respectivos identificadores.
+
+    A matriz pode conter vários templates por participante, agrupados em linhas consecutivas; 'inicios' indica a primeira linha
+    de cada participante (None quando há exatamente uma linha por participante).
+    '''
+    def __init__(self, matriz, matriculas, participante_ids, inicios=None):
+        self.matriz = np.ascontiguousarray(matriz, dtype=np.float32)
+        self.matriculas = list(matriculas)
+        self.participante_ids = np.asarray(participante_ids, dtype=np.int64)
+        self.inicios = None if inicios is None else np.asarray(inicios, dtype=np.int64)
+
+    @classmethod
+    def de_templates(cls, templates, matriculas, participante_ids, agregacao='max'):
+        '''
+        Monta a galeria a partir dos templates normalizados (array (K, 512), K >= 1) de cada participante. Com agregação 'max' a similaridade
+        de um participante é a maior entre os seus templates; com 'centroide' cada participante é representado pela média normalizada deles.
+        '''
+        if agregacao not in AGREGACOES:
+            raise ValueError(f"Agregação de templates inválida: '{agregacao}'.")
+
+        if agregacao == 'centroide' or all(len(templates_participante) == 1 for templates_participante in templates):
+            centroides = np.stack([templates_participante.mean(axis=0) for templates_participante in templates]) if templates else np.empty((0, EMBEDDING_DIM))
+            centroides /= np.maximum(np.linalg.norm(centroides, axis=1, keepdims=True), np.finfo(np.float32).eps)
+            return cls(centroides, matriculas, participante_ids)
+
+        inicios = np.cumsum([0] + [len(templates_participante) for templates_participante in templates[:-1]])
+        return cls(np.concatenate(templates), matriculas, participante_ids, inicios=inicios)
+
+    @property
+    def nbytes(self):
+        return self.matriz.nbytes + self.participante_ids.nbytes + sum(len(matricula) for matricula in self.matriculas) + \
+               (0 if self.inicios is None else self.inicios.nbytes)
+
+    def similaridades(self, embeddings):
+        '''
+        Matriz (faces x participantes) de similaridade cosseno entre os embeddings normalizados e a galeria, calculada com uma única
+        multiplicação pela matriz de templates seguida do máximo entre os templates de cada participante
+        '''
+        similaridades = embeddings @ self.matriz.T
+
+        if self.inicios is None:
+            return similaridades
+
+        if len(similaridades) == 0:
+            return np.empty((0, len(self.matriculas)), dtype=np.float32)
+
+        return np.maximum.reduceat(similaridades, self.inicios, axis=1)
+
+
+class CacheDeGalerias:
+    '''
+    Cache local ao processo das galerias de cada turma, com descarte LRU baseado em um limite de memória.
+
+    Cada galeria é armazenada com a versão da turma lida antes da sua montagem (ver Turma.versao_galeria); a consulta com uma versão
+    diferente é tratada como ausência, então alterações confirmadas por outros processos também invalidam a galeria.
+    '''
+    def __init__(self):
+        self._galerias = OrderedDict()
+        self._bytes_em_uso = 0
+        self._lock = Lock()
+
+    def obter(self, turma_codigo, versao=None):
+        with self._lock:
+            versao_armazenada, galeria = self._galerias.get(turma_codigo, (None, None))
+            if galeria is None:
+                return None
+
+            if versao_armazenada != versao:
+                self._remover(turma_codigo)
+                return None
+
+            self._galerias.move_to_end(turma_codigo)
+            return galeria
+
+    def adicionar(self, turma_codigo, galeria, limite_bytes, versao=None):
+        with self._lock:
+            self._remover(turma_codigo)
+
+            # Galerias maiores que o limite não são armazenadas
+            if galeria.nbytes > limite_bytes:
+                return
+
+            self._galerias[turma_codigo] = (versao, galeria)
+            self._bytes_em_uso += galeria.nbytes
+
+            while self._bytes_em_uso > limite_bytes:
+                turma_mais_antiga = next(iter(self._galerias))
+                self._remover(turma_mais_antiga)
+
+    def invalidar(self, turma_codigo):
+        with self._lock:
+            self._remover(turma_codigo)
+
+    def invalidar_matricula(self, matricula):
+        '''
+        Remove todas as galerias que contêm o aluno com determinada matrícula
+        '''
+        with self._lock:
+            for turma_codigo in [codigo for codigo, (_, galeria) in self._galerias.items() if matricula in galeria.matriculas]:
+                self._remover(turma_codigo)
+
+    def limpar(self):
+        with self._lock:
+            self._galerias.clear()
+            self._bytes_em_uso = 0
+
+    def _remover(self, turma_codigo):
+        _, galeria = self._galerias.pop(turma_codigo, (None, None))
+        if galeria is not None:
+            self._bytes_em_uso -= galeria.nbytes
+
+
+cache_galerias = CacheDeGalerias()
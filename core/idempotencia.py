@@ -0,0 +1,235 @@
+'''
+Suporte ao header 'Idempotency-Key' nas rotas que executam o reconhecimento facial.
+
+A primeira requisição com uma chave reserva a chave no banco de dados (tabela 'requisicao_idempotente') e armazena a resposta ao
+terminar. Repetições dentro do prazo configurado recebem a mesma resposta sem executar a rota de novo, e repetições que chegam
+enquanto a primeira ainda está em andamento aguardam o seu resultado em vez de executar a pipeline em paralelo.
+
+A reserva pertence ao processo que executa a requisição, que renova o seu heartbeat enquanto a rota não termina (como os jobs de
+core/jobs.py). Se o processo for encerrado no meio da execução, uma repetição assume a reserva assim que o dono não existir mais
+(verificável apenas no mesmo host) ou o lease expirar, em vez de receber 409 até o fim do prazo da chave.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import Event, Lock, Thread
+from flask import abort, current_app, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from core.models import db, RequisicaoIdempotente
+from core.jobs import identificador_do_processo, igual_ou_nulo, dono_encerrado
+from core.utils import obter_configuracao
+
+HEADER = 'Idempotency-Key'
+TAMANHO_MAXIMO_CHAVE = 128
+
+# Documentação do header no Swagger, usada com @api.doc(params=...)
+PARAMETRO_IDEMPOTENCIA = {HEADER: {'in': 'header', 'type': 'string',
+                                   'description': 'Identificador único da operação; repetições com a mesma chave recebem a resposta da primeira'}}
+
+# Requisições em andamento neste processo, para que as repetições sejam avisadas assim que a resposta for armazenada
+_em_andamento = {}
+_lock = Lock()
+_identificadores = {}
+
+
+def _identificador():
+    # Gerado por pid, já que o módulo pode ter sido importado antes do fork dos processos do servidor
+    with _lock:
+        return _identificadores.setdefault(os.getpid(), identificador_do_processo())
+
+
+def idempotente():
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            chave = request.headers.get(HEADER)
+            if not chave:
+                return fn(*args, **kwargs)
+
+            if len(chave) > TAMANHO_MAXIMO_CHAVE:
+                abort(400, f'A {HEADER} deve ter no máximo {TAMANHO_MAXIMO_CHAVE} caracteres.')
+
+            escopo = f'{request.method} {request.path} {get_jwt_identity()}'
+            impressao = _impressao_da_requisicao()
+            prazo = time.monotonic() + obter_configuracao('IDEMPOTENCY_WAIT_SECONDS', 300)
+
+            while True:
+                reservada, registro = _reservar(escopo, chave, impressao, obter_configuracao('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+
+                if reservada:
+                    return _executar(fn, args, kwargs, escopo, chave)
+
+                if registro is not None:
+                    if registro.impressao != impressao:
+                        abort(422, f'Essa {HEADER} já foi usada em uma requisição diferente.')
+
+                    if registro.status == 'done':
+                        return _reproduzir(registro)
+
+                    if time.monotonic() >= prazo:
+                        abort(409, f'Uma requisição com essa {HEADER} ainda está em processamento.')
+
+                _aguardar(escopo, chave, prazo)
+        return decorator
+    return wrapper
+
+
+def _impressao_da_requisicao():
+    '''
+    SHA-256 do conteúdo da requisição. Para formulários são usados os campos e os arquivos, já que o separador do multipart muda a cada envio.
+    '''
+    impressao = hashlib.sha256(request.query_string)
+
+    if request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        impressao.update(json.dumps(sorted(request.form.items(multi=True))).encode())
+
+        for nome, arquivo in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            conteudo = arquivo.read()
+            arquivo.seek(0) # O arquivo ainda será lido pela rota
+            impressao.update(f'{nome}:{len(conteudo)}:'.encode() + conteudo)
+    else:
+        impressao.update(request.get_data())
+
+    return impressao.hexdigest()
+
+
+def _reservar(escopo, chave, impressao, validade):
+    '''
+    Tenta reservar a chave para esta requisição, assumindo a reserva abandonada por um processo encerrado ou com o lease expirado.
+    Retorna se a reserva foi feita e, caso contrário, o registro existente da chave.
+    '''
+    agora = datetime.utcnow()
+    RequisicaoIdempotente.query.filter(RequisicaoIdempotente.timestamp < agora - timedelta(seconds=validade)).delete()
+
+    try:
+        db.session.add(RequisicaoIdempotente(escopo=escopo, chave=chave, impressao=impressao, status='running',
+                                             dono=_identificador(), heartbeat=agora))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        registro = RequisicaoIdempotente.query.filter_by(escopo=escopo, chave=chave).first()
+
+        if registro is None or registro.impressao != impressao or not _abandonada(registro, agora):
+            return False, registro
+
+        # Condicional ao dono e ao heartbeat lidos, para que só uma repetição assuma a reserva e nunca uma reserva recém-renovada
+        assumida = RequisicaoIdempotente.query.filter(RequisicaoIdempotente.id == registro.id, RequisicaoIdempotente.status == 'running',
+                                                      igual_ou_nulo(RequisicaoIdempotente.dono, registro.dono),
+                                                      igual_ou_nulo(RequisicaoIdempotente.heartbeat, registro.heartbeat))\
+                                              .update(dict(dono=_identificador(), heartbeat=agora), synchronize_session=False)
+        db.session.commit()
+
+        if not assumida:
+            return False, registro
+
+    with _lock:
+        _em_andamento[(escopo, chave)] = Event()
+
+    return True, None
+
+
+def _abandonada(registro, agora):
+    if registro.status != 'running':
+        return False
+
+    limite = agora - timedelta(seconds=obter_configuracao('IDEMPOTENCY_LEASE_SECONDS', 30))
+    return registro.heartbeat is None or registro.heartbeat < limite or dono_encerrado(registro.dono, _identificador())
+
+
+def _manter_reserva(app, escopo, chave, intervalo, parar):
+    '''
+    Renova o heartbeat da reserva enquanto a rota é executada
+    '''
+    while not parar.wait(intervalo):
+        with app.app_context():
+            try:
+                RequisicaoIdempotente.query.filter_by(escopo=escopo, chave=chave, dono=_identificador(), status='running')\
+                                           .update(dict(heartbeat=datetime.utcnow()))
+                db.session.commit()
+            except Exception: # Falhas temporárias do banco são tentadas de novo na próxima renovação
+                logging.getLogger(__name__).exception('Falha na renovação do lease de uma Idempotency-Key.')
+            finally:
+                db.session.remove()
+
+
+def _executar(fn, args, kwargs, escopo, chave):
+    parar = Event()
+    renovacao = Thread(target=_manter_reserva, name='idempotencia-lease', daemon=True,
+                       args=(current_app._get_current_object(), escopo, chave, obter_configuracao('IDEMPOTENCY_LEASE_SECONDS', 30) / 3, parar))
+    renovacao.start()
+
+    try:
+        try:
+            resultado = fn(*args, **kwargs)
+        except HTTPException as erro:
+            db.session.rollback()
+
+            # Erros de validação se repetiriam com o mesmo corpo, então também são armazenados
+            if erro.code is not None and erro.code < 500:
+                _concluir(escopo, chave, erro.code, {'message': erro.description})
+            else:
+                _liberar(escopo, chave)
+            raise
+        except Exception:
+            db.session.rollback()
+            _liberar(escopo, chave)
+            raise
+
+        corpo, codigo = (resultado[0], resultado[1]) if isinstance(resultado, tuple) else (resultado, 200)
+        _concluir(escopo, chave, codigo, corpo)
+
+        return resultado
+    finally:
+        parar.set()
+        renovacao.join()
+
+        # Avisa as repetições que aguardam neste processo, já com a resposta armazenada
+        with _lock:
+            evento = _em_andamento.pop((escopo, chave), None)
+
+        if evento is not None:
+            evento.set()
+
+
+def _concluir(escopo, chave, codigo, corpo):
+    # Uma reserva assumida por outro processo (lease expirado) não é sobrescrita
+    RequisicaoIdempotente.query.filter_by(escopo=escopo, chave=chave, dono=_identificador())\
+                               .update(dict(status='done', codigo=codigo, resposta=json.dumps(corpo)))
+    db.session.commit()
+
+
+def _liberar(escopo, chave):
+    # Falhas inesperadas não são armazenadas, permitindo que a requisição seja repetida
+    RequisicaoIdempotente.query.filter_by(escopo=escopo, chave=chave, dono=_identificador()).delete()
+    db.session.commit()
+
+
+def _reproduzir(registro):
+    corpo = json.loads(registro.resposta)
+
+    if registro.codigo >= 400:
+        abort(registro.codigo, corpo['message'])
+
+    return corpo, registro.codigo, {'Idempotency-Replayed': 'true'}
+
+
+def _aguardar(escopo, chave, prazo):
+    with _lock:
+        evento = _em_andamento.get((escopo, chave))
+
+    restante = max(0.0, prazo - time.monotonic())
+
+    # Requisições em andamento em outros processos são consultadas periodicamente
+    if evento is not None:
+        evento.wait(restante)
+    else:
+        time.sleep(min(0.1, restante))
+
+    db.session.rollback() # Encerra a transação atual para que a próxima consulta veja o registro atualizado
@@ -0,0 +1,143 @@
+'''
+Contexto de processamento de uma imagem enviada para a API.
+
+Os bytes são decodificados uma única vez, já com a orientação EXIF aplicada, e o mesmo buffer serve o detector de faces
+(em resolução reduzida), os recortes das faces (em resolução original) e a miniatura armazenada no banco de dados.
+'''
+
+import io
+import numpy as np
+from PIL import Image, ImageOps
+
+TAMANHO_MINIATURA = (512, 256)
+TAMANHO_FACE = (160, 160)
+LADO_MAXIMO_REGIAO = 2 * TAMANHO_FACE[0] # Faces maiores são reduzidas antes do ROI Align, limitando a memória do lote
+ORIENTACAO_EXIF = 0x0112
+
+
+class ImagemProcessada:
+    def __init__(self, img_bytes, com_miniatura=False):
+        '''
+        'com_miniatura' indica que a miniatura será usada, permitindo que ela seja gerada junto com a decodificação quando
+        a imagem for processada em outro processo (ver core/inferencia.py)
+        '''
+        self.img_bytes = img_bytes
+        self.com_miniatura = com_miniatura
+        self._arquivo = Image.open(io.BytesIO(img_bytes)) # Só lê o cabeçalho; os pixels são decodificados no primeiro acesso
+        self._imagem = None
+        self._deteccao = {}
+        self._miniatura = None
+
+    @property
+    def pixels(self):
+        return self._arquivo.width * self._arquivo.height
+
+    @property
+    def imagem(self):
+        '''
+        Imagem RGB em resolução original, com a orientação EXIF aplicada
+        '''
+        if self._imagem is None:
+            img = self._arquivo
+
+            # exif_transpose e convert sempre copiam a imagem, então só são chamados quando necessários
+            if img.getexif().get(ORIENTACAO_EXIF, 1) != 1:
+                img = ImageOps.exif_transpose(img)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            img.load()
+            self._imagem = img
+        return self._imagem
+
+    def para_deteccao(self, lado_maximo):
+        '''
+        Retorna a imagem reduzida para que o maior lado não ultrapasse 'lado_maximo' e a escala (x, y) até a resolução original.
+        A redução é feita sobre o buffer já decodificado, primeiro por um fator inteiro (como no draft mode do JPEG) e depois com interpolação.
+        '''
+        img = self.imagem
+
+        if not lado_maximo or max(img.size) <= lado_maximo:
+            return img, np.ones(2, dtype=np.float32)
+
+        if lado_maximo not in self._deteccao:
+            proporcao = lado_maximo / max(img.size)
+            tamanho = (max(1, round(img.width * proporcao)), max(1, round(img.height * proporcao)))
+            reduzida = img.resize(tamanho, resample=Image.BILINEAR, reducing_gap=2.0)
+
+            self._deteccao[lado_maximo] = (reduzida, np.array([img.width / reduzida.width, img.height / reduzida.height], dtype=np.float32))
+
+        return self._deteccao[lado_maximo]
+
+    def recortar_faces(self, boxes):
+        '''
+        Recorta as caixas (N, 4) da imagem em resolução original, redimensionando cada face para 160x160
+        '''
+        face_list = []
+
+        # Check if any face was found
+        if boxes is not None:
+            for box in boxes:
+                cropped_face = self.imagem.crop(box.tolist()).resize(TAMANHO_FACE, resample=Image.BICUBIC)
+                face_list.append(cropped_face)
+
+        return face_list
+
+    def recortar_faces_em_lote(self, boxes):
+        '''
+        Recorta e redimensiona todas as caixas (N, 4) de uma só vez com ROI Align, retornando o tensor (N, 3, 160, 160) com valores
+        entre 0 e 1 pronto para o extrator de características (equivalente a recortar_faces seguido de ToTensor)
+        '''
+        import torch
+        from torchvision.ops import roi_align
+
+        if boxes is None or len(boxes) == 0:
+            return torch.empty((0, 3) + TAMANHO_FACE, dtype=torch.float32)
+
+        # Coordenadas inteiras, como as usadas por Image.crop, e a parte de cada caixa que fica dentro da imagem
+        caixas = np.round(np.asarray(boxes, dtype=np.float64)).astype(np.int64)
+        limites = np.clip(caixas, 0, np.tile(self.imagem.size, 2))
+
+        # Cada face é reduzida para que a caixa inteira caiba em LADO_MAXIMO_REGIAO (o dobro da saída, mantendo 2 amostras por pixel
+        # no ROI Align), então o lote não cresce com o tamanho das faces na foto
+        escalas = np.minimum(1.0, LADO_MAXIMO_REGIAO / np.maximum(caixas[:, 2:] - caixas[:, :2], 1).max(axis=1))
+
+        recortes, rois = [], []
+        for indice, ((x0, y0, x1, y1), escala) in enumerate(zip(limites, escalas)):
+            recorte = None
+            proporcao = np.ones(2)
+
+            if x1 > x0 and y1 > y0:
+                recorte = self.imagem.crop((x0, y0, x1, y1))
+                if escala < 1:
+                    tamanho = (max(1, round((x1 - x0) * escala)), max(1, round((y1 - y0) * escala)))
+                    recorte = recorte.resize(tamanho, resample=Image.BILINEAR, reducing_gap=2.0)
+                    proporcao = np.array(tamanho) / (x1 - x0, y1 - y0)
+
+            recortes.append(recorte)
+            rois.append([indice, *((caixas[indice] - np.tile(limites[indice, :2], 2)) * np.tile(proporcao, 2))])
+
+        # Cada região é copiada (já convertida para float) para uma posição do lote, preenchido com zeros como no Image.crop fora da imagem.
+        # Só os pixels das faces são lidos, sem converter a imagem inteira para array.
+        tamanhos = np.array([recorte.size if recorte is not None else (0, 0) for recorte in recortes])
+        regioes = torch.zeros((len(caixas), 3, int(tamanhos[:, 1].max()) + 1, int(tamanhos[:, 0].max()) + 1), dtype=torch.float32)
+        for indice, recorte in enumerate(recortes):
+            if recorte is not None:
+                regioes[indice, :, :recorte.height, :recorte.width] = torch.from_numpy(np.array(recorte)).permute(2, 0, 1)
+        regioes.div_(255)
+
+        # aligned=True faz as bordas da caixa coincidirem com as bordas dos pixels
+        return roi_align(regioes, torch.tensor(rois, dtype=torch.float32), output_size=TAMANHO_FACE, spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+    def miniatura(self):
+        '''
+        Retorna os bytes da miniatura JPEG 512x256 armazenada junto com a frequência
+        '''
+        if self._miniatura is None:
+            imgByteArr = io.BytesIO()
+            self.imagem.resize(TAMANHO_MINIATURA, resample=Image.BICUBIC, reducing_gap=3.0).save(imgByteArr, format='JPEG')
+            self._miniatura = imgByteArr.getvalue()
+        return self._miniatura
+
+    def definir_miniatura(self, miniatura):
+        self._miniatura = miniatura
@@ -0,0 +1,159 @@
+'''
+Cadastro de alunos em lote fora do servidor, para importações no início do semestre.
+
+Lê a lista de alunos (CSV com as colunas matricula, nome, curso e imagem, com o caminho da foto relativo ao diretório de fotos) e extrai
+os embeddings em todos os núcleos da máquina com o serviço de inferência (core/inferencia.py). A pipeline é a mesma de process_faces nas
+rotas da API, com as configurações do servidor (valores padrão de core/run.py e arquivo ENV_FILE_LOCATION), então os embeddings são
+idênticos aos de um cadastro pelo servidor. As opções de linha de comando substituem as configurações correspondentes.
+
+Os alunos são gravados no banco a cada lote. Uma importação interrompida é retomada executando o mesmo comando, já que as matrículas
+presentes no banco são ignoradas.
+
+Uso (a partir da raiz do repositório):
+    python core/importar_alunos.py <alunos.csv> <diretorio_fotos> [--banco attendance.db] [--processos N] [--lote 256] [--pesos <MODEL_WEIGHTS_DIR>]
+'''
+
+import csv
+import os
+import sys
+from collections import Counter, deque
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from core.models import db, Aluno
+from core.modelos import opcoes_da_configuracao
+from core.utils import CONFIGURACOES_DA_PIPELINE, serializar_embedding
+
+COLUNAS = ('matricula', 'nome', 'curso', 'imagem')
+
+
+def ler_alunos(caminho_csv):
+    with open(caminho_csv, newline='', encoding='utf-8-sig') as arquivo:
+        linhas = list(csv.DictReader(arquivo))
+
+    if linhas and not set(COLUNAS) <= set(linhas[0]):
+        raise ValueError(f"O arquivo '{caminho_csv}' deve conter as colunas {', '.join(COLUNAS)}.")
+
+    return linhas
+
+
+def configuracoes_do_servico(config):
+    '''
+    Opções dos modelos e configurações da pipeline para o serviço de inferência, lidas das configurações da aplicação (as mesmas
+    passadas pelo servidor em create_app)
+    '''
+    return dict(opcoes_modelos=opcoes_da_configuracao(config), configuracoes={chave: config[chave] for chave in CONFIGURACOES_DA_PIPELINE})
+
+
+def importar_alunos(linhas, diretorio_fotos, servico, tamanho_lote=256, em_andamento=None):
+    '''
+    Processa as fotos no serviço de inferência já iniciado e grava os alunos com uma única face na foto, com um commit a cada
+    'tamanho_lote' alunos. Retorna a quantidade de alunos em cada status (os mesmos do cadastro em lote pela API).
+    Deve ser chamada dentro do contexto da aplicação.
+    '''
+    existentes = {matricula for (matricula,) in db.session.query(Aluno.matricula)}
+    contagem = Counter()
+    pendentes = []
+
+    for linha in linhas:
+        if not all(linha.get(coluna) for coluna in COLUNAS):
+            contagem['dados_invalidos'] += 1
+        elif linha['matricula'] in existentes:
+            contagem['matricula_duplicada'] += 1
+        elif not os.path.isfile(os.path.join(diretorio_fotos, linha['imagem'])):
+            contagem['imagem_invalida'] += 1
+        else:
+            existentes.add(linha['matricula'])
+            pendentes.append(linha)
+
+    lote = []
+
+    def gravar():
+        db.session.bulk_insert_mappings(Aluno, lote)
+        db.session.commit()
+        lote.clear()
+
+    def consumir(linha, futuro):
+        try:
+            embeddings, _, _ = futuro.result()
+        except (OSError, ValueError): # Foto que não pôde ser decodificada
+            contagem['imagem_invalida'] += 1
+            return
+
+        if len(embeddings) != 1:
+            contagem['sem_face' if len(embeddings) == 0 else 'varias_faces'] += 1
+            return
+
+        lote.append(dict(matricula=linha['matricula'], nome=linha['nome'], curso=linha['curso'], embedding=serializar_embedding(embeddings)))
+        contagem['ok'] += 1
+
+        if len(lote) >= tamanho_lote:
+            gravar()
+
+    # Quantidade limitada de fotos em processamento, para que a memória não cresça com o tamanho da lista
+    limite = em_andamento or 2 * servico.num_workers
+    futuros = deque()
+
+    for linha in pendentes:
+        with open(os.path.join(diretorio_fotos, linha['imagem']), 'rb') as foto:
+            futuros.append((linha, servico.submeter(foto.read())))
+
+        if len(futuros) >= limite:
+            consumir(*futuros.popleft())
+
+    while futuros:
+        consumir(*futuros.popleft())
+
+    gravar()
+
+    return contagem
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from config import app
+    from run import definir_configuracoes_padrao
+    from core.utils import clear_parser
+    from core.inferencia import servico_inferencia
+
+    parser = argparse.ArgumentParser(description='Cadastra alunos a partir de um CSV e de um diretório de fotos, usando todos os núcleos da máquina.')
+    parser.add_argument('alunos', help='CSV com as colunas matricula, nome, curso e imagem')
+    parser.add_argument('fotos', help='Diretório das fotos')
+    parser.add_argument('--banco', default='attendance.db', help='Arquivo SQLite do banco de dados (caminhos relativos partem da pasta core, como no servidor)')
+    parser.add_argument('--processos', type=int, default=os.cpu_count() or 1, help='Processos de inferência')
+    parser.add_argument('--lote', type=int, default=256, help='Quantidade de alunos gravados por transação')
+    parser.add_argument('--pesos', help='Diretório local dos pesos (substitui MODEL_WEIGHTS_DIR)')
+    parser.add_argument('--torchscript', help='Diretório das redes TorchScript (substitui MODEL_TORCHSCRIPT_DIR)')
+    parser.add_argument('--precisao', choices=['fp32', 'int8'], help='Precisão da rede de extração (substitui EMBEDDING_PRECISION)')
+    parser.add_argument('--calibracao', help='Fotos de calibração da precisão int8 (substitui QUANTIZATION_CALIBRATION_DIR)')
+    parser.add_argument('--lado', type=int, help='Maior lado da imagem usada na detecção (substitui DETECTION_MAX_SIDE)')
+    parser.add_argument('--minimo', type=int, help='Tamanho mínimo de face (substitui DETECTION_MIN_FACE_SIZE)')
+    args = parser.parse_args()
+
+    # Mesmas configurações do servidor, para que os embeddings importados sejam comparáveis aos cadastrados pela API
+    definir_configuracoes_padrao(app)
+    if os.getenv('ENV_FILE_LOCATION'):
+        app.config.from_envvar('ENV_FILE_LOCATION')
+
+    app.config.update(clear_parser(dict(MODEL_WEIGHTS_DIR=args.pesos, MODEL_TORCHSCRIPT_DIR=args.torchscript, EMBEDDING_PRECISION=args.precisao,
+                                        QUANTIZATION_CALIBRATION_DIR=args.calibracao, DETECTION_MAX_SIDE=args.lado,
+                                        DETECTION_MIN_FACE_SIZE=args.minimo)))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{args.banco}'
+
+    db.app = app
+    db.init_app(app)
+
+    # Um processo por núcleo, cada um com uma única thread do torch
+    servico_inferencia.iniciar(args.processos, threads=1, **configuracoes_do_servico(app.config))
+
+    with app.app_context():
+        db.create_all()
+        contagem = importar_alunos(ler_alunos(args.alunos), args.fotos, servico_inferencia, tamanho_lote=args.lote)
+
+    servico_inferencia.encerrar()
+
+    for status, quantidade in sorted(contagem.items()):
+        print(f'{status}: {quantidade}')
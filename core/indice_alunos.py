@@ -0,0 +1,209 @@
+'''
+Índice de busca aproximada (IVF) sobre os embeddings de todos os alunos, usado na identificação de um aluno sem restringir a busca a uma turma.
+
+Os vetores normalizados são divididos em listas pelo k-means esférico; cada busca compara o embedding apenas com os centroides e com os
+vetores das 'nprobe' listas mais próximas. Abaixo de 'tamanho_minimo' vetores o índice tem uma única lista e a busca é exata.
+
+O índice é atualizado de forma incremental pelas rotas de alunos e salvo em disco; outros processos recarregam o arquivo quando ele muda.
+Parte do princípio de que as alterações de alunos não ocorrem em processos diferentes ao mesmo tempo.
+'''
+
+import os
+from threading import Lock
+import numpy as np
+
+from core.embeddings import EMBEDDING_DIM
+
+ITERACOES_KMEANS = 10
+VETORES_POR_LISTA = 64 # Tamanho médio das listas no treinamento
+
+
+class IndiceAlunos:
+    def __init__(self):
+        self._lock = Lock()
+        self.caminho = None
+        self.nprobe = 16
+        self.tamanho_minimo = 2048
+        self._limpar()
+
+    @property
+    def ativo(self):
+        '''
+        Indica se alterações de alunos precisam ser repassadas ao índice (já carregado neste processo ou salvo em disco)
+        '''
+        return self._carregado or bool(self.caminho)
+
+    def __len__(self):
+        return len(self.vetores)
+
+    def configurar(self, caminho=None, nprobe=16, tamanho_minimo=2048):
+        with self._lock:
+            self.caminho = caminho
+            self.nprobe = nprobe
+            self.tamanho_minimo = tamanho_minimo
+            self._limpar()
+
+    def limpar(self):
+        '''
+        Descarta o índice em memória, que será lido do arquivo ou reconstruído na próxima busca
+        '''
+        with self._lock:
+            self._limpar()
+
+    def preparar(self, carregar_do_banco, contar_no_banco):
+        '''
+        Garante que o índice está carregado e atualizado: lê o arquivo salvo quando ele mudou desde a última leitura e, se o índice não
+        tiver a mesma quantidade de vetores que o banco (alunos alterados fora das rotas da API, como na importação offline), reconstrói
+        o índice com carregar_do_banco() (matrículas e matriz normalizada dos vetores)
+        '''
+        with self._lock:
+            self._recarregar(carregar_do_banco)
+
+            if len(self.vetores) != contar_no_banco():
+                self._reconstruir(carregar_do_banco)
+
+    def atualizar(self, remover, matriculas, vetores, carregar_do_banco):
+        '''
+        Remove todos os vetores das matrículas em 'remover' e adiciona os novos vetores normalizados, salvando o índice em seguida.
+        As alterações salvas por outros processos são lidas antes, para não serem sobrescritas.
+        '''
+        with self._lock:
+            self._recarregar(carregar_do_banco)
+
+            if remover:
+                manter = ~np.isin(self.matriculas, list(remover))
+                self.vetores, self.matriculas, self.listas = self.vetores[manter], self.matriculas[manter], self.listas[manter]
+
+            self._adicionar(matriculas, vetores)
+            self._salvar()
+
+    def buscar(self, embedding, k=5):
+        '''
+        Retorna as 'k' matrículas mais similares ao embedding normalizado, cada uma com a maior similaridade entre os seus vetores
+        '''
+        with self._lock:
+            if len(self.vetores) == 0:
+                return []
+
+            # Listas cujos centroides são os mais próximos do embedding
+            proximas = np.argsort(-(self.centroides @ embedding))[:self.nprobe]
+            candidatos = np.concatenate([self._ordem[self._limites[lista]:self._limites[lista + 1]] for lista in proximas])
+
+            similaridades = self.vetores[candidatos] @ embedding
+            matriculas, posicoes = np.unique(self.matriculas[candidatos], return_inverse=True)
+
+            # Maior similaridade de cada matrícula entre os seus vetores candidatos (cadastro e templates)
+            melhores = np.full(len(matriculas), -np.inf, dtype=np.float32)
+            np.maximum.at(melhores, posicoes, similaridades)
+
+            ordem = np.argsort(-melhores, kind='stable')[:k]
+            return [(str(matriculas[indice]), float(melhores[indice])) for indice in ordem]
+
+    def _recarregar(self, carregar_do_banco):
+        modificacao = self._modificacao_do_arquivo()
+
+        if self._carregado and modificacao == self._modificacao:
+            return
+
+        if modificacao is not None and self._ler():
+            self._modificacao = modificacao
+            return
+
+        self._reconstruir(carregar_do_banco)
+
+    def _reconstruir(self, carregar_do_banco):
+        self._limpar()
+        self._adicionar(*carregar_do_banco())
+        self._carregado = True
+        self._salvar()
+
+    def _limpar(self):
+        self._carregado = False
+        self._modificacao = None
+        self.centroides = np.zeros((1, EMBEDDING_DIM), dtype=np.float32)
+        self.vetores = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        self.matriculas = np.empty(0, dtype=str)
+        self.listas = np.empty(0, dtype=np.int64)
+        self.tamanho_treino = 0
+        self._organizar()
+
+    def _adicionar(self, matriculas, vetores):
+        if len(matriculas) > 0:
+            vetores = np.asarray(vetores, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+
+            self.vetores = np.concatenate([self.vetores, vetores])
+            self.matriculas = np.concatenate([self.matriculas, np.asarray(matriculas, dtype=str)])
+            self.listas = np.concatenate([self.listas, np.argmax(vetores @ self.centroides.T, axis=1)])
+
+        # O índice é treinado de novo quando atinge o tamanho mínimo e sempre que dobra de tamanho desde o último treinamento
+        if len(self.vetores) >= max(self.tamanho_minimo, 2 * self.tamanho_treino):
+            self._treinar()
+
+        self._organizar()
+
+    def _treinar(self):
+        '''
+        K-means esférico sobre os vetores atuais, com cerca de VETORES_POR_LISTA vetores por lista
+        '''
+        quantidade_listas = max(1, len(self.vetores) // VETORES_POR_LISTA)
+        aleatorio = np.random.default_rng(0)
+
+        centroides = self.vetores[aleatorio.choice(len(self.vetores), quantidade_listas, replace=False)]
+
+        for _ in range(ITERACOES_KMEANS):
+            listas = np.argmax(self.vetores @ centroides.T, axis=1)
+
+            somas = np.zeros_like(centroides)
+            np.add.at(somas, listas, self.vetores)
+
+            # Listas que ficaram vazias mantêm o centroide anterior
+            normas = np.linalg.norm(somas, axis=1, keepdims=True)
+            centroides = np.where(normas > 0, somas / np.maximum(normas, np.finfo(np.float32).eps), centroides)
+
+        self.centroides = np.ascontiguousarray(centroides, dtype=np.float32)
+        self.listas = np.argmax(self.vetores @ self.centroides.T, axis=1)
+        self.tamanho_treino = len(self.vetores)
+
+    def _organizar(self):
+        # Posições dos vetores ordenadas por lista e o início de cada lista nessa ordem
+        self._ordem = np.argsort(self.listas, kind='stable')
+        self._limites = np.searchsorted(self.listas[self._ordem], np.arange(len(self.centroides) + 1))
+
+    def _modificacao_do_arquivo(self):
+        if not self.caminho or not os.path.exists(self.caminho):
+            return None
+        return os.stat(self.caminho).st_mtime_ns
+
+    def _ler(self):
+        try:
+            with np.load(self.caminho) as arquivo:
+                if arquivo['vetores'].shape[1:] != (EMBEDDING_DIM,):
+                    return False
+
+                self.centroides = arquivo['centroides']
+                self.vetores = arquivo['vetores']
+                self.matriculas = arquivo['matriculas']
+                self.listas = arquivo['listas']
+                self.tamanho_treino = int(arquivo['tamanho_treino'])
+        except (OSError, KeyError, ValueError): # Arquivo corrompido ou de outro formato é reconstruído
+            return False
+
+        self._organizar()
+        self._carregado = True
+        return True
+
+    def _salvar(self):
+        if not self.caminho:
+            return
+
+        # Escrita em arquivo temporário seguida de troca atômica, para que outros processos nunca leiam um arquivo incompleto
+        temporario = f'{self.caminho}.{os.getpid()}.tmp'
+        with open(temporario, 'wb') as arquivo:
+            np.savez(arquivo, centroides=self.centroides, vetores=self.vetores, matriculas=self.matriculas,
+                     listas=self.listas, tamanho_treino=self.tamanho_treino)
+        os.replace(temporario, self.caminho)
+
+        self._modificacao = self._modificacao_do_arquivo()
+
+
+indice_alunos = IndiceAlunos()
@@ -0,0 +1,149 @@
+'''
+Serviço de inferência com um conjunto de processos dedicados, cada um com a sua própria cópia das redes de reconhecimento facial.
+
+As requisições do Flask apenas submetem as imagens para a fila do serviço e aguardam o resultado, de forma que o número de
+cópias das redes e de threads do torch em uso na máquina não cresce com a quantidade de requisições simultâneas.
+'''
+
+import atexit
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+
+def _inicializar_worker(threads, opcoes_modelos, configuracoes):
+    import torch
+    from core.modelos import modelos
+    from core.utils import definir_configuracoes
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError: # Só pode ser definido antes de qualquer operação paralela
+        pass
+
+    definir_configuracoes(configuracoes)
+
+    modelos.configurar(**opcoes_modelos)
+    modelos.aquecer()
+
+
+def _processar_imagem(img_bytes, gerar_miniatura):
+    from core.imagem import ImagemProcessada
+    from core.utils import extrair_faces_localmente
+
+    imagem = ImagemProcessada(img_bytes)
+    embeddings, caixas = extrair_faces_localmente(imagem)
+    return embeddings, caixas, (imagem.miniatura() if gerar_miniatura else None)
+
+
+def _detectar_e_recortar(img_bytes, gerar_miniatura):
+    from core.imagem import ImagemProcessada
+    from core.utils import detectar_caixas, caixas_detectadas
+
+    imagem = ImagemProcessada(img_bytes)
+    caixas = caixas_detectadas(detectar_caixas(imagem))
+    return imagem.recortar_faces_em_lote(caixas), caixas, (imagem.miniatura() if gerar_miniatura else None)
+
+
+def _detectar_tiles(tiles):
+    from core.utils import detectar_lote_de_tiles
+    return detectar_lote_de_tiles(tiles)
+
+
+def _extrair_caracteristicas(faces):
+    from core.utils import get_face_features
+    return get_face_features(faces)
+
+
+def limitar_workers(num_workers):
+    '''
+    Quantidade de processos limitada ao número de núcleos da máquina, já que cada processo usa ao menos uma thread do torch
+    '''
+    nucleos = os.cpu_count() or 1
+
+    if num_workers > nucleos:
+        logging.getLogger(__name__).warning('INFERENCE_WORKERS (%d) é maior que o número de núcleos da máquina; usando %d processos.',
+                                            num_workers, nucleos)
+        return nucleos
+
+    return num_workers
+
+
+def threads_por_worker(num_workers, threads=None):
+    '''
+    Quantidade de threads do torch por processo, limitada para que o total não ultrapasse o número de núcleos da máquina
+    '''
+    limite = max(1, (os.cpu_count() or 1) // num_workers)
+    return limite if threads is None else max(1, min(threads, limite))
+
+
+class ServicoInferencia:
+    def __init__(self):
+        self._executor = None
+        self._num_workers = 0
+        self._lock = Lock()
+
+    @property
+    def ativo(self):
+        return self._executor is not None
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    def iniciar(self, num_workers, threads=None, opcoes_modelos=None, configuracoes=None):
+        '''
+        Inicia os processos de inferência. 'opcoes_modelos' segue o formato de ModelosReconhecimento.configurar e 'configuracoes'
+        contém as configurações da aplicação usadas pela pipeline (ver utils.CONFIGURACOES_DA_PIPELINE).
+        '''
+        with self._lock:
+            if self._executor is not None:
+                return
+
+            num_workers = limitar_workers(num_workers)
+
+            # 'spawn' evita herdar o estado do torch e do Flask do processo principal
+            self._executor = ProcessPoolExecutor(max_workers=num_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_inicializar_worker,
+                                                 initargs=(threads_por_worker(num_workers, threads), opcoes_modelos or {}, configuracoes or {}))
+            self._num_workers = num_workers
+
+    def submeter(self, img_bytes, gerar_miniatura=False):
+        '''
+        Envia a imagem para detecção e extração de características, retornando um Future com o array (N, 512) de embeddings,
+        as caixas (N, 4) das faces e os bytes da miniatura da imagem (None quando 'gerar_miniatura' for falso)
+        '''
+        return self._executor.submit(_processar_imagem, img_bytes, gerar_miniatura)
+
+    def submeter_deteccao(self, img_bytes, gerar_miniatura=False):
+        '''
+        Envia a imagem apenas para detecção e recorte, retornando um Future com o tensor (N, 3, 160, 160) das faces, as caixas e a miniatura
+        '''
+        return self._executor.submit(_detectar_e_recortar, img_bytes, gerar_miniatura)
+
+    def submeter_tiles(self, tiles):
+        '''
+        Envia um lote de tiles (N, H, W, 3) para detecção, retornando um Future com as caixas de cada tile
+        '''
+        return self._executor.submit(_detectar_tiles, tiles)
+
+    def submeter_faces(self, faces):
+        '''
+        Envia as faces já recortadas (tensor (N, 3, 160, 160)) para extração de características, retornando um Future com o array (N, 512) de embeddings
+        '''
+        return self._executor.submit(_extrair_caracteristicas, faces)
+
+    def encerrar(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+                self._num_workers = 0
+
+
+servico_inferencia = ServicoInferencia()
+atexit.register(servico_inferencia.encerrar)
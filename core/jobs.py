@@ -0,0 +1,200 @@
+'''
+Execução em segundo plano dos registros de frequência enviados no modo assíncrono.
+
+Cada job é persistido na tabela 'job_frequencia' junto com as imagens enviadas (tabela 'imagem_job_frequencia'), então
+jobs que ainda não terminaram quando um processo do servidor foi encerrado são retomados por outro processo ou na próxima
+inicialização.
+
+Cada processo do servidor é registrado como dono dos jobs que enfileira ou retoma e renova periodicamente o heartbeat deles.
+Um job só é retomado por outro processo quando o seu dono não existe mais (verificável apenas no mesmo host) ou quando o
+heartbeat não é renovado dentro do prazo do lease. A execução só começa com um UPDATE condicional (status 'queued' e dono
+igual ao processo), então o mesmo job nunca é executado por dois processos.
+'''
+
+import logging
+import os
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from sqlalchemy import inspect
+from werkzeug.exceptions import HTTPException
+from core.models import db, JobFrequencia, ImagemJobFrequencia
+
+PENDENTES = ('queued', 'running')
+
+
+def identificador_do_processo():
+    # O sufixo diferencia processos que reutilizam o pid de um processo já encerrado
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def igual_ou_nulo(coluna, valor):
+    return coluna.is_(None) if valor is None else coluna == valor
+
+
+def dono_encerrado(dono, identificador):
+    '''
+    Indica se o processo 'dono' (gerado por identificador_do_processo) terminou, do ponto de vista do processo 'identificador'.
+    Processos de outros hosts dependem apenas do prazo do lease.
+    '''
+    try:
+        host, pid, _ = dono.rsplit(':', 2)
+        pid = int(pid)
+    except (AttributeError, ValueError): # Registros sem dono (criados antes dessa coluna) ou com identificador inválido
+        return True
+
+    if host != socket.gethostname() or os.name != 'posix':
+        return False
+
+    # Mesmo pid com outro sufixo é uma execução anterior deste processo
+    if pid == os.getpid():
+        return dono != identificador
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError: # Processo existe, mas pertence a outro usuário
+        return False
+
+    return False
+
+
+class ExecutorDeJobs:
+    def __init__(self):
+        self._app = None
+        self._executor = None
+        self._manutencao = None
+        self._parar = Event()
+        self.identificador = None
+        self.validade_lease = 60
+
+    @property
+    def ativo(self):
+        return self._executor is not None
+
+    def iniciar(self, app, num_threads=1, validade_lease=60):
+        if self._executor is not None:
+            return
+
+        self._app = app
+        self.validade_lease = validade_lease
+        self.identificador = identificador_do_processo()
+        self._executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='job-frequencia')
+        self.retomar_pendentes()
+
+        # Renovação dos leases deste processo e retomada periódica dos jobs abandonados por outros processos
+        self._parar.clear()
+        self._manutencao = Thread(target=self._manter, name='job-frequencia-lease', daemon=True)
+        self._manutencao.start()
+
+    def encerrar(self):
+        if self._executor is None:
+            return
+
+        self._parar.set()
+        self._manutencao.join()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def enfileirar(self, turma_codigo, imagens):
+        '''
+        Persiste um novo job com as imagens enviadas e o coloca na fila de execução, retornando o seu ID
+        '''
+        job = JobFrequencia(turma_codigo=turma_codigo, status='queued', dono=self.identificador, heartbeat=datetime.utcnow(),
+                            imagens=[ImagemJobFrequencia(imagem_turma=img_bytes) for img_bytes in imagens])
+        db.session.add(job)
+        db.session.commit()
+
+        self._executor.submit(self._executar, job.id)
+        return job.id
+
+    def retomar_pendentes(self):
+        '''
+        Assume os jobs pendentes cujo dono foi encerrado ou deixou o lease expirar e os coloca na fila deste processo
+        '''
+        with self._app.app_context():
+            try:
+                # Bancos criados antes da existência da tabela de jobs não têm nada a retomar
+                if JobFrequencia.__tablename__ not in inspect(db.engine).get_table_names():
+                    return
+
+                limite = datetime.utcnow() - timedelta(seconds=self.validade_lease)
+                candidatos = db.session.query(JobFrequencia.id, JobFrequencia.dono, JobFrequencia.heartbeat)\
+                                       .filter(JobFrequencia.status.in_(PENDENTES))\
+                                       .filter(db.or_(JobFrequencia.dono.is_(None), JobFrequencia.dono != self.identificador)).all()
+
+                retomados = []
+                for job_id, dono, heartbeat in candidatos:
+                    if heartbeat is not None and heartbeat >= limite and not dono_encerrado(dono, self.identificador):
+                        continue
+
+                    # Condicional ao dono e ao heartbeat lidos, para que só um processo assuma o job e nunca um job cujo dono acabou de renovar o lease
+                    assumido = JobFrequencia.query.filter(JobFrequencia.id == job_id, JobFrequencia.status.in_(PENDENTES),
+                                                          igual_ou_nulo(JobFrequencia.dono, dono), igual_ou_nulo(JobFrequencia.heartbeat, heartbeat))\
+                                                  .update(dict(status='queued', dono=self.identificador, heartbeat=datetime.utcnow()),
+                                                          synchronize_session=False)
+                    db.session.commit()
+
+                    if assumido:
+                        retomados.append(job_id)
+
+                for job_id in retomados:
+                    self._executor.submit(self._executar, job_id)
+            finally:
+                db.session.remove()
+
+    def _manter(self):
+        while not self._parar.wait(self.validade_lease / 3):
+            try:
+                self._renovar_leases()
+                self.retomar_pendentes()
+            except Exception: # Falhas temporárias do banco são tentadas de novo no próximo ciclo
+                logging.getLogger(__name__).exception('Falha na renovação dos leases dos jobs de frequência.')
+
+    def _renovar_leases(self):
+        with self._app.app_context():
+            try:
+                # O timestamp do job não muda com a renovação do lease
+                JobFrequencia.query.filter(JobFrequencia.dono == self.identificador, JobFrequencia.status.in_(PENDENTES))\
+                                   .update(dict(heartbeat=datetime.utcnow(), timestamp=JobFrequencia.timestamp), synchronize_session=False)
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+    def _executar(self, job_id):
+        from core.utils import registrar_frequencia
+
+        with self._app.app_context():
+            try:
+                # Só executa o job se ele ainda estiver na fila deste processo (evita execução duplicada)
+                if JobFrequencia.query.filter_by(id=job_id, status='queued', dono=self.identificador)\
+                                      .update(dict(status='running', heartbeat=datetime.utcnow())) == 0:
+                    db.session.commit()
+                    return
+                db.session.commit()
+
+                job = JobFrequencia.query.get(job_id)
+
+                try:
+                    frequencia_id = registrar_frequencia(job.turma_codigo, [imagem.imagem_turma for imagem in job.imagens])
+                    job = JobFrequencia.query.get(job_id)
+                    job.status, job.frequencia_id = 'done', frequencia_id
+                except HTTPException as erro:
+                    db.session.rollback()
+                    job = JobFrequencia.query.get(job_id)
+                    job.status, job.erro = 'failed', erro.description
+                except Exception as erro:
+                    db.session.rollback()
+                    job = JobFrequencia.query.get(job_id)
+                    job.status, job.erro = 'failed', str(erro)[:256]
+
+                ImagemJobFrequencia.query.filter_by(job_id=job_id).delete()
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+
+executor_de_jobs = ExecutorDeJobs()
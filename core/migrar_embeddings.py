@@ -0,0 +1,97 @@
+'''
+Converte os embeddings dos alunos salvos com np.save (ou no formato compacto com outra precisão) para o formato compacto definido
+em embeddings.py, com a precisão escolhida, e adiciona aos bancos antigos as tabelas e colunas criadas depois deles.
+
+Uso (a partir da pasta core):
+    python migrar_embeddings.py [--banco attendance.db] [--lote 500] [--float16]
+'''
+
+import argparse
+from sqlalchemy import inspect
+from config import app, db
+from models import Aluno, Presenca, JobFrequencia, Turma, RequisicaoIdempotente
+from embeddings import codificar_embedding, decodificar_embedding, formato_compacto
+
+
+# Colunas adicionadas a tabelas já existentes: (tabela, coluna, tipo SQL)
+COLUNAS_NOVAS = [(Presenca.__tablename__, 'similaridade', 'FLOAT'),
+                 (JobFrequencia.__tablename__, 'dono', 'VARCHAR(128)'),
+                 (JobFrequencia.__tablename__, 'heartbeat', 'DATETIME'),
+                 (Turma.__tablename__, 'versao_galeria', 'INTEGER NOT NULL DEFAULT 0'),
+                 (RequisicaoIdempotente.__tablename__, 'dono', 'VARCHAR(128)'),
+                 (RequisicaoIdempotente.__tablename__, 'heartbeat', 'DATETIME')]
+
+
+def atualizar_esquema():
+    '''
+    Cria as tabelas que ainda não existem e adiciona as colunas novas às tabelas existentes, retornando as colunas adicionadas
+    '''
+    db.create_all()
+
+    inspetor = inspect(db.engine)
+    adicionadas = []
+
+    for tabela, coluna, tipo in COLUNAS_NOVAS:
+        if coluna not in [existente['name'] for existente in inspetor.get_columns(tabela)]:
+            db.session.execute(f'ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}')
+            adicionadas.append(f'{tabela}.{coluna}')
+
+    db.session.commit()
+    return adicionadas
+
+
+def migrar_embeddings(tamanho_lote=500, dtype='float32'):
+    '''
+    Converte para o formato compacto com a precisão 'dtype' os embeddings em formato antigo ou armazenados com outra precisão
+    '''
+    tabela_aluno = Aluno.__table__
+    convertidos = 0
+    ultima_matricula = ''
+
+    while True:
+        # Paginação pela chave primária para não carregar a tabela inteira em memória
+        lote = db.session.execute(db.select([tabela_aluno.c.matricula, tabela_aluno.c.embedding])
+                                    .where(tabela_aluno.c.matricula > ultima_matricula)
+                                    .order_by(tabela_aluno.c.matricula)
+                                    .limit(tamanho_lote)).fetchall()
+
+        if not lote:
+            break
+
+        ultima_matricula = lote[-1].matricula
+
+        atualizacoes = [{'_matricula': aluno.matricula, 'embedding': codificar_embedding(decodificar_embedding(aluno.embedding), dtype=dtype)}
+                        for aluno in lote if aluno.embedding is not None and not formato_compacto(aluno.embedding, dtype)]
+
+        if atualizacoes:
+            db.session.execute(tabela_aluno.update()
+                                           .where(tabela_aluno.c.matricula == db.bindparam('_matricula'))
+                                           .values(embedding=db.bindparam('embedding')),
+                               atualizacoes)
+            db.session.commit()
+            convertidos += len(atualizacoes)
+
+    return convertidos
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Migra os embeddings dos alunos para o formato compacto.')
+    parser.add_argument('--banco', default='attendance.db', help='Arquivo SQLite do banco de dados')
+    parser.add_argument('--lote', type=int, default=500, help='Quantidade de alunos convertidos por transação')
+    parser.add_argument('--float16', action='store_true', help='Armazena os embeddings em float16')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{args.banco}'
+
+    db.app = app
+    db.init_app(app)
+
+    with app.app_context():
+        adicionadas = atualizar_esquema()
+        convertidos = migrar_embeddings(tamanho_lote=args.lote, dtype='float16' if args.float16 else 'float32')
+
+    if adicionadas:
+        print(f"Colunas adicionadas: {', '.join(adicionadas)}.")
+    print(f'{convertidos} embeddings convertidos para o formato compacto.')
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+PRECISOES = ('fp32', 'int8')
+LADO_MAXIMO_CALIBRACAO = 1024
+
+
+class ModelosReconhecimento:
+    '''
+    Mantém as redes de detecção (MTCNN) e de extração de características (InceptionResnetV1), carregadas somente no primeiro uso.
+    O torch só é importado nesse momento, então processos que atendem apenas rotas de cadastro não pagam esse custo.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._carregado = False
+        self.diretorio_pesos = None
+        self.verificar_pesos = True
+        self.precisao = 'fp32'
+        self.diretorio_torchscript = None
+        self.tamanho_minimo_face = 20
+        self.diretorio_calibracao = None
+        self.device = None
+        self.face_detector = None
+        self.feature_extractor = None
+
+    @property
+    def carregado(self):
+        return self._carregado
+
+    def configurar(self, diretorio_pesos=None, verificar_pesos=True, precisao='fp32', diretorio_torchscript=None, tamanho_minimo_face=20,
+                   diretorio_calibracao=None):
+        '''
+        Define de onde os pesos serão lidos (sem diretório, os pesos da InceptionResnetV1 são baixados para o cache do torch)
+        e a precisão da rede de extração de características: 'fp32' ou 'int8' (quantização estática, somente em CPU, calibrada com
+        as faces das imagens de 'diretorio_calibracao', obrigatório exceto para redes TorchScript já exportadas em int8).
+        Com um diretório TorchScript (gerado por core/torchscript.py) as redes congeladas são usadas no lugar dos módulos Python.
+        'tamanho_minimo_face' é o menor lado de face (em pixels da imagem entregue ao detector) procurado pela MTCNN.
+        '''
+        if precisao not in PRECISOES:
+            raise ValueError(f"Precisão de inferência inválida: '{precisao}'.")
+
+        if precisao == 'int8' and not diretorio_torchscript and not diretorio_calibracao:
+            raise ValueError("A precisão 'int8' exige um diretório de fotos para a calibração da quantização (QUANTIZATION_CALIBRATION_DIR).")
+
+        self.diretorio_pesos = diretorio_pesos
+        self.verificar_pesos = verificar_pesos
+        self.precisao = precisao
+        self.diretorio_torchscript = diretorio_torchscript
+        self.tamanho_minimo_face = tamanho_minimo_face
+        self.diretorio_calibracao = diretorio_calibracao
+
+    def opcoes(self):
+        '''
+        Configuração atual, no formato aceito por configurar (usada para replicar a configuração nos processos de inferência)
+        '''
+        return dict(diretorio_pesos=self.diretorio_pesos, verificar_pesos=self.verificar_pesos,
+                    precisao=self.precisao, diretorio_torchscript=self.diretorio_torchscript,
+                    tamanho_minimo_face=self.tamanho_minimo_face, diretorio_calibracao=self.diretorio_calibracao)
+
+    def versao(self, configuracoes=None):
+        '''
+        Identificador da pipeline de reconhecimento: muda quando os pesos, a precisão (e as imagens de calibração da int8), o tamanho
+        mínimo de face ou as configurações de detecção informadas mudam (usado na chave do cache de resultados)
+        '''
+        if self.diretorio_torchscript:
+            from core.torchscript import REDES
+            arquivos = [os.path.join(self.diretorio_torchscript, f'{nome}.pt') for nome in REDES]
+            pesos = [(os.path.basename(arquivo), os.path.getsize(arquivo), os.path.getmtime(arquivo)) for arquivo in arquivos]
+        elif self.diretorio_pesos:
+            from core.pesos import ler_manifesto
+            pesos = {nome: rede['sha256'] for nome, rede in ler_manifesto(self.diretorio_pesos).items()}
+        else:
+            pesos = 'vggface2'
+
+        identificacao = dict(pesos=pesos, precisao=self.precisao, tamanho_minimo_face=self.tamanho_minimo_face,
+                             configuracoes=configuracoes or {})
+        if self.precisao == 'int8' and not self.diretorio_torchscript:
+            identificacao['calibracao'] = sorted(os.listdir(self.diretorio_calibracao))
+        return hashlib.sha256(json.dumps(identificacao, sort_keys=True).encode()).hexdigest()
+
+    def carregar(self):
+        '''
+        Carrega os modelos caso ainda não tenham sido carregados (seguro para chamadas concorrentes) e retorna a própria instância
+        '''
+        if self._carregado:
+            return self
+
+        with self._lock:
+            if not self._carregado:
+                import torch
+                from facenet_pytorch import MTCNN, InceptionResnetV1
+
+                if torch.cuda.is_available():
+                    self.device = torch.device('cuda')
+                else:
+                    self.device = torch.device('cpu')
+
+                if self.diretorio_torchscript:
+                    self.face_detector, self.feature_extractor = self._carregar_torchscript(MTCNN)
+                elif self.diretorio_pesos:
+                    self.face_detector, self.feature_extractor = self._carregar_do_diretorio(MTCNN, InceptionResnetV1)
+                else:
+                    self.face_detector = MTCNN(keep_all=True, min_face_size=self.tamanho_minimo_face, device=self.device)
+                    self.feature_extractor = InceptionResnetV1(pretrained='vggface2', device=self.device).eval()
+
+                # Modelos TorchScript já são exportados na precisão configurada
+                if self.precisao == 'int8' and not self.diretorio_torchscript:
+                    self.feature_extractor = quantizar(self.feature_extractor, self._faces_de_calibracao())
+
+                self._carregado = True
+
+        return self
+
+    def aquecer(self):
+        '''
+        Executa uma inferência sintética para que a primeira requisição não pague o custo de inicialização das redes
+        '''
+        import torch
+        from PIL import Image
+
+        self.carregar()
+
+        with torch.no_grad():
+            self.face_detector.detect(Image.new('RGB', (320, 240)))
+            self.feature_extractor(torch.zeros(2, 3, 160, 160, device=self.device))
+
+    def _faces_de_calibracao(self):
+        '''
+        Faces detectadas nas imagens do diretório de calibração, no formato de entrada do extrator de características (N, 3, 160, 160)
+        '''
+        import numpy as np
+        import torch
+        from core.imagem import ImagemProcessada
+
+        faces = []
+
+        for arquivo in sorted(os.listdir(self.diretorio_calibracao)):
+            try:
+                with open(os.path.join(self.diretorio_calibracao, arquivo), 'rb') as imagem_arquivo:
+                    imagem = ImagemProcessada(imagem_arquivo.read())
+                img_deteccao, escala = imagem.para_deteccao(LADO_MAXIMO_CALIBRACAO)
+            except OSError: # Subdiretórios e arquivos que não são imagens
+                continue
+
+            with torch.no_grad():
+                caixas, _ = self.face_detector.detect(img_deteccao)
+
+            if caixas is not None:
+                faces.append(imagem.recortar_faces_em_lote(caixas * np.tile(escala, 2)))
+
+        if not faces:
+            raise ValueError(f"Nenhuma face encontrada nas imagens de calibração da quantização int8 em '{self.diretorio_calibracao}'.")
+
+        return torch.cat(faces)
+
+    def _carregar_torchscript(self, MTCNN):
+        from core.torchscript import carregar_torchscript
+
+        redes = carregar_torchscript(self.diretorio_torchscript, self.precisao, self.device)
+
+        face_detector = MTCNN(keep_all=True, min_face_size=self.tamanho_minimo_face, device=self.device)
+        face_detector.pnet, face_detector.rnet, face_detector.onet = redes['pnet'], redes['rnet'], redes['onet']
+
+        return face_detector, redes['inception_resnet_v1']
+
+    def _carregar_do_diretorio(self, MTCNN, InceptionResnetV1):
+        from core.pesos import ler_manifesto, verificar_pesos, carregar_pesos
+
+        if self.verificar_pesos:
+            verificar_pesos(self.diretorio_pesos)
+
+        manifesto = ler_manifesto(self.diretorio_pesos)
+
+        face_detector = MTCNN(keep_all=True, min_face_size=self.tamanho_minimo_face)
+        for nome in ('pnet', 'rnet', 'onet'):
+            carregar_pesos(self.diretorio_pesos, nome, getattr(face_detector, nome), manifesto)
+
+        feature_extractor = carregar_pesos(self.diretorio_pesos, 'inception_resnet_v1', InceptionResnetV1(pretrained=None), manifesto)
+
+        # Na CPU os tensores continuam mapeados do arquivo; em GPU são copiados para a memória do dispositivo
+        face_detector.device = self.device
+        return face_detector.to(self.device).eval(), feature_extractor.to(self.device).eval()
+
+
+def quantizar(feature_extractor, faces):
+    '''
+    Quantização estática int8 (pós-treinamento) das camadas convolucionais em modo eager (ver core/rede_quantizavel.py): cada
+    Conv2d é fundida com a batch normalization e a ReLU seguintes e os observadores são calibrados com as faces (N, 3, 160, 160)
+    informadas, antes da conversão para os kernels int8 do backend de quantização da CPU (fbgemm/x86 ou qnnpack em ARM).
+
+    Os pesos int8 são tensores novos, alocados em cada processo: o mapeamento dos pesos fp32 do arquivo (ver core/pesos.py) deixa
+    de ser compartilhado entre os processos de inferência, mas a rede quantizada ocupa cerca de 1/4 da memória da rede fp32.
+    Exportar a rede quantizada para TorchScript (core/torchscript.py) evita repetir a calibração na inicialização de cada processo.
+    '''
+    import torch
+    from core.rede_quantizavel import quantizar_rede
+
+    if feature_extractor.device.type != 'cpu':
+        raise ValueError("A precisão 'int8' só está disponível para inferência em CPU.")
+
+    backend = torch.backends.quantized.engine
+    if backend not in torch.backends.quantized.supported_engines or backend == 'none':
+        raise ValueError(f"A precisão 'int8' não está disponível nesta CPU (backend de quantização '{backend}').")
+
+    return quantizar_rede(feature_extractor, faces, backend)
+
+
+modelos = ModelosReconhecimento()
+
+
+def aquecer_modelos():
+    '''
+    Carregamento explícito dos modelos seguido de uma inferência sintética (ex.: na inicialização do servidor), evitando que a primeira requisição pague esse custo
+    '''
+    modelos.aquecer()
+
+
+def opcoes_da_configuracao(config):
+    '''
+    Opções de configurar a partir das configurações da aplicação Flask (MODEL_WEIGHTS_DIR, EMBEDDING_PRECISION, DETECTION_MIN_FACE_SIZE, ...)
+    '''
+    return dict(diretorio_pesos=config['MODEL_WEIGHTS_DIR'], verificar_pesos=config['MODEL_WEIGHTS_VERIFY'],
+                precisao=config['EMBEDDING_PRECISION'], diretorio_torchscript=config['MODEL_TORCHSCRIPT_DIR'],
+                tamanho_minimo_face=config['DETECTION_MIN_FACE_SIZE'], diretorio_calibracao=config['QUANTIZATION_CALIBRATION_DIR'])
@@ -20,6 +20,24 @@ class Aluno(db.Model):
     curso = db.Column(db.String(40), nullable=False)
     embedding = db.Column(db.LargeBinary(), nullable=True)
     disciplinas = db.relationship('Participante', backref='aluno', passive_deletes=True)
+    templates = db.relationship('AlunoTemplate', backref='aluno', passive_deletes=True, lazy=True)
+
+
+class AlunoTemplate(db.Model):
+    __tablename__ = 'aluno_template'
+    id = db.Column(db.Integer, primary_key=True)
+    matricula = db.Column(db.String(10), db.ForeignKey('aluno.matricula', onupdate='CASCADE', ondelete='CASCADE'), nullable=False, index=True)
+    embedding = db.Column(db.LargeBinary(), nullable=False) # Embedding adicional ao do cadastro, no formato compacto definido em embeddings.py
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SuspeitaDuplicidade(db.Model):
+    __tablename__ = 'suspeita_duplicidade'
+    id = db.Column(db.Integer, primary_key=True)
+    matricula = db.Column(db.String(10), db.ForeignKey('aluno.matricula', onupdate='CASCADE', ondelete='CASCADE'), nullable=False, index=True)
+    matricula_semelhante = db.Column(db.String(10), db.ForeignKey('aluno.matricula', onupdate='CASCADE', ondelete='CASCADE'), nullable=False, index=True)
+    similaridade = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class Turma(db.Model):
@@ -28,6 +46,7 @@ class Turma(db.Model):
     codigo = db.Column(db.String(10), unique=True, nullable=False, primary_key=True)
     semestre = db.Column(db.String(10), nullable=False, primary_key=True)
     professor_id = db.Column(db.Integer, db.ForeignKey('professor.id', ondelete='SET NULL'), nullable=True)
+    versao_galeria = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Incrementada a cada alteração dos embeddings dos participantes (ver core/galeria.py)
     frequencias = db.relationship('Frequencia', backref='turma', passive_deletes=True)
     participante = db.relationship('Participante', backref='turma', passive_deletes=True)   
 
@@ -42,6 +61,7 @@ class Frequencia(db.Model):
     imagem_turma = db.Column(db.LargeBinary(), nullable=True)
     presenca = db.relationship('Presenca', backref='frequencia', passive_deletes=True, lazy=True)
     erros = db.relationship('AnotacaoErros', backref='frequencia', passive_deletes=True, lazy=True)
+    faces = db.relationship('FaceFrequencia', backref='frequencia', passive_deletes=True, lazy=True)
 
 
 class Participante(db.Model):
@@ -58,6 +78,7 @@ class Presenca(db.Model):
     frequencia_id = db.Column(db.Integer, db.ForeignKey('frequencia.id', ondelete='CASCADE'))
     participante_id = db.Column(db.Integer, db.ForeignKey('participante.id', ondelete='CASCADE'))
     status = db.Column(db.Boolean, default=True)
+    similaridade = db.Column(db.Float, nullable=True) # Maior similaridade entre o participante e as faces da frequência
 
 
 class AnotacaoErros(db.Model):
@@ -68,6 +89,53 @@ class AnotacaoErros(db.Model):
     falsos_negativos = db.Column(db.Integer, nullable=False)
     
 
+class FaceFrequencia(db.Model):
+    __tablename__ = 'face_frequencia'
+    id = db.Column(db.Integer, primary_key=True)
+    frequencia_id = db.Column(db.Integer, db.ForeignKey('frequencia.id', ondelete='CASCADE'), nullable=False, index=True)
+    imagem = db.Column(db.Integer, nullable=False, default=0) # Índice da foto da frequência em que a face foi detectada
+    x1 = db.Column(db.Float, nullable=False)
+    y1 = db.Column(db.Float, nullable=False)
+    x2 = db.Column(db.Float, nullable=False)
+    y2 = db.Column(db.Float, nullable=False)
+    embedding = db.Column(db.LargeBinary(), nullable=False) # Formato compacto definido em embeddings.py
+
+
+class JobFrequencia(db.Model):
+    __tablename__ = 'job_frequencia'
+    id = db.Column(db.Integer, primary_key=True)
+    turma_codigo = db.Column(db.String(10), db.ForeignKey('turma.codigo', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued') # queued, running, done ou failed
+    frequencia_id = db.Column(db.Integer, db.ForeignKey('frequencia.id', ondelete='SET NULL'), nullable=True)
+    erro = db.Column(db.String(256), nullable=True)
+    dono = db.Column(db.String(128), nullable=True) # Processo do servidor responsável pelo job (host:pid:sufixo)
+    heartbeat = db.Column(db.DateTime, nullable=True) # Última renovação do lease pelo dono
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    imagens = db.relationship('ImagemJobFrequencia', backref='job', passive_deletes=True, lazy=True, order_by='ImagemJobFrequencia.id')
+
+
+class ImagemJobFrequencia(db.Model):
+    __tablename__ = 'imagem_job_frequencia'
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('job_frequencia.id', ondelete='CASCADE'), nullable=False)
+    imagem_turma = db.Column(db.LargeBinary(), nullable=False) # Imagens enviadas, descartadas ao fim do processamento
+
+
+class RequisicaoIdempotente(db.Model):
+    __tablename__ = 'requisicao_idempotente'
+    __table_args__ = (db.UniqueConstraint('escopo', 'chave'),)
+    id = db.Column(db.Integer, primary_key=True)
+    escopo = db.Column(db.String(256), nullable=False) # Método, rota e usuário da requisição
+    chave = db.Column(db.String(128), nullable=False) # Valor do header Idempotency-Key
+    impressao = db.Column(db.String(64), nullable=False) # SHA-256 do corpo da requisição
+    status = db.Column(db.String(10), nullable=False, default='running') # running ou done
+    codigo = db.Column(db.Integer, nullable=True)
+    resposta = db.Column(db.Text, nullable=True) # Corpo da resposta em JSON
+    dono = db.Column(db.String(128), nullable=True) # Processo que executa a requisição (ver core/jobs.py)
+    heartbeat = db.Column(db.DateTime, nullable=True) # Última renovação do lease da reserva pelo dono
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
 class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key = True)
@@ -101,6 +169,16 @@ class AlunoSchema(ma.SQLAlchemyAutoSchema):
         load_instance = True
 
 
+class AlunoTemplateSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        fields = ('id', 'timestamp')
+
+
+class SuspeitaDuplicidadeSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        fields = ('matricula', 'matricula_semelhante', 'similaridade', 'timestamp')
+
+
 class TurmaSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         fields = ('codigo', 'semestre', 'nome', 'professor_id')
@@ -120,6 +198,11 @@ class FrequenciaSchema(ma.SQLAlchemyAutoSchema):
         fields = ('id', 'timestamp')
 
 
+class JobFrequenciaSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        fields = ('id', 'status', 'frequencia_id', 'erro', 'timestamp')
+
+
 class UserSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         fields = ('id', 'username')
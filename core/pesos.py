@@ -0,0 +1,141 @@
+'''
+Armazenamento local dos pesos das redes de reconhecimento facial, para uso em máquinas sem acesso à internet.
+
+Cada rede é salva em um arquivo binário único com os tensores alinhados, descrito por um manifesto JSON com o
+formato e o SHA-256 de cada arquivo. Na leitura os arquivos são mapeados em memória (copy-on-write), então
+processos diferentes na mesma máquina compartilham as páginas dos pesos em vez de manter cópias privadas.
+
+Uso (a partir da raiz do repositório):
+    python core/pesos.py empacotar <diretorio>
+    python core/pesos.py verificar <diretorio>
+'''
+
+import hashlib
+import json
+import os
+import numpy as np
+
+MANIFESTO = 'manifesto.json'
+VERSAO_MANIFESTO = 1
+ALINHAMENTO = 64 # Bytes entre o início de cada tensor no arquivo
+
+
+def _sha256(caminho):
+    hash_arquivo = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(1024 * 1024), b''):
+            hash_arquivo.update(bloco)
+    return hash_arquivo.hexdigest()
+
+
+def _salvar_rede(diretorio, nome, estado):
+    arquivo = f'{nome}.bin'
+    tensores = []
+    offset = 0
+
+    with open(os.path.join(diretorio, arquivo), 'wb') as saida:
+        for chave, tensor in estado.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+
+            preenchimento = (-offset) % ALINHAMENTO
+            saida.write(b'\0' * preenchimento)
+            offset += preenchimento
+
+            saida.write(array.tobytes())
+            tensores.append({'nome': chave, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+            offset += array.nbytes
+
+    return {'arquivo': arquivo, 'sha256': _sha256(os.path.join(diretorio, arquivo)), 'tensores': tensores}
+
+
+def empacotar_pesos(diretorio):
+    '''
+    Salva no diretório os pesos do detector (P-, R- e O-Net da MTCNN) e do extrator de características (InceptionResnetV1 - VGGFace2).
+    Precisa ser executado uma vez em uma máquina com acesso à internet para obter os pesos da InceptionResnetV1.
+    '''
+    from facenet_pytorch import MTCNN, InceptionResnetV1
+
+    os.makedirs(diretorio, exist_ok=True)
+
+    detector = MTCNN()
+    extrator = InceptionResnetV1(pretrained='vggface2').eval()
+
+    # A camada de classificação das identidades do VGGFace2 não é usada para extrair embeddings
+    estado_extrator = {chave: tensor for chave, tensor in extrator.state_dict().items() if not chave.startswith('logits.')}
+
+    redes = {'inception_resnet_v1': _salvar_rede(diretorio, 'inception_resnet_v1', estado_extrator),
+             'pnet': _salvar_rede(diretorio, 'pnet', detector.pnet.state_dict()),
+             'rnet': _salvar_rede(diretorio, 'rnet', detector.rnet.state_dict()),
+             'onet': _salvar_rede(diretorio, 'onet', detector.onet.state_dict())}
+
+    with open(os.path.join(diretorio, MANIFESTO), 'w') as manifesto:
+        json.dump({'versao': VERSAO_MANIFESTO, 'redes': redes}, manifesto, indent=2)
+
+    return redes
+
+
+def ler_manifesto(diretorio):
+    with open(os.path.join(diretorio, MANIFESTO)) as manifesto:
+        conteudo = json.load(manifesto)
+
+    if conteudo.get('versao') != VERSAO_MANIFESTO:
+        raise ValueError(f"Versão do manifesto de pesos não suportada em '{diretorio}'.")
+
+    return conteudo['redes']
+
+
+def verificar_pesos(diretorio):
+    '''
+    Confere o SHA-256 de todos os arquivos de pesos listados no manifesto
+    '''
+    for nome, rede in ler_manifesto(diretorio).items():
+        if _sha256(os.path.join(diretorio, rede['arquivo'])) != rede['sha256']:
+            raise ValueError(f"Checksum inválido para os pesos da rede '{nome}' em '{diretorio}'.")
+
+
+def carregar_pesos(diretorio, nome, modulo, manifesto=None):
+    '''
+    Substitui os parâmetros e buffers do módulo por tensores mapeados em memória a partir do arquivo da rede
+    '''
+    import torch
+
+    rede = (manifesto or ler_manifesto(diretorio))[nome]
+    mapa = np.memmap(os.path.join(diretorio, rede['arquivo']), dtype=np.uint8, mode='c')
+    tensores = {tensor['nome']: tensor for tensor in rede['tensores']}
+
+    faltando = set(modulo.state_dict().keys()) - set(tensores.keys())
+    if faltando:
+        raise ValueError(f"Pesos da rede '{nome}' incompletos: {sorted(faltando)[:5]}.")
+
+    for chave in modulo.state_dict().keys():
+        tensor = tensores[chave]
+        array = np.ndarray(tensor['shape'], dtype=np.dtype(tensor['dtype']), buffer=mapa, offset=tensor['offset'])
+        valor = torch.from_numpy(array)
+
+        *caminho, atributo = chave.split('.')
+        submodulo = modulo
+        for parte in caminho:
+            submodulo = getattr(submodulo, parte)
+
+        if atributo in submodulo._parameters:
+            submodulo._parameters[atributo] = torch.nn.Parameter(valor, requires_grad=False)
+        else:
+            submodulo._buffers[atributo] = valor
+
+    return modulo
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Gerencia o diretório local de pesos das redes de reconhecimento facial.')
+    parser.add_argument('comando', choices=['empacotar', 'verificar'])
+    parser.add_argument('diretorio', help='Diretório local dos pesos (MODEL_WEIGHTS_DIR)')
+    args = parser.parse_args()
+
+    if args.comando == 'empacotar':
+        empacotar_pesos(args.diretorio)
+
+    verificar_pesos(args.diretorio)
+    print(f"Pesos verificados em '{args.diretorio}'.")
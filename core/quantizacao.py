@@ -0,0 +1,106 @@
+'''
+Verificação da diferença entre os embeddings gerados pela rede em fp32 e pela versão quantizada em int8.
+
+Uso (a partir da raiz do repositório):
+    python core/quantizacao.py --calibracao <QUANTIZATION_CALIBRATION_DIR> [--imagens tests/test_images] [--pesos <MODEL_WEIGHTS_DIR>]
+
+As imagens avaliadas não podem fazer parte do conjunto de calibração, para que a diferença medida não seja otimista.
+'''
+
+import hashlib
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from core.modelos import ModelosReconhecimento, modelos
+from core.utils import from_img_dir_to_bytes, find_faces, normalizar_embeddings
+
+
+def _extrair(extrator, faces, repeticoes=3):
+    '''
+    Embeddings das faces e o menor tempo entre as repetições, medido após uma execução de aquecimento
+    '''
+    import torch
+    import torchvision.transforms as transforms
+
+    to_tensor = transforms.ToTensor()
+    entrada = torch.stack([to_tensor(face) for face in faces])
+    tempos = []
+
+    with torch.no_grad():
+        embeddings = extrator(entrada).numpy()
+
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            extrator(entrada)
+            tempos.append(time.perf_counter() - inicio)
+
+    return embeddings, min(tempos)
+
+
+def _conteudos(diretorio):
+    conteudos = set()
+    for arquivo in os.listdir(diretorio):
+        with open(os.path.join(diretorio, arquivo), 'rb') as imagem:
+            conteudos.add(hashlib.sha256(imagem.read()).hexdigest())
+    return conteudos
+
+
+def avaliar_quantizacao(diretorio_imagens, diretorio_calibracao):
+    '''
+    Compara os embeddings fp32 e int8 das faces encontradas em cada imagem do diretório, usando os mesmos pesos dos modelos configurados
+    e a rede int8 calibrada com as imagens de 'diretorio_calibracao', que não pode conter nenhuma das imagens avaliadas.
+    Retorna, por imagem, o número de faces, a similaridade cosseno média e mínima entre as duas versões e o tempo de cada uma.
+    '''
+    if _conteudos(diretorio_imagens) & _conteudos(diretorio_calibracao):
+        raise ValueError('As imagens avaliadas não podem fazer parte do conjunto de calibração da quantização.')
+
+    modelos_fp32 = ModelosReconhecimento()
+    modelos_fp32.configurar(**dict(modelos.opcoes(), precisao='fp32', diretorio_torchscript=None))
+    modelos_int8 = ModelosReconhecimento()
+    modelos_int8.configurar(**dict(modelos.opcoes(), precisao='int8', diretorio_torchscript=None, diretorio_calibracao=diretorio_calibracao))
+
+    modelos_fp32.carregar()
+    modelos_int8.carregar()
+
+    resultados = {}
+
+    for arquivo in sorted(os.listdir(diretorio_imagens)):
+        faces = find_faces(from_img_dir_to_bytes(os.path.join(diretorio_imagens, arquivo)))
+
+        if not faces:
+            continue
+
+        embeddings_fp32, tempo_fp32 = _extrair(modelos_fp32.feature_extractor, faces)
+        embeddings_int8, tempo_int8 = _extrair(modelos_int8.feature_extractor, faces)
+
+        similaridades = np.sum(normalizar_embeddings(embeddings_fp32) * normalizar_embeddings(embeddings_int8), axis=1)
+
+        resultados[arquivo] = dict(faces=len(faces),
+                                   similaridade_media=float(similaridades.mean()),
+                                   similaridade_minima=float(similaridades.min()),
+                                   tempo_fp32=tempo_fp32,
+                                   tempo_int8=tempo_int8)
+
+    return resultados
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compara os embeddings da rede em fp32 e quantizada em int8.')
+    parser.add_argument('--imagens', default='tests/test_images', help='Diretório com as imagens avaliadas')
+    parser.add_argument('--pesos', default=os.getenv('MODEL_WEIGHTS_DIR'), help='Diretório local dos pesos (MODEL_WEIGHTS_DIR)')
+    parser.add_argument('--calibracao', default=os.getenv('QUANTIZATION_CALIBRATION_DIR'), required=not os.getenv('QUANTIZATION_CALIBRATION_DIR'),
+                        help='Diretório com as fotos de calibração da quantização, diferentes das avaliadas (QUANTIZATION_CALIBRATION_DIR)')
+    args = parser.parse_args()
+
+    modelos.configurar(diretorio_pesos=args.pesos)
+
+    for arquivo, resultado in avaliar_quantizacao(args.imagens, args.calibracao).items():
+        print(f"{arquivo}: {resultado['faces']} face(s), similaridade fp32 x int8 média {resultado['similaridade_media']:.4f} "
+              f"(mínima {resultado['similaridade_minima']:.4f}), {resultado['tempo_fp32'] * 1000:.1f} ms fp32 / {resultado['tempo_int8'] * 1000:.1f} ms int8")
@@ -0,0 +1,104 @@
+'''
+Versão da InceptionResnetV1 (facenet_pytorch) preparada para a quantização estática em modo eager do PyTorch (disponível desde o 1.3).
+
+Os blocos da rede reaproveitam os módulos (e pesos) da rede original; só mudam as operações que não são módulos, como a concatenação
+dos ramos e a soma residual, que passam a usar FloatFunctional para que o PyTorch possa observá-las e quantizá-las. Cada BasicConv2d
+(Conv2d + BatchNorm2d + ReLU) é fundida em uma única convolução. A camada linear final e a sua batch normalization 1D (sem versão
+quantizada no PyTorch 1.7) continuam em fp32, assim como a normalização L2 do embedding.
+'''
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.quantized import FloatFunctional
+from torch.quantization import QuantStub, DeQuantStub, fuse_modules, get_default_qconfig, prepare, convert
+from facenet_pytorch.models.inception_resnet_v1 import BasicConv2d, Block35, Block17, Block8, Mixed_6a, Mixed_7a
+
+CAMADAS_CONVOLUCIONAIS = ('conv2d_1a', 'conv2d_2a', 'conv2d_2b', 'maxpool_3a', 'conv2d_3b', 'conv2d_4a', 'conv2d_4b',
+                          'repeat_1', 'mixed_6a', 'repeat_2', 'mixed_7a', 'repeat_3', 'block8', 'avgpool_1a')
+
+
+class BlocoResidual(nn.Module):
+    '''
+    Block35, Block17 e Block8: concatenação dos ramos, convolução 1x1 e soma residual escalada (seguida de ReLU, exceto no último bloco)
+    '''
+    def __init__(self, bloco):
+        super().__init__()
+        self.ramos = nn.ModuleList([getattr(bloco, nome) for nome in ('branch0', 'branch1', 'branch2') if hasattr(bloco, nome)])
+        self.conv2d = bloco.conv2d
+        self.scale = bloco.scale
+        self.com_relu = not getattr(bloco, 'noReLU', False)
+        self.concatenacao = FloatFunctional()
+        self.escala = FloatFunctional()
+        self.soma = FloatFunctional()
+
+    def forward(self, x):
+        saida = self.conv2d(self.concatenacao.cat([ramo(x) for ramo in self.ramos], 1))
+        saida = self.escala.mul_scalar(saida, self.scale)
+
+        if self.com_relu:
+            return self.soma.add_relu(saida, x)
+        return self.soma.add(saida, x)
+
+
+class BlocoDeReducao(nn.Module):
+    '''
+    Mixed_6a e Mixed_7a: concatenação dos ramos
+    '''
+    def __init__(self, bloco):
+        super().__init__()
+        self.ramos = nn.ModuleList([getattr(bloco, nome) for nome in ('branch0', 'branch1', 'branch2', 'branch3') if hasattr(bloco, nome)])
+        self.concatenacao = FloatFunctional()
+
+    def forward(self, x):
+        return self.concatenacao.cat([ramo(x) for ramo in self.ramos], 1)
+
+
+class RedeQuantizavel(nn.Module):
+    '''
+    Mesmo cálculo do forward da InceptionResnetV1 (sem classificação), com a entrada quantizada e a saída das convoluções desquantizada
+    '''
+    def __init__(self, rede):
+        super().__init__()
+        self.quantizacao = QuantStub()
+        self.convolucoes = nn.Sequential(*[_adaptar(getattr(rede, nome)) for nome in CAMADAS_CONVOLUCIONAIS])
+        self.desquantizacao = DeQuantStub()
+        self.last_linear = rede.last_linear
+        self.last_bn = rede.last_bn
+
+    def forward(self, x):
+        x = self.desquantizacao(self.convolucoes(self.quantizacao(x)))
+        x = self.last_bn(self.last_linear(x.flatten(1)))
+        return F.normalize(x, p=2, dim=1)
+
+
+def _adaptar(modulo):
+    if isinstance(modulo, (Block35, Block17, Block8)):
+        return BlocoResidual(modulo)
+    if isinstance(modulo, (Mixed_6a, Mixed_7a)):
+        return BlocoDeReducao(modulo)
+    if isinstance(modulo, nn.Sequential):
+        return nn.Sequential(*[_adaptar(filho) for filho in modulo])
+    return modulo
+
+
+def quantizar_rede(rede, faces, backend):
+    '''
+    Funde as convoluções, calibra os observadores com as faces (N, 3, 160, 160) e retorna a rede convertida para int8.
+    Os módulos da rede original são alterados (fusão e conversão são feitas no lugar, sem cópia dos pesos fp32).
+    '''
+    quantizavel = RedeQuantizavel(rede.eval()).eval()
+
+    for modulo in quantizavel.modules():
+        if isinstance(modulo, BasicConv2d):
+            fuse_modules(modulo, ['conv', 'bn', 'relu'], inplace=True)
+
+    quantizavel.qconfig = get_default_qconfig(backend)
+    quantizavel.last_linear.qconfig = None
+    quantizavel.last_bn.qconfig = None
+    prepare(quantizavel, inplace=True)
+
+    with torch.no_grad():
+        quantizavel(faces)
+
+    return convert(quantizavel, inplace=True)
@@ -3,9 +3,104 @@ import sys
 sys.path.append('./')
 from APIs import api
 from config import app, db
+from core.modelos import modelos, aquecer_modelos, opcoes_da_configuracao
+from core.inferencia import servico_inferencia
+from core.cache_resultados import cache_resultados
+from core.indice_alunos import indice_alunos
+from core.jobs import executor_de_jobs
+from core.utils import CONFIGURACOES_DA_PIPELINE
 from flask import jsonify
 from flask_jwt_extended import JWTManager
 
+def definir_configuracoes_padrao(app):
+    '''
+    Valores padrão das configurações da aplicação, substituídos pelos definidos no arquivo ENV_FILE_LOCATION (também usados
+    pelos scripts de linha de comando que executam a pipeline de reconhecimento fora do servidor)
+    '''
+    # Quantidade máxima de faces processadas por forward pass da rede de extração de características
+    app.config.setdefault('EMBEDDING_BATCH_SIZE', 32)
+
+    # Maior lado (em pixels) da imagem usada na detecção de faces (0 desativa) e tamanho mínimo de face procurado pela MTCNN nessa imagem
+    app.config.setdefault('DETECTION_MAX_SIDE', 1600)
+    app.config.setdefault('DETECTION_MIN_FACE_SIZE', 20)
+
+    # Imagens acima desse número de pixels são detectadas em tiles sobrepostos na resolução original (0 desativa), com o tamanho
+    # e a sobreposição dos tiles em pixels e a quantidade de tiles processados por lote
+    app.config.setdefault('DETECTION_TILE_MIN_PIXELS', 24000000)
+    app.config.setdefault('DETECTION_TILE_SIZE', 1024)
+    app.config.setdefault('DETECTION_TILE_OVERLAP', 256)
+    app.config.setdefault('DETECTION_TILE_BATCH', 8)
+
+    # Memória máxima (em bytes) ocupada pelas galerias de embeddings das turmas mantidas em cache
+    app.config.setdefault('GALLERY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+    # Arquivo (SQLite) do cache de resultados por conteúdo da imagem, compartilhado entre os processos do servidor (sem arquivo o cache
+    # fica desativado), e o tamanho máximo em bytes dos resultados armazenados, com descarte dos usados há mais tempo
+    app.config.setdefault('RESULT_CACHE_PATH', os.getenv('RESULT_CACHE_PATH'))
+    app.config.setdefault('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+    # Arquivo (.npz) do índice de identificação de alunos, salvo a cada alteração e recarregado pelos outros processos do servidor (sem
+    # arquivo o índice fica apenas em memória), quantidade de listas consultadas por busca e quantidade de vetores a partir da qual o
+    # índice é dividido em listas (abaixo disso a busca é exata)
+    app.config.setdefault('STUDENT_INDEX_PATH', os.getenv('STUDENT_INDEX_PATH'))
+    app.config.setdefault('STUDENT_INDEX_NPROBE', 16)
+    app.config.setdefault('STUDENT_INDEX_MIN_SIZE', 2048)
+
+    # Similaridade a partir da qual a face de um novo aluno é considerada a de um aluno já cadastrado, o que fazer com esses cadastros
+    # ('sinalizar', registrando a suspeita; 'rejeitar'; ou 'desativado') e lado dos blocos da matriz na varredura completa de duplicatas
+    app.config.setdefault('DUPLICATE_IDENTITY_THRESHOLD', 0.7)
+    app.config.setdefault('DUPLICATE_IDENTITY_ACTION', 'sinalizar')
+    app.config.setdefault('DUPLICATE_SCAN_BLOCK_SIZE', 4096)
+
+    # Quantidade máxima de templates adicionais por aluno e como os templates de um aluno são combinados na comparação: 'max' (maior
+    # similaridade entre eles) ou 'centroide' (média normalizada)
+    app.config.setdefault('STUDENT_MAX_TEMPLATES', 10)
+    app.config.setdefault('GALLERY_TEMPLATE_AGGREGATION', 'max')
+
+    # Precisão dos embeddings salvos no banco de dados ('float32' ou 'float16')
+    app.config.setdefault('EMBEDDING_STORAGE_DTYPE', 'float32')
+
+    # Carrega e aquece (inferência sintética) os modelos de reconhecimento facial na inicialização em vez de esperar pela primeira requisição.
+    # Desativado por padrão para que processos que só atendem o CRUD não carreguem as redes; ativar nos processos que registram a frequência
+    app.config.setdefault('PRELOAD_MODELS', False)
+
+    # Diretório local com os pesos das redes gerado por 'python core/pesos.py empacotar <diretorio>' (dispensa download)
+    app.config.setdefault('MODEL_WEIGHTS_DIR', os.getenv('MODEL_WEIGHTS_DIR'))
+    app.config.setdefault('MODEL_WEIGHTS_VERIFY', True)
+
+    # Precisão da rede de extração de características: 'fp32' ou 'int8' (ver 'python core/quantizacao.py' para a diferença nos embeddings
+    # e no tempo) e diretório com as fotos usadas na calibração da quantização int8 (obrigatório para 'int8', exceto com MODEL_TORCHSCRIPT_DIR)
+    app.config.setdefault('EMBEDDING_PRECISION', 'fp32')
+    app.config.setdefault('QUANTIZATION_CALIBRATION_DIR', os.getenv('QUANTIZATION_CALIBRATION_DIR'))
+
+    # Diretório com as redes congeladas geradas por 'python core/torchscript.py <diretorio>', usadas no lugar dos módulos Python
+    app.config.setdefault('MODEL_TORCHSCRIPT_DIR', os.getenv('MODEL_TORCHSCRIPT_DIR'))
+
+    # Processos dedicados à inferência (0 executa o reconhecimento na própria thread da requisição; limitado ao número de núcleos)
+    # e threads do torch por processo
+    app.config.setdefault('INFERENCE_WORKERS', 0)
+    app.config.setdefault('INFERENCE_THREADS_PER_WORKER', None)
+
+    # Threads responsáveis pelos jobs de registro de frequência enviados com 'assincrono=true' e prazo (em segundos) sem renovação
+    # do lease após o qual o job de um processo que parou de responder é retomado por outro processo
+    app.config.setdefault('ATTENDANCE_JOB_THREADS', 1)
+    app.config.setdefault('JOB_LEASE_SECONDS', 60)
+
+    # Quantidade máxima de fotos por frequência e similaridade a partir da qual faces de fotos diferentes são tratadas como a mesma pessoa
+    app.config.setdefault('ATTENDANCE_MAX_IMAGES', 4)
+    app.config.setdefault('FACE_DEDUP_THRESHOLD', 0.6)
+
+    # Quantidade de fotos decodificadas e processadas de cada vez no cadastro de alunos em lote (limita a memória usada por lotes grandes)
+    app.config.setdefault('ENROLLMENT_CHUNK_SIZE', 64)
+
+    # Tempo (em segundos) durante o qual a resposta de uma requisição com 'Idempotency-Key' é reaproveitada, tempo máximo que uma
+    # repetição aguarda a requisição original ainda em andamento e prazo sem renovação do lease após o qual uma repetição assume
+    # a reserva de um processo que parou de responder
+    app.config.setdefault('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60)
+    app.config.setdefault('IDEMPOTENCY_WAIT_SECONDS', 300)
+    app.config.setdefault('IDEMPOTENCY_LEASE_SECONDS', 30)
+
+
 def create_app(testing=False):
     if testing:
         app.config['TESTING'] = True
@@ -16,6 +111,8 @@ def create_app(testing=False):
 
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+    definir_configuracoes_padrao(app)
+
     # Para leitura de configuracoes chave secreta JWT
     if os.getenv('ENV_FILE_LOCATION'):
         app.config.from_envvar('ENV_FILE_LOCATION')
@@ -26,6 +123,26 @@ def create_app(testing=False):
 
     db.init_app(app)
     api.init_app(app)
+
+    modelos.configurar(**opcoes_da_configuracao(app.config))
+
+    # O tamanho do lote da Inception não altera os resultados, então não faz parte da versão da pipeline
+    cache_resultados.configurar(app.config['RESULT_CACHE_PATH'], app.config['RESULT_CACHE_MAX_BYTES'],
+                                versao=modelos.versao({chave: app.config[chave] for chave in CONFIGURACOES_DA_PIPELINE if chave != 'EMBEDDING_BATCH_SIZE'}))
+
+    indice_alunos.configurar(app.config['STUDENT_INDEX_PATH'], nprobe=app.config['STUDENT_INDEX_NPROBE'],
+                             tamanho_minimo=app.config['STUDENT_INDEX_MIN_SIZE'])
+
+    if app.config['INFERENCE_WORKERS'] > 0:
+        servico_inferencia.iniciar(app.config['INFERENCE_WORKERS'],
+                                   threads=app.config['INFERENCE_THREADS_PER_WORKER'],
+                                   opcoes_modelos=modelos.opcoes(),
+                                   configuracoes={chave: app.config[chave] for chave in CONFIGURACOES_DA_PIPELINE})
+    elif app.config['PRELOAD_MODELS']:
+        aquecer_modelos()
+
+    executor_de_jobs.iniciar(app, num_threads=app.config['ATTENDANCE_JOB_THREADS'], validade_lease=app.config['JOB_LEASE_SECONDS'])
+
     jwt = JWTManager(app)
 
     @jwt.expired_token_loader
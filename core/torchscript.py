@@ -0,0 +1,95 @@
+'''
+Exportação das redes de reconhecimento facial para TorchScript congelado, evitando reconstruir os módulos Python a cada inicialização.
+
+Uso (a partir da raiz do repositório):
+    python core/torchscript.py <diretorio> [--pesos <MODEL_WEIGHTS_DIR>] [--precisao fp32|int8] [--calibracao <QUANTIZATION_CALIBRATION_DIR>]
+
+A precisão 'int8' exige o diretório de calibração; a rede exportada já inclui a calibração.
+'''
+
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+METADADOS = 'torchscript.json'
+REDES = ('inception_resnet_v1', 'pnet', 'rnet', 'onet')
+
+# Entradas de exemplo usadas no tracing: faces 160x160 para o extrator e os tamanhos fixos das etapas R e O da MTCNN
+_EXEMPLOS = {'inception_resnet_v1': (2, 3, 160, 160),
+             'pnet': (1, 3, 120, 160),
+             'rnet': (2, 3, 24, 24),
+             'onet': (2, 3, 48, 48)}
+
+
+def _congelar(modulo, formato, congelar=True):
+    import torch
+
+    with torch.no_grad():
+        traced = torch.jit.trace(modulo.eval(), torch.rand(*formato))
+
+    # torch.jit.freeze incorpora os pesos como constantes no grafo (disponível a partir do PyTorch 1.7)
+    if congelar and hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+
+    return traced
+
+
+def exportar_torchscript(diretorio, modelos):
+    '''
+    Salva no diretório as redes já carregadas no container de modelos informado (pesos e precisão configurados nele)
+    '''
+    import torch
+
+    if modelos.device.type != 'cpu':
+        raise ValueError('A exportação para TorchScript deve ser feita com os modelos em CPU.')
+
+    os.makedirs(diretorio, exist_ok=True)
+
+    redes = {'inception_resnet_v1': modelos.feature_extractor,
+             'pnet': modelos.face_detector.pnet,
+             'rnet': modelos.face_detector.rnet,
+             'onet': modelos.face_detector.onet}
+
+    for nome, modulo in redes.items():
+        # A detecção da MTCNN consulta o dtype dos parâmetros da P-Net, então as redes do detector não podem ser congeladas (só passam pelo tracing)
+        torch.jit.save(_congelar(modulo, _EXEMPLOS[nome], congelar=(nome == 'inception_resnet_v1')), os.path.join(diretorio, f'{nome}.pt'))
+
+    with open(os.path.join(diretorio, METADADOS), 'w') as metadados:
+        json.dump({'precisao': modelos.precisao, 'torch': torch.__version__}, metadados, indent=2)
+
+
+def carregar_torchscript(diretorio, precisao, device):
+    '''
+    Retorna os módulos TorchScript salvos no diretório, indexados pelo nome da rede
+    '''
+    import torch
+
+    with open(os.path.join(diretorio, METADADOS)) as metadados:
+        precisao_exportada = json.load(metadados)['precisao']
+
+    if precisao_exportada != precisao:
+        raise ValueError(f"Os modelos TorchScript em '{diretorio}' foram exportados com precisão '{precisao_exportada}', mas a configurada é '{precisao}'.")
+
+    return {nome: torch.jit.load(os.path.join(diretorio, f'{nome}.pt'), map_location=device) for nome in REDES}
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from core.modelos import ModelosReconhecimento
+
+    parser = argparse.ArgumentParser(description='Exporta as redes de reconhecimento facial para TorchScript congelado.')
+    parser.add_argument('diretorio', help='Diretório de saída (MODEL_TORCHSCRIPT_DIR)')
+    parser.add_argument('--pesos', default=os.getenv('MODEL_WEIGHTS_DIR'), help='Diretório local dos pesos (MODEL_WEIGHTS_DIR)')
+    parser.add_argument('--precisao', default='fp32', choices=['fp32', 'int8'])
+    parser.add_argument('--calibracao', default=os.getenv('QUANTIZATION_CALIBRATION_DIR'),
+                        help='Diretório com as fotos de calibração da quantização int8 (QUANTIZATION_CALIBRATION_DIR)')
+    args = parser.parse_args()
+
+    modelos = ModelosReconhecimento()
+    modelos.configurar(diretorio_pesos=args.pesos, precisao=args.precisao, diretorio_calibracao=args.calibracao)
+
+    exportar_torchscript(args.diretorio, modelos.carregar())
+    print(f"Modelos TorchScript ({args.precisao}) salvos em '{args.diretorio}'.")
@@ -1,13 +1,18 @@
-from core.models import Aluno, AlunoSchema, Participante
+from core.models import db, Aluno, AlunoSchema, AlunoTemplate, SuspeitaDuplicidade, Turma, Participante, Presenca, Frequencia, AnotacaoErros, FaceFrequencia
+from core.galeria import Galeria, cache_galerias
+from core.embeddings import EMBEDDING_DIM, codificar_embedding, decodificar_embedding
+from core.modelos import modelos
+from core.inferencia import servico_inferencia
+from core.cache_resultados import cache_resultados
+from core.indice_alunos import indice_alunos
+from core.imagem import ImagemProcessada
 import numpy as np
 from numpy.linalg import norm
-from flask import abort
+from flask import abort, current_app, has_app_context
 import io
+import os
 from PIL import Image
-from facenet_pytorch import MTCNN, InceptionResnetV1
-import torch
-import torchvision.transforms as transforms
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
 from functools import wraps
@@ -23,38 +28,232 @@ def token_required():
     return wrapper
 
 
-if torch.cuda.is_available():
-    current_device = torch.device('cuda')
-else:
-    current_device = torch.device('cpu')
+EMBEDDING_BATCH_SIZE = 32 # Quantidade máxima de faces por forward pass da Inception
+GALLERY_CACHE_MAX_BYTES = 64 * 1024 * 1024 # Memória máxima ocupada pelas galerias das turmas em cache
+EMBEDDING_STORAGE_DTYPE = 'float32' # Precisão dos embeddings salvos no banco de dados ('float32' ou 'float16')
+DETECTION_MAX_SIDE = 1600 # Maior lado (em pixels) da imagem entregue à MTCNN; 0 desativa a redução
+DETECTION_TILE_MIN_PIXELS = 24000000 # Imagens com mais pixels que isso são detectadas em tiles na resolução original; 0 desativa
+DETECTION_TILE_SIZE = 1024 # Lado (em pixels) de cada tile
+DETECTION_TILE_OVERLAP = 256 # Sobreposição (em pixels) entre tiles vizinhos; deve ser maior que as faces procuradas
+DETECTION_TILE_BATCH = 8 # Quantidade de tiles processados juntos pela MTCNN
+FACE_DEDUP_THRESHOLD = 0.6 # Similaridade a partir da qual faces de fotos diferentes da mesma frequência são consideradas a mesma pessoa
+GALLERY_TEMPLATE_AGGREGATION = 'max' # Como os templates de um aluno são combinados na comparação ('max' ou 'centroide')
+ENROLLMENT_CHUNK_SIZE = 64 # Quantidade de fotos decodificadas e processadas de cada vez no cadastro de alunos em lote
+DUPLICATE_IDENTITY_THRESHOLD = 0.7 # Similaridade a partir da qual a face de um novo aluno é considerada a mesma de um aluno já cadastrado
+DUPLICATE_IDENTITY_ACTION = 'sinalizar' # O que fazer com esses cadastros ('sinalizar', 'rejeitar' ou 'desativado')
+DUPLICATE_SCAN_BLOCK_SIZE = 4096 # Lado dos blocos da matriz de similaridades calculados de cada vez na varredura de duplicatas
 
+# Configurações repassadas aos processos que executam a pipeline fora da aplicação Flask (ver core/inferencia.py)
+CONFIGURACOES_DA_PIPELINE = ('EMBEDDING_BATCH_SIZE', 'DETECTION_MAX_SIDE', 'DETECTION_TILE_MIN_PIXELS',
+                             'DETECTION_TILE_SIZE', 'DETECTION_TILE_OVERLAP', 'DETECTION_TILE_BATCH')
+_configuracoes_sem_app = {}
 
-face_detector = MTCNN(keep_all=True, device=current_device)
-feature_extractor = InceptionResnetV1(pretrained='vggface2').eval()
+
+def obter_configuracao(chave, padrao):
+    '''
+    Lê uma configuração da aplicação Flask ativa. Sem contexto de aplicação (ex.: scripts de linha de comando e processos de inferência),
+    usa as configurações definidas com definir_configuracoes ou o valor padrão.
+    '''
+    if has_app_context():
+        return current_app.config.get(chave, padrao)
+    return _configuracoes_sem_app.get(chave, padrao)
+
+
+def definir_configuracoes(configuracoes):
+    _configuracoes_sem_app.update(configuracoes)
 
 
 def timestamp_to_datetime_object(timestamp):
     return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
 
 
-def find_faces(img_bytes):
-    
-    face_list = []
-    
-    img = Image.open(io.BytesIO(img_bytes))
+def abrir_imagem(img):
+    '''
+    Retorna o contexto de processamento da imagem (ImagemProcessada), aceitando os bytes enviados ou um contexto já criado
+    '''
+    return img if isinstance(img, ImagemProcessada) else ImagemProcessada(img)
 
-    # Detect faces
-    boxes, _ = face_detector.detect(img)
-    
-    # Check if any face was found
-    found_faces = not (str(type(boxes)) == "<class 'NoneType'>")
 
-    if found_faces:
-        for box in boxes:
-            cropped_face = img.crop(box.tolist()).resize((160,160), resample=Image.BICUBIC)
-            face_list.append(cropped_face)
+def iou(caixas_a, caixas_b):
+    '''
+    Matriz (N, M) com a interseção sobre união entre as caixas (x1, y1, x2, y2) dos dois conjuntos
+    '''
+    caixas_a = np.asarray(caixas_a, dtype=np.float32).reshape(-1, 4)
+    caixas_b = np.asarray(caixas_b, dtype=np.float32).reshape(-1, 4)
+
+    x1 = np.maximum(caixas_a[:, None, 0], caixas_b[None, :, 0])
+    y1 = np.maximum(caixas_a[:, None, 1], caixas_b[None, :, 1])
+    x2 = np.minimum(caixas_a[:, None, 2], caixas_b[None, :, 2])
+    y2 = np.minimum(caixas_a[:, None, 3], caixas_b[None, :, 3])
+
+    intersecao = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (caixas_a[:, 2] - caixas_a[:, 0]) * (caixas_a[:, 3] - caixas_a[:, 1])
+    area_b = (caixas_b[:, 2] - caixas_b[:, 0]) * (caixas_b[:, 3] - caixas_b[:, 1])
+
+    return intersecao / np.maximum(area_a[:, None] + area_b[None, :] - intersecao, 1e-6)
+
+
+def nms(caixas, scores, limiar=0.3):
+    '''
+    Supressão de não-máximos: retorna os índices das caixas mantidas, da maior para a menor probabilidade
+    '''
+    ordem = np.argsort(-np.asarray(scores), kind='stable')
+    sobreposicoes = iou(caixas, caixas)
+    mantidas = []
+
+    for indice in ordem:
+        if all(sobreposicoes[indice, mantida] <= limiar for mantida in mantidas):
+            mantidas.append(indice)
 
-    return face_list
+    return np.array(mantidas, dtype=np.int64)
+
+
+def pedacos_de_faces(caixas, faces, limiar_contencao=0.5, limiar_iou=0.3):
+    '''
+    Indica as caixas (N, 4) que estão majoritariamente contidas em uma das faces (M, 4) sem corresponder a ela (IoU baixo)
+    '''
+    x0 = np.maximum(caixas[:, None, 0], faces[None, :, 0])
+    y0 = np.maximum(caixas[:, None, 1], faces[None, :, 1])
+    x1 = np.minimum(caixas[:, None, 2], faces[None, :, 2])
+    y1 = np.minimum(caixas[:, None, 3], faces[None, :, 3])
+    intersecao = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    areas = (caixas[:, 2] - caixas[:, 0]) * (caixas[:, 3] - caixas[:, 1])
+
+    contencao = intersecao / np.maximum(areas[:, None], np.finfo(np.float32).eps)
+    return ((contencao >= limiar_contencao) & (iou(caixas, faces) <= limiar_iou)).any(axis=1)
+
+
+def usar_tiles(imagem):
+    limite = obter_configuracao('DETECTION_TILE_MIN_PIXELS', DETECTION_TILE_MIN_PIXELS)
+    return bool(limite) and imagem.pixels > limite
+
+
+def posicoes_dos_tiles(tamanho, tamanho_tile, sobreposicao):
+    '''
+    Origens dos tiles ao longo de um eixo, distribuídas igualmente para que todos tenham o mesmo tamanho e cubram a imagem inteira
+    '''
+    if tamanho <= tamanho_tile:
+        return [0]
+
+    quantidade = int(np.ceil((tamanho - sobreposicao) / (tamanho_tile - sobreposicao)))
+    return np.linspace(0, tamanho - tamanho_tile, quantidade).round().astype(int).tolist()
+
+
+def detectar_lote_de_tiles(tiles):
+    '''
+    Executa a MTCNN em um array (N, H, W, 3) uint8 de tiles de mesmo tamanho, retornando as caixas (K, 5) de cada tile (x1, y1, x2, y2, probabilidade)
+    '''
+    import torch
+    from facenet_pytorch.models.utils.detect_face import detect_face
+
+    detector = modelos.carregar().face_detector
+
+    def detectar(lote):
+        with torch.no_grad():
+            return detect_face(lote, detector.min_face_size, detector.pnet, detector.rnet, detector.onet,
+                               detector.thresholds, detector.factor, detector.device)[0]
+
+    try:
+        caixas_por_tile = detectar(tiles)
+    except ValueError:
+        # Com numpy >= 1.24 a facenet_pytorch 2.5.1 falha ao montar o resultado de lotes com número de faces diferente por tile
+        caixas_por_tile = [detectar(tile[None])[0] for tile in tiles]
+
+    return [np.asarray(caixas, dtype=np.float32).reshape(-1, 5) for caixas in caixas_por_tile]
+
+
+def detectar_em_tiles(imagem, detectar_lote=None):
+    '''
+    Detecta as faces em tiles sobrepostos da imagem em resolução original e junta as caixas com NMS nas coordenadas globais.
+    Uma passada na imagem inteira reduzida (DETECTION_MAX_SIDE) encontra as faces maiores que a sobreposição, que ficam cortadas
+    em todos os tiles. 'detectar_lote' permite executar cada lote de tiles em outro processo: recebe o array de tiles e retorna
+    um Future com o resultado de detectar_lote_de_tiles. Retorna as caixas (N, 4) ou None.
+    '''
+    tamanho_tile = obter_configuracao('DETECTION_TILE_SIZE', DETECTION_TILE_SIZE)
+    sobreposicao = obter_configuracao('DETECTION_TILE_OVERLAP', DETECTION_TILE_OVERLAP)
+    tamanho_lote = obter_configuracao('DETECTION_TILE_BATCH', DETECTION_TILE_BATCH)
+    lado_maximo = obter_configuracao('DETECTION_MAX_SIDE', DETECTION_MAX_SIDE)
+
+    img = imagem.imagem
+    largura, altura = min(tamanho_tile, img.width), min(tamanho_tile, img.height)
+    origens = [(x, y) for y in posicoes_dos_tiles(img.height, altura, sobreposicao)
+                      for x in posicoes_dos_tiles(img.width, largura, sobreposicao)]
+    lotes = [origens[inicio:inicio + tamanho_lote] for inicio in range(0, len(origens), tamanho_lote)]
+
+    def recortar(lote):
+        return np.stack([np.asarray(img.crop((x, y, x + largura, y + altura))) for x, y in lote])
+
+    img_reduzida, escala = imagem.para_deteccao(lado_maximo)
+    reduzida = np.asarray(img_reduzida)[None]
+
+    if detectar_lote is None:
+        resultados = [detectar_lote_de_tiles(recortar(lote)) for lote in lotes]
+        caixas_reduzida = detectar_lote_de_tiles(reduzida)[0]
+    else:
+        futuros = [detectar_lote(recortar(lote)) for lote in lotes] + [detectar_lote(reduzida)]
+        resultados = [futuro.result() for futuro in futuros[:-1]]
+        caixas_reduzida = futuros[-1].result()[0]
+
+    caixas_reduzida = caixas_reduzida * np.append(np.tile(escala, 2), 1).astype(np.float32)
+
+    caixas_globais = []
+    margem = 2
+
+    for (x, y), caixas in zip(origens, [caixas for resultado in resultados for caixas in resultado]):
+        # Faces cortadas na borda interna de um tile aparecem inteiras no tile vizinho (graças à sobreposição), então são descartadas
+        cortadas = (((caixas[:, 0] <= margem) & (x > 0)) |
+                    ((caixas[:, 1] <= margem) & (y > 0)) |
+                    ((caixas[:, 2] >= largura - margem) & (x + largura < img.width)) |
+                    ((caixas[:, 3] >= altura - margem) & (y + altura < img.height)))
+
+        caixas = caixas[~cortadas]
+        caixas_globais.append(caixas + np.array([x, y, x, y, 0], dtype=np.float32))
+
+    caixas_globais = np.concatenate(caixas_globais)
+
+    # Caixas dos tiles contidas em uma face maior da imagem reduzida são pedaços dessa face (olhos, boca) e não faces inteiras;
+    # a mesma face encontrada nas duas passadas tem IoU alto e é resolvida pelo NMS
+    if len(caixas_globais) > 0 and len(caixas_reduzida) > 0:
+        caixas_globais = caixas_globais[~pedacos_de_faces(caixas_globais[:, :4], caixas_reduzida[:, :4])]
+
+    caixas_globais = np.concatenate([caixas_globais, caixas_reduzida])
+
+    if len(caixas_globais) == 0:
+        return None
+
+    # Faces na região de sobreposição são encontradas em mais de um tile
+    return caixas_globais[nms(caixas_globais[:, :4], caixas_globais[:, 4]), :4]
+
+
+def detectar_caixas(img, lado_maximo=None):
+    '''
+    Detecta as faces na imagem reduzida (ou em tiles, para imagens muito grandes) e retorna as caixas (N, 4) nas coordenadas
+    da imagem original (ou None). 'img' pode ser os bytes da imagem ou uma ImagemProcessada.
+    '''
+    imagem = abrir_imagem(img)
+
+    if lado_maximo is None:
+        lado_maximo = obter_configuracao('DETECTION_MAX_SIDE', DETECTION_MAX_SIDE)
+
+    if usar_tiles(imagem):
+        return detectar_em_tiles(imagem)
+
+    img_deteccao, escala = imagem.para_deteccao(lado_maximo)
+
+    boxes, _ = modelos.carregar().face_detector.detect(img_deteccao)
+
+    if boxes is not None:
+        boxes = boxes * np.tile(escala, 2)
+
+    return boxes
+
+
+def find_faces(img_bytes):
+    
+    imagem = abrir_imagem(img_bytes)
+
+    # Detect faces (as caixas voltam na escala original, então os recortes usam a resolução completa)
+    return imagem.recortar_faces(detectar_caixas(imagem))
 
 
 def from_img_dir_to_bytes(directory):
@@ -71,11 +270,15 @@ def from_array_to_bytes(array):
     return imgByteArr.read()
 
 
+def serializar_embedding(embedding):
+    '''
+    Converte o embedding de um aluno para o formato compacto usado na coluna aluno.embedding
+    '''
+    return codificar_embedding(embedding, dtype=obter_configuracao('EMBEDDING_STORAGE_DTYPE', EMBEDDING_STORAGE_DTYPE))
+
+
 def resize_img_bytes(img_bytes):
-    imgByteArr = io.BytesIO()
-    img = Image.open(io.BytesIO(img_bytes)).resize((512, 256), resample=Image.BICUBIC)
-    img.save(imgByteArr, format='JPEG')
-    return imgByteArr.getvalue()
+    return abrir_imagem(img_bytes).miniatura()
 
 
 def obter_threshold(lista_de_faces_da_turma):
@@ -91,57 +294,327 @@ def obter_threshold(lista_de_faces_da_turma):
     return similaridade_maxima
 
 
-def obter_presenca(matriculas, embedding_participantes, embeddings_do_dia, threshold=0.49):
-    
-    embeddings_restantes = deepcopy(embedding_participantes)
-    matriculas_restantes = deepcopy(matriculas)
+def normalizar_embeddings(embeddings):
+    '''
+    Empilha os embeddings em uma matriz float32 (N, 512) com cada linha de norma L2 unitária
+    '''
+    matriz = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    normas = norm(matriz, axis=1, keepdims=True)
+    return matriz / np.maximum(normas, np.finfo(np.float32).eps)
+
+
+def obter_presenca(matriculas, embedding_participantes, embeddings_do_dia, threshold=0.49, participantes_normalizados=False):
+    '''
+    Associa as faces do dia aos participantes da turma através da matriz de similaridade cosseno e de uma atribuição ótima um-para-um (algoritmo húngaro).
+    Retorna o status de presença e a maior similaridade obtida por cada matrícula.
+    '''
+    if len(matriculas) == 0 or len(embeddings_do_dia) == 0:
+        return associar_faces(matriculas, np.empty((len(embeddings_do_dia), len(matriculas)), dtype=np.float32), threshold)
+
+    # Matriz (faces do dia x participantes) obtida com uma única multiplicação de matrizes
+    if not participantes_normalizados:
+        embedding_participantes = normalizar_embeddings(embedding_participantes)
+
+    return associar_faces(matriculas, normalizar_embeddings(embeddings_do_dia) @ embedding_participantes.T, threshold)
+
+
+def associar_faces(matriculas, similaridades, threshold=0.49):
+    '''
+    Associa as faces aos participantes a partir da matriz (faces x participantes) de similaridade cosseno, retornando o status de presença
+    e a maior similaridade obtida por cada matrícula
+    '''
     status_presenca = {aluno: False for aluno in matriculas}
 
-    for index, pessoa_na_aula in enumerate(embeddings_do_dia):
-        
-        similaridades = []
-        
-        for feature_aluno, matricula_aluno in zip(embeddings_restantes, matriculas_restantes):
-            similaridades.append(cos_sim(feature_aluno, pessoa_na_aula))
-            #print(f'Similaridade da pessoa {index+1} com {matricula_aluno} foi de: {cos_sim(feature_aluno, pessoa_na_aula)}')
-        
-        #print('\n')
-
-        maxima_similaridade = max(similaridades)
-        index_aluno_mais_parecido = similaridades.index(maxima_similaridade)
-    
-        if maxima_similaridade > threshold and maxima_similaridade != 1.0:
-            # Muda o status do aluno para presente
-            status_presenca[matriculas_restantes[index_aluno_mais_parecido]] = True
-            #print(f'Aluno {matriculas_restantes[index_aluno_mais_parecido]} esta presente')
-            
-            # Remove esse aluno da lista de participantes aptos a serem reconhecidos
-            del matriculas_restantes[index_aluno_mais_parecido]
-            del embeddings_restantes[index_aluno_mais_parecido]
-        
-        if len(matriculas_restantes) == 0: # Se todas as matriculas já estiverem sido analisadas, break
-            break
-
-    return status_presenca
-
-
-def get_face_features(face_list):
-    
-    face_embeddings = []
+    if similaridades.size == 0:
+        return status_presenca, {aluno: 0.0 for aluno in matriculas}
+
+    # Similaridade igual a 1.0 indica a mesma imagem usada no cadastro e não é considerada
+    validos = (similaridades > threshold) & (similaridades != 1.0)
+
+    from scipy.optimize import linear_sum_assignment # Importação tardia para não pesar na inicialização das rotas de cadastro
+
+    # Pares inválidos recebem peso abaixo de qualquer similaridade cosseno possível
+    faces, alunos = linear_sum_assignment(np.where(validos, similaridades, -2.0), maximize=True)
+
+    for face, aluno in zip(faces, alunos):
+        if validos[face, aluno]:
+            status_presenca[matriculas[aluno]] = True
 
-    for face in face_list:
-        face_as_tensor = transforms.ToTensor()(face).unsqueeze(0)
-        face_embeddings.append(feature_extractor(face_as_tensor).squeeze(0).detach().numpy())
+    melhores_similaridades = {matricula: float(similaridade) for matricula, similaridade in zip(matriculas, similaridades.max(axis=0))}
+
+    return status_presenca, melhores_similaridades
+
+
+def get_face_features(face_list, batch_size=None):
+    '''
+    Extrai os embeddings de todas as faces em lotes, retornando um array float32 contíguo de formato (N, 512).
+    'face_list' pode ser uma lista de faces 160x160 (PIL) ou o tensor (N, 3, 160, 160) gerado por ImagemProcessada.recortar_faces_em_lote.
+    '''
+    if len(face_list) == 0:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+    if batch_size is None:
+        batch_size = obter_configuracao('EMBEDDING_BATCH_SIZE', EMBEDDING_BATCH_SIZE)
+
+    # Importações tardias: o torch só é carregado quando alguma face precisa ser processada
+    import torch
+    import torchvision.transforms as transforms
+
+    modelos.carregar()
+
+    if isinstance(face_list, torch.Tensor):
+        faces_as_tensor = face_list
+    else:
+        to_tensor = transforms.ToTensor()
+        faces_as_tensor = torch.stack([to_tensor(face) for face in face_list])
+
+    face_embeddings = np.empty((len(face_list), EMBEDDING_DIM), dtype=np.float32)
+
+    with torch.no_grad():
+        for inicio in range(0, len(face_list), batch_size):
+            lote = faces_as_tensor[inicio:inicio + batch_size].to(modelos.device)
+            face_embeddings[inicio:inicio + batch_size] = modelos.feature_extractor(lote).cpu().numpy()
 
     return face_embeddings
 
 
-def process_faces(img_bytes):
-    faces_found = find_faces(img_bytes)
-    features = get_face_features(faces_found)
+def caixas_detectadas(boxes):
+    '''
+    Caixas das faces como array float32 (N, 4), vazio quando nenhuma face foi detectada
+    '''
+    if boxes is None:
+        return np.empty((0, 4), dtype=np.float32)
+    return np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+def extrair_faces_localmente(img_bytes):
+    '''
+    Detecta as faces e extrai os seus embeddings neste processo, retornando os embeddings (N, 512) e as caixas (N, 4)
+    '''
+    imagem = abrir_imagem(img_bytes)
+    caixas = caixas_detectadas(detectar_caixas(imagem))
+    return get_face_features(imagem.recortar_faces_em_lote(caixas)), caixas
+
+
+def processar_faces_localmente(img_bytes):
+    features, _ = extrair_faces_localmente(img_bytes)
     return features
 
 
+def extrair_faces(img_bytes):
+    '''
+    Detecta as faces e extrai os seus embeddings, usando o serviço de inferência quando ele estiver ativo. Retorna os embeddings (N, 512)
+    e as caixas (N, 4) das faces. 'img_bytes' pode ser os bytes da imagem ou uma ImagemProcessada.
+    Imagens já processadas são lidas do cache de resultados, sem passar pelas redes.
+    '''
+    imagem = abrir_imagem(img_bytes)
+
+    resultado = cache_resultados.obter(imagem.img_bytes)
+    if resultado is None:
+        resultado = _inferir_faces(imagem)
+        cache_resultados.adicionar(imagem.img_bytes, *resultado)
+
+    return resultado
+
+
+def _inferir_faces(imagem):
+    if servico_inferencia.ativo:
+        # Imagens grandes têm os lotes de tiles distribuídos entre os processos de inferência
+        if usar_tiles(imagem):
+            caixas = caixas_detectadas(detectar_em_tiles(imagem, detectar_lote=servico_inferencia.submeter_tiles))
+            return servico_inferencia.submeter_faces(imagem.recortar_faces_em_lote(caixas)).result(), caixas
+
+        # A miniatura é gerada pelo processo que decodificou a imagem, evitando uma nova decodificação neste processo
+        embeddings, caixas, miniatura = servico_inferencia.submeter(imagem.img_bytes, gerar_miniatura=imagem.com_miniatura).result()
+        if miniatura is not None:
+            imagem.definir_miniatura(miniatura)
+        return embeddings, caixas
+
+    return extrair_faces_localmente(imagem)
+
+
+def process_faces(img_bytes):
+    '''
+    Detecta as faces e extrai os seus embeddings, usando o serviço de inferência quando ele estiver ativo.
+    'img_bytes' pode ser os bytes da imagem ou uma ImagemProcessada.
+    '''
+    embeddings, _ = extrair_faces(img_bytes)
+    return embeddings
+
+
+def recortar_faces_das_imagens(imagens, ignorar_invalidas=False):
+    '''
+    Detecta e recorta as faces de várias imagens (ImagemProcessada), retornando o tensor (N, 3, 160, 160) e as caixas (N, 4) de cada imagem.
+    Com o serviço de inferência ativo, cada imagem é detectada em um processo diferente. Com 'ignorar_invalidas', as imagens que não
+    puderem ser decodificadas recebem None em vez de interromper o processamento das demais.
+    '''
+    if not servico_inferencia.ativo:
+        futuros = [None] * len(imagens)
+    else:
+        # Imagens grandes são divididas em tiles neste processo e só os lotes de tiles vão para os processos de inferência
+        futuros = [None if usar_tiles(imagem) else servico_inferencia.submeter_deteccao(imagem.img_bytes, gerar_miniatura=imagem.com_miniatura)
+                   for imagem in imagens]
+
+    resultados = []
+    for imagem, futuro in zip(imagens, futuros):
+        try:
+            if futuro is not None:
+                faces_da_imagem, caixas, miniatura = futuro.result()
+                if miniatura is not None:
+                    imagem.definir_miniatura(miniatura)
+                resultados.append((faces_da_imagem, caixas))
+                continue
+
+            if servico_inferencia.ativo:
+                caixas = caixas_detectadas(detectar_em_tiles(imagem, detectar_lote=servico_inferencia.submeter_tiles))
+            else:
+                caixas = caixas_detectadas(detectar_caixas(imagem))
+            resultados.append((imagem.recortar_faces_em_lote(caixas), caixas))
+        except (OSError, ValueError): # Arquivo truncado ou corrompido, decodificado aqui ou no processo de inferência
+            if not ignorar_invalidas:
+                raise
+            resultados.append(None)
+
+    return resultados
+
+
+def deduplicar_faces(embeddings, origens, limiar=None):
+    '''
+    Junta as faces de fotos diferentes que pertencem à mesma pessoa, retornando um embedding normalizado (média do grupo) por pessoa.
+    Uma face só entra em um grupo se for similar a todas as faces dele e se o grupo ainda não tiver face da mesma foto.
+    '''
+    if limiar is None:
+        limiar = obter_configuracao('FACE_DEDUP_THRESHOLD', FACE_DEDUP_THRESHOLD)
+
+    embeddings = normalizar_embeddings(embeddings)
+    origens = np.asarray(origens)
+    similaridades = embeddings @ embeddings.T
+
+    grupos = []
+    for indice in range(len(embeddings)):
+        melhor_grupo, melhor_similaridade = None, limiar
+
+        for grupo in grupos:
+            if origens[indice] in origens[grupo]:
+                continue
+
+            similaridade = similaridades[indice, grupo].min()
+            if similaridade > melhor_similaridade:
+                melhor_grupo, melhor_similaridade = grupo, similaridade
+
+        if melhor_grupo is None:
+            grupos.append([indice])
+        else:
+            melhor_grupo.append(indice)
+
+    return normalizar_embeddings(np.stack([embeddings[grupo].mean(axis=0) for grupo in grupos]))
+
+
+def processar_imagens(imagens):
+    '''
+    Processa as fotos de uma mesma frequência (ImagemProcessada): detecção de cada foto (em paralelo com o serviço de inferência ativo)
+    e extração de características de todas as faces em um único lote. Retorna os embeddings (N, 512), as caixas (N, 4) e o índice
+    da foto de origem de cada face.
+    '''
+    if len(imagens) == 1:
+        embeddings, caixas = extrair_faces(imagens[0])
+        return embeddings, caixas, np.zeros(len(embeddings), dtype=np.int64)
+
+    import torch
+
+    # Só as fotos que não estão no cache de resultados passam pelas redes
+    resultados = [cache_resultados.obter(imagem.img_bytes) for imagem in imagens]
+    pendentes = [indice for indice, resultado in enumerate(resultados) if resultado is None]
+
+    if pendentes:
+        recortes = recortar_faces_das_imagens([imagens[indice] for indice in pendentes])
+        faces = torch.cat([faces_da_imagem for faces_da_imagem, _ in recortes])
+
+        if len(faces) == 0:
+            embeddings = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        elif servico_inferencia.ativo:
+            embeddings = servico_inferencia.submeter_faces(faces).result()
+        else:
+            embeddings = get_face_features(faces)
+
+        inicios = np.cumsum([0] + [len(caixas) for _, caixas in recortes])
+        for posicao, (indice, (_, caixas)) in enumerate(zip(pendentes, recortes)):
+            resultados[indice] = (embeddings[inicios[posicao]:inicios[posicao + 1]], caixas)
+            cache_resultados.adicionar(imagens[indice].img_bytes, *resultados[indice])
+
+    origens = np.repeat(np.arange(len(resultados)), [len(caixas) for _, caixas in resultados])
+    embeddings = np.concatenate([embeddings for embeddings, _ in resultados])
+    caixas = np.concatenate([caixas for _, caixas in resultados])
+
+    return embeddings, caixas, origens
+
+
+def _decodificar(imagem):
+    try:
+        imagem.imagem
+        return True
+    except (OSError, ValueError): # Arquivo truncado ou corrompido
+        return False
+
+
+def extrair_faces_unicas(imagens):
+    '''
+    Processa as fotos de cadastro (ImagemProcessada) de uma só vez: decodificação em paralelo, detecção de cada foto e extração de
+    características em um único lote apenas das fotos com exatamente uma face. Retorna, para cada foto, o número de faces detectadas
+    (None quando a foto não pôde ser decodificada) e o embedding (1, 512) das fotos com uma única face.
+    '''
+    resultados = [cache_resultados.obter(imagem.img_bytes) for imagem in imagens]
+    pendentes = [indice for indice, resultado in enumerate(resultados) if resultado is None]
+
+    # Com o serviço de inferência ativo as fotos são decodificadas pelos próprios processos de inferência
+    if pendentes and not servico_inferencia.ativo:
+        with ThreadPoolExecutor(max_workers=min(len(pendentes), os.cpu_count() or 1)) as executor:
+            decodificadas = list(executor.map(lambda indice: _decodificar(imagens[indice]), pendentes))
+        pendentes = [indice for indice, decodificada in zip(pendentes, decodificadas) if decodificada]
+
+    if pendentes:
+        import torch
+
+        # Fotos que só falham na decodificação dentro dos processos de inferência ficam sem resultado, como as que falham aqui
+        recortes = recortar_faces_das_imagens([imagens[indice] for indice in pendentes], ignorar_invalidas=True)
+        validos = [(posicao, recorte) for posicao, recorte in enumerate(recortes) if recorte is not None]
+
+        # Posição de cada foto com uma única face no lote enviado ao extrator
+        unicas = {posicao: indice_unica for indice_unica, posicao in enumerate(posicao for posicao, (_, caixas) in validos if len(caixas) == 1)}
+
+        embeddings = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        if unicas:
+            faces = torch.cat([recortes[posicao][0] for posicao in unicas])
+            embeddings = servico_inferencia.submeter_faces(faces).result() if servico_inferencia.ativo else get_face_features(faces)
+
+        for posicao, (_, caixas) in validos:
+            if len(caixas) == 1:
+                resultados[pendentes[posicao]] = (embeddings[unicas[posicao]:unicas[posicao] + 1], caixas)
+            elif len(caixas) == 0:
+                resultados[pendentes[posicao]] = (np.empty((0, EMBEDDING_DIM), dtype=np.float32), caixas)
+            else:
+                # As faces de fotos com várias pessoas não passam pelo extrator, então o resultado não vai para o cache
+                resultados[pendentes[posicao]] = (None, caixas)
+                continue
+
+            cache_resultados.adicionar(imagens[pendentes[posicao]].img_bytes, *resultados[pendentes[posicao]])
+
+    return [(None, None) if resultado is None else (len(resultado[1]), resultado[0] if len(resultado[1]) == 1 else None)
+            for resultado in resultados]
+
+
+def comparar_com_galeria(galeria, embeddings, origens, threshold=0.49):
+    '''
+    Compara as faces do dia com a galeria da turma, juntando antes as faces repetidas entre fotos diferentes.
+    Retorna o status de presença e a maior similaridade obtida por cada matrícula.
+    '''
+    if len(np.unique(origens)) > 1:
+        embeddings = deduplicar_faces(embeddings, origens)
+
+    # Uma única multiplicação pela matriz de templates da turma, qualquer que seja a quantidade de templates por aluno
+    return associar_faces(galeria.matriculas, galeria.similaridades(normalizar_embeddings(embeddings)), threshold)
+
+
 def cos_sim(a,b): 
     return np.dot(a, b)/(norm(a)*norm(b))
 
@@ -151,23 +624,434 @@ def obter_aluno_pela_matricula(lista_matricula):
     return AlunoSchema(many=True, only=('nome', 'matricula', 'curso')).dump(lista_de_alunos)
 
 
-def checar_presenca_da_turma(turma_codigo, img_turma):
-    
-    face_embeddings_do_dia = np.array(process_faces(img_turma))
+def obter_participantes_com_embedding(turma_codigo):
+    '''
+    Retorna o ID de participante, a matrícula e o embedding de todos os alunos da turma em uma única consulta
+    '''
+    return db.session.query(Participante.id, Participante.matricula, Aluno.embedding)\
+                     .join(Aluno, Aluno.matricula == Participante.matricula)\
+                     .filter(Participante.turma_codigo == turma_codigo)\
+                     .order_by(Participante.id)\
+                     .all()
+
+
+def obter_templates_dos_participantes(turma_codigo):
+    '''
+    Retorna os embeddings dos templates adicionais de cada participante da turma (indexados pelo ID de participante) em uma única consulta
+    '''
+    templates = {}
+
+    for participante_id, embedding in db.session.query(Participante.id, AlunoTemplate.embedding)\
+                                                .join(AlunoTemplate, AlunoTemplate.matricula == Participante.matricula)\
+                                                .filter(Participante.turma_codigo == turma_codigo)\
+                                                .order_by(AlunoTemplate.id):
+        templates.setdefault(participante_id, []).append(decodificar_embedding(embedding))
+
+    return templates
+
+
+def marcar_galerias_alteradas(turma_codigo=None, matricula=None):
+    '''
+    Incrementa, na transação atual, a versão da galeria da turma ou de todas as turmas em que o aluno participa. Deve ser chamada
+    antes das alterações (a exclusão de um aluno também remove as suas participações); o commit fica a cargo de quem chama.
+    '''
+    turmas = Turma.query.filter_by(codigo=turma_codigo) if turma_codigo is not None else \
+             Turma.query.filter(Turma.codigo.in_(db.session.query(Participante.turma_codigo).filter_by(matricula=matricula)))
+
+    turmas.update({Turma.versao_galeria: Turma.versao_galeria + 1}, synchronize_session=False)
+
+
+def obter_galeria_da_turma(turma_codigo):
+    '''
+    Retorna a galeria de embeddings normalizados dos participantes da turma, consultando o banco de dados somente quando ela não estiver
+    em cache ou quando a versão da turma mudou (alteração feita por este ou por outro processo do servidor)
+    '''
+    # A versão é lida antes da galeria: uma alteração confirmada durante a montagem deixa a galeria em cache com a versão anterior,
+    # e ela é descartada na próxima consulta
+    versao = db.session.query(Turma.versao_galeria).filter_by(codigo=turma_codigo).scalar()
+    galeria = cache_galerias.obter(turma_codigo, versao)
+
+    if galeria is not None:
+        return galeria
+
+    participantes = obter_participantes_com_embedding(turma_codigo)
+    templates_adicionais = obter_templates_dos_participantes(turma_codigo)
+
+    # Embedding do cadastro seguido dos templates adicionais de cada participante
+    templates = []
+    for participante in participantes:
+        embeddings = templates_adicionais.get(participante.id, [])
+        if participante.embedding is not None:
+            embeddings = [decodificar_embedding(participante.embedding)] + embeddings
+
+        # Participantes sem nenhum embedding ficam com um template nulo (similaridade 0) e nunca são reconhecidos
+        templates.append(normalizar_embeddings(embeddings) if embeddings else np.zeros((1, EMBEDDING_DIM), dtype=np.float32))
+
+    galeria = Galeria.de_templates(templates,
+                                   [participante.matricula for participante in participantes],
+                                   [participante.id for participante in participantes],
+                                   agregacao=obter_configuracao('GALLERY_TEMPLATE_AGGREGATION', GALLERY_TEMPLATE_AGGREGATION))
+
+    if versao is not None:
+        cache_galerias.adicionar(turma_codigo, galeria, limite_bytes=obter_configuracao('GALLERY_CACHE_MAX_BYTES', GALLERY_CACHE_MAX_BYTES), versao=versao)
+
+    return galeria
+
 
-    if len(face_embeddings_do_dia) < 1:
+def obter_embeddings_dos_alunos(matriculas=None):
+    '''
+    Retorna a matrícula de cada vetor e a matriz normalizada com os embeddings de cadastro e os templates adicionais de todos os alunos
+    (ou apenas das matrículas informadas)
+    '''
+    cadastros = db.session.query(Aluno.matricula, Aluno.embedding).filter(Aluno.embedding.isnot(None))
+    templates = db.session.query(AlunoTemplate.matricula, AlunoTemplate.embedding)
+
+    if matriculas is not None:
+        cadastros = cadastros.filter(Aluno.matricula.in_(matriculas))
+        templates = templates.filter(AlunoTemplate.matricula.in_(matriculas))
+
+    linhas = cadastros.all() + templates.all()
+
+    if not linhas:
+        return [], np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+    return [matricula for matricula, _ in linhas], normalizar_embeddings([decodificar_embedding(embedding) for _, embedding in linhas])
+
+
+def contar_embeddings_dos_alunos():
+    return Aluno.query.filter(Aluno.embedding.isnot(None)).count() + AlunoTemplate.query.count()
+
+
+def obter_indice_alunos():
+    '''
+    Retorna o índice de identificação com todos os alunos, lendo o arquivo salvo ou reconstruindo o índice a partir do banco quando necessário
+    '''
+    indice_alunos.preparar(obter_embeddings_dos_alunos, contar_embeddings_dos_alunos)
+    return indice_alunos
+
+
+def sincronizar_indice_alunos(matriculas, removidas=()):
+    '''
+    Repassa ao índice de identificação os vetores atuais (lidos do banco) das matrículas alteradas e remove as matrículas em 'removidas'.
+    Deve ser chamada após o commit das alterações.
+    '''
+    if not indice_alunos.ativo:
+        return # O índice será construído com os dados atuais na primeira identificação
+
+    matriculas = list(matriculas)
+
+    # Consultas em partes, como na verificação de matrículas do cadastro em lote
+    novas, vetores = [], [np.empty((0, EMBEDDING_DIM), dtype=np.float32)]
+    for inicio in range(0, len(matriculas), 500):
+        matriculas_da_parte, vetores_da_parte = obter_embeddings_dos_alunos(matriculas[inicio:inicio + 500])
+        novas.extend(matriculas_da_parte)
+        vetores.append(vetores_da_parte)
+
+    indice_alunos.atualizar(set(matriculas) | set(removidas), novas, np.concatenate(vetores), obter_embeddings_dos_alunos)
+
+
+def pares_semelhantes(matriz, limiar, tamanho_bloco=None):
+    '''
+    Retorna os índices (i, j), com i < j, e a similaridade de todos os pares de linhas da matriz normalizada com similaridade a partir do
+    limiar. A matriz de similaridades é calculada em blocos quadrados, sem nunca ocupar mais que tamanho_bloco² valores na memória.
+    '''
+    tamanho_bloco = tamanho_bloco or obter_configuracao('DUPLICATE_SCAN_BLOCK_SIZE', DUPLICATE_SCAN_BLOCK_SIZE)
+    linhas, colunas, similaridades = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+
+    for inicio_a in range(0, len(matriz), tamanho_bloco):
+        bloco_a = matriz[inicio_a:inicio_a + tamanho_bloco]
+
+        # Apenas os blocos acima da diagonal, já que a matriz de similaridades é simétrica
+        for inicio_b in range(inicio_a, len(matriz), tamanho_bloco):
+            bloco = bloco_a @ matriz[inicio_b:inicio_b + tamanho_bloco].T
+            semelhantes = bloco >= limiar
+
+            if inicio_b == inicio_a:
+                semelhantes = np.triu(semelhantes, k=1)
+
+            i, j = np.nonzero(semelhantes)
+            linhas.append(i + inicio_a)
+            colunas.append(j + inicio_b)
+            similaridades.append(bloco[i, j])
+
+    return np.concatenate(linhas), np.concatenate(colunas), np.concatenate(similaridades)
+
+
+def buscar_duplicatas(embeddings, matriculas=None):
+    '''
+    Retorna, para cada embedding de um novo cadastro, as matrículas e as similaridades dos alunos já cadastrados com face semelhante
+    (a partir de DUPLICATE_IDENTITY_THRESHOLD), consultando o índice de identificação. Quando as matrículas dos novos alunos são
+    informadas, os embeddings também são comparados entre si e cada um recebe os anteriores da lista com face semelhante.
+    '''
+    limiar = obter_configuracao('DUPLICATE_IDENTITY_THRESHOLD', DUPLICATE_IDENTITY_THRESHOLD)
+    normalizados = normalizar_embeddings(embeddings)
+    indice = obter_indice_alunos()
+
+    # As 5 matrículas mais similares bastam para identificar os cadastros repetidos
+    duplicatas = [[(matricula, similaridade) for matricula, similaridade in indice.buscar(embedding, 5) if similaridade >= limiar]
+                  for embedding in normalizados]
+
+    if matriculas is not None:
+        for i, j, similaridade in zip(*pares_semelhantes(normalizados, limiar)):
+            duplicatas[j].append((matriculas[i], float(similaridade)))
+
+    return duplicatas
+
+
+def registrar_suspeitas_de_duplicidade(matricula, duplicatas):
+    for matricula_semelhante, similaridade in duplicatas:
+        db.session.add(SuspeitaDuplicidade(matricula=matricula, matricula_semelhante=matricula_semelhante, similaridade=similaridade))
+
+
+def varrer_duplicatas(limiar=None):
+    '''
+    Compara todos os alunos entre si (embeddings de cadastro e templates), retornando os pares de matrículas diferentes com similaridade
+    a partir do limiar, da maior para a menor similaridade
+    '''
+    limiar = obter_configuracao('DUPLICATE_IDENTITY_THRESHOLD', DUPLICATE_IDENTITY_THRESHOLD) if limiar is None else limiar
+    matriculas, matriz = obter_embeddings_dos_alunos()
+
+    # Maior similaridade entre os vetores de cada par de alunos
+    pares = {}
+    for i, j, similaridade in zip(*pares_semelhantes(matriz, limiar)):
+        if matriculas[i] != matriculas[j]:
+            par = tuple(sorted((matriculas[i], matriculas[j])))
+            pares[par] = max(float(similaridade), pares.get(par, -1.0))
+
+    return sorted(((matricula, matricula_semelhante, similaridade) for (matricula, matricula_semelhante), similaridade in pares.items()),
+                  key=lambda par: -par[2])
+
+
+def reconhecer_faces_do_dia(img_turma):
+    '''
+    Detecta e extrai as faces de uma ou mais fotos da turma (bytes ou ImagemProcessada), retornando os embeddings, as caixas e a foto de origem de cada face
+    '''
+    imagens = img_turma if isinstance(img_turma, (list, tuple)) else [img_turma]
+    embeddings, caixas, origens = processar_imagens([abrir_imagem(imagem) for imagem in imagens])
+
+    if len(embeddings) < 1:
             abort(400, 'Não foram detectadas faces na imagem enviada.')
 
-    # Obtenção da matricula dos participantes
-    alunos_participantes = Participante.query.filter_by(turma_codigo=turma_codigo)
-    matricula_participantes = [aluno.matricula for aluno in alunos_participantes.all()]
+    return embeddings, caixas, origens
+
 
-    # Obtencao dos embeddings dos participantes
-    embedding_participantes = [Aluno.query.filter_by(matricula=matricula).all()[0].embedding for matricula in matricula_participantes]
-    embedding_participantes = [np.load(io.BytesIO(data)) for data in embedding_participantes]
+def checar_presenca_da_turma(turma_codigo, img_turma, galeria=None):
+    
+    face_embeddings_do_dia, _, origens = reconhecer_faces_do_dia(img_turma)
+
+    if galeria is None:
+        galeria = obter_galeria_da_turma(turma_codigo)
     
     # Similaridade tem que ser acima de 49%
-    return obter_presenca(matricula_participantes, embedding_participantes, face_embeddings_do_dia, threshold=0.49)
+    return comparar_com_galeria(galeria, face_embeddings_do_dia, origens, threshold=0.49)
+
+def registrar_presencas(frequencia_id, galeria, status_presenca, similaridades=None):
+    '''
+    Insere de uma só vez o registro de presença de todos os participantes da galeria, junto com a maior similaridade obtida por cada um
+    (o commit fica a cargo de quem chama)
+    '''
+    db.session.bulk_insert_mappings(Presenca, [dict(frequencia_id=frequencia_id,
+                                                    participante_id=int(participante_id),
+                                                    status=status_presenca[matricula],
+                                                    similaridade=similaridades[matricula] if similaridades else None)
+                                               for matricula, participante_id in zip(galeria.matriculas, galeria.participante_ids)])
+
+
+def registrar_faces(frequencia_id, embeddings, caixas, origens):
+    '''
+    Armazena o embedding compacto, a caixa e a foto de origem de cada face detectada na frequência, permitindo refazer a comparação
+    sem executar as redes novamente (o commit fica a cargo de quem chama)
+    '''
+    db.session.bulk_insert_mappings(FaceFrequencia, [dict(frequencia_id=frequencia_id,
+                                                          imagem=int(origem),
+                                                          x1=float(caixa[0]), y1=float(caixa[1]), x2=float(caixa[2]), y2=float(caixa[3]),
+                                                          embedding=serializar_embedding(embedding))
+                                                     for embedding, caixa, origem in zip(embeddings, caixas, origens)])
+
+
+def obter_faces_da_frequencia(frequencia_id):
+    '''
+    Retorna os embeddings (N, 512) e a foto de origem das faces armazenadas para a frequência
+    '''
+    faces = db.session.query(FaceFrequencia.embedding, FaceFrequencia.imagem).filter_by(frequencia_id=frequencia_id).order_by(FaceFrequencia.id).all()
+
+    if not faces:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32), np.empty(0, dtype=np.int64)
+
+    return np.concatenate([decodificar_embedding(face.embedding) for face in faces]), np.array([face.imagem for face in faces], dtype=np.int64)
+
+
+def abrir_imagens_da_frequencia(img_bytes):
+    '''
+    Cria o contexto de cada foto enviada para uma frequência; apenas a primeira tem a miniatura armazenada
+    '''
+    lista_de_imagens = img_bytes if isinstance(img_bytes, (list, tuple)) else [img_bytes]
+    return [ImagemProcessada(imagem, com_miniatura=(indice == 0)) for indice, imagem in enumerate(lista_de_imagens)]
+
+
+def registrar_frequencia(turma_codigo, img_bytes):
+    '''
+    Executa o reconhecimento facial na imagem (ou lista de imagens) da turma e registra uma única frequência com a presença de cada participante,
+    retornando o ID da frequência
+    '''
+    imagens = abrir_imagens_da_frequencia(img_bytes)
+
+    galeria = obter_galeria_da_turma(turma_codigo)
+
+    embeddings, caixas, origens = reconhecer_faces_do_dia(imagens)
+    alunos_presenca_status, similaridades = comparar_com_galeria(galeria, embeddings, origens)
+
+    frequencia_do_dia = Frequencia(turma_codigo=turma_codigo, imagem_turma=imagens[0].miniatura())
+    
+    db.session.add(frequencia_do_dia)
+    db.session.flush() # Obtém o ID da frequência sem encerrar a transação
+
+    registrar_presencas(frequencia_do_dia.id, galeria, alunos_presenca_status, similaridades)
+    registrar_faces(frequencia_do_dia.id, embeddings, caixas, origens)
+    
+    db.session.add(AnotacaoErros(frequencia_id=frequencia_do_dia.id, falsos_positivos=0, falsos_negativos=0)) # Criando instância para registro dos erros das frequências
+    db.session.commit()
+
+    return frequencia_do_dia.id
+
+
+def adicionar_imagens_a_frequencia(turma_codigo, frequencia_id, img_bytes):
+    '''
+    Processa apenas a(s) nova(s) foto(s) de uma frequência já registrada e marca como presentes os participantes que estavam ausentes
+    e foram reconhecidos, sem alterar as demais presenças nem as anotações de erros. Retorna as matrículas atualizadas.
+    '''
+    lista_de_imagens = img_bytes if isinstance(img_bytes, (list, tuple)) else [img_bytes]
+
+    galeria = obter_galeria_da_turma(turma_codigo)
+
+    embeddings, caixas, origens = reconhecer_faces_do_dia([ImagemProcessada(imagem) for imagem in lista_de_imagens])
+
+    # Todos os participantes entram na atribuição, para que faces de quem já estava presente não sejam associadas a um ausente
+    alunos_presenca_status, similaridades = comparar_com_galeria(galeria, embeddings, origens)
+
+    ausentes = {participante_id for (participante_id,) in db.session.query(Presenca.participante_id).filter_by(frequencia_id=frequencia_id, status=False)}
+
+    novos_presentes = {int(participante_id): matricula for matricula, participante_id in zip(galeria.matriculas, galeria.participante_ids)
+                       if alunos_presenca_status[matricula] and int(participante_id) in ausentes}
+
+    if novos_presentes:
+        tabela_presenca = Presenca.__table__
+        db.session.execute(tabela_presenca.update()
+                                          .where((tabela_presenca.c.frequencia_id == frequencia_id) & (tabela_presenca.c.participante_id == db.bindparam('_participante_id')))
+                                          .values(status=True, similaridade=db.bindparam('similaridade')),
+                           [{'_participante_id': participante_id, 'similaridade': similaridades[matricula]} for participante_id, matricula in novos_presentes.items()])
+
+    # As faces das novas fotos continuam a numeração das fotos já armazenadas
+    ultima_imagem = db.session.query(db.func.max(FaceFrequencia.imagem)).filter_by(frequencia_id=frequencia_id).scalar()
+    registrar_faces(frequencia_id, embeddings, caixas, origens + (0 if ultima_imagem is None else ultima_imagem + 1))
+
+    db.session.commit()
+
+    return sorted(novos_presentes.values())
+
+
+def recomparar_frequencia(turma_codigo, frequencia_id, threshold=0.49):
+    '''
+    Refaz o registro de presença de uma frequência a partir das faces armazenadas e da galeria atual da turma, sem executar as redes
+    (permite usar outro threshold ou incluir alunos matriculados depois do registro)
+    '''
+    embeddings, origens = obter_faces_da_frequencia(frequencia_id)
+
+    if len(embeddings) < 1:
+        abort(400, 'Não existem faces armazenadas para essa frequencia.')
+
+    galeria = obter_galeria_da_turma(turma_codigo)
+
+    alunos_presenca_status, similaridades = comparar_com_galeria(galeria, embeddings, origens, threshold=threshold)
+
+    Presenca.query.filter_by(frequencia_id=frequencia_id).delete()
+    registrar_presencas(frequencia_id, galeria, alunos_presenca_status, similaridades)
+
+    # O novo resultado reinicia a contagem de erros, como na atualização da frequência
+    AnotacaoErros.query.filter_by(frequencia_id=frequencia_id).delete()
+    db.session.add(AnotacaoErros(frequencia_id=frequencia_id, falsos_positivos=0, falsos_negativos=0))
+
+    db.session.commit()
+
+
+def cadastrar_alunos(entradas):
+    '''
+    Cadastra vários alunos em uma única transação. Cada entrada é um dicionário com 'matricula', 'nome', 'curso' e 'ler_imagem'
+    (função que retorna os bytes da foto, ou None quando ela não existe, chamada apenas quando a foto for processada).
+    Retorna o status de cada entrada: 'ok', 'dados_invalidos', 'matricula_duplicada', 'imagem_invalida', 'sem_face', 'varias_faces'
+    ou 'possivel_duplicata' (face semelhante à de outro aluno, quando DUPLICATE_IDENTITY_ACTION é 'rejeitar').
+    '''
+    status = [None] * len(entradas)
+
+    # Matrículas já cadastradas e repetidas no próprio lote são descartadas antes de qualquer processamento das fotos
+    matriculas = [entrada.get('matricula') for entrada in entradas]
+    existentes = set()
+    for inicio in range(0, len(matriculas), 500):
+        existentes.update(matricula for (matricula,) in db.session.query(Aluno.matricula).filter(Aluno.matricula.in_(matriculas[inicio:inicio + 500])))
+
+    pendentes = []
+    for indice, entrada in enumerate(entradas):
+        if not all(entrada.get(campo) for campo in ('matricula', 'nome', 'curso')):
+            status[indice] = 'dados_invalidos'
+        elif entrada['matricula'] in existentes:
+            status[indice] = 'matricula_duplicada'
+        else:
+            existentes.add(entrada['matricula'])
+            pendentes.append(indice)
+
+    # As fotos são lidas e decodificadas por partes, limitando a memória ocupada por lotes grandes
+    tamanho_lote = obter_configuracao('ENROLLMENT_CHUNK_SIZE', ENROLLMENT_CHUNK_SIZE)
+    alunos, indices, embeddings = [], [], []
+
+    for inicio in range(0, len(pendentes), tamanho_lote):
+        lote = []
+        for indice in pendentes[inicio:inicio + tamanho_lote]:
+            status[indice] = 'imagem_invalida' # Substituído pelo resultado da detecção quando a foto puder ser decodificada
+
+            img_bytes = entradas[indice]['ler_imagem']()
+            if not img_bytes:
+                continue
+
+            try:
+                lote.append((indice, ImagemProcessada(img_bytes)))
+            except (OSError, ValueError): # Formato de imagem não reconhecido
+                continue
+
+        for (indice, _), (quantidade_faces, embedding) in zip(lote, extrair_faces_unicas([imagem for _, imagem in lote])):
+            if quantidade_faces is None:
+                continue
+
+            if quantidade_faces != 1:
+                status[indice] = 'sem_face' if quantidade_faces == 0 else 'varias_faces'
+                continue
+
+            alunos.append(dict(matricula=entradas[indice]['matricula'], nome=entradas[indice]['nome'], curso=entradas[indice]['curso'],
+                               embedding=serializar_embedding(embedding)))
+            indices.append(indice)
+            embeddings.append(embedding)
+            status[indice] = 'ok'
+
+    # Faces semelhantes às de alunos já cadastrados ou às de alunos anteriores do próprio lote
+    acao = obter_configuracao('DUPLICATE_IDENTITY_ACTION', DUPLICATE_IDENTITY_ACTION)
+    duplicatas = buscar_duplicatas(embeddings, [aluno['matricula'] for aluno in alunos]) if alunos and acao != 'desativado' else [[]] * len(alunos)
+
+    if acao == 'rejeitar':
+        for indice, duplicatas_do_aluno in zip(indices, duplicatas):
+            if duplicatas_do_aluno:
+                status[indice] = 'possivel_duplicata'
+
+        alunos = [aluno for indice, aluno in zip(indices, alunos) if status[indice] == 'ok']
+
+    db.session.bulk_insert_mappings(Aluno, alunos)
+
+    if acao == 'sinalizar':
+        for aluno, duplicatas_do_aluno in zip(alunos, duplicatas):
+            registrar_suspeitas_de_duplicidade(aluno['matricula'], duplicatas_do_aluno)
+
+    db.session.commit()
+
+    return status
+
 
 def clear_parser(dictionary):
     '''
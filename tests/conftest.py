@@ -2,6 +2,8 @@ import pytest
 import os, sys
 sys.path.append('./')
 from core.run import create_app
+from core.galeria import cache_galerias
+from core.indice_alunos import indice_alunos
 from flask_jwt_extended import create_access_token
 
 @pytest.fixture(scope='session', autouse=True)
@@ -25,6 +27,8 @@ def clear_data(_db):
     for table in reversed(meta.sorted_tables):
         _db.session.execute(table.delete())
     _db.session.commit()
+    cache_galerias.limpar()
+    indice_alunos.limpar()
 
 #@pytest.fixture(scope='session', autouse=True)
 def headers():
@@ -4,9 +4,14 @@
 
 # Alunos
 from conftest import clear_data
-from core.models import Aluno
-from core.utils import from_img_dir_to_bytes
+from core.indice_alunos import indice_alunos
+from core.models import Aluno, AlunoTemplate, Professor, Turma, Participante
+from core.utils import from_img_dir_to_bytes, process_faces, decodificar_embedding, serializar_embedding, obter_galeria_da_turma
 import os 
+import pytest
+import io
+import zipfile
+import numpy as np
 
 class Teste_Alunos:
     def test_get(self, get_client_db):
@@ -92,10 +97,259 @@ class Teste_Alunos:
         assert response.status_code == 400
         assert response.json['message'] == 'Já existe aluno com essa matrícula.'
 
+        # CENÁRIO 4 - Repetição com 'Idempotency-Key' recebe a resposta do primeiro registro
+        data = {
+            "nome": "Claudia",
+            "curso": "Dança",
+            "matricula": "202020",
+            "imagem_aluno": (os.path.join("./tests/test_images/claudia.jpg"), './tests/test_images/claudia.jpg')
+        }
+        idempotente = dict(headers, **{'Idempotency-Key': 'cadastro-claudia'})
+
+        response = client.post('/alunos/', data=data, content_type='multipart/form-data', headers=idempotente)
+        assert response.status_code == 201
+
+        response = client.post('/alunos/', data=data, content_type='multipart/form-data', headers=idempotente)
+
+        assert response.status_code == 201
+        assert response.json == {'aluno.matricula': '202020'}
+
         # CLEAN UP
         clear_data(_db)
 
 
+    def test_post_lote(self, get_client_db):
+        # POST na rota de cadastro em lote
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Aluno(nome='Ivete', curso='Danca', matricula='101010'))
+        _db.session.commit()
+
+        # CENÁRIO 1 - Arquivo zip com o resultado de cada aluno
+        conteudo = io.BytesIO()
+        with zipfile.ZipFile(conteudo, 'w') as arquivo_zip:
+            arquivo_zip.writestr('alunos.csv', 'matricula,nome,curso,imagem\n'
+                                               '101010,Ivete,Danca,fotos/ivete.jpg\n'
+                                               '202020,Claudia,Danca,fotos/claudia.jpg\n'
+                                               '303030,Porta,Danca,fotos/door.jpg\n'
+                                               '404040,Fitdance,Danca,fotos/fitdance-3faces.jpg\n'
+                                               '505050,Sem Foto,Danca,fotos/inexistente.jpg\n'
+                                               '202020,Claudia,Danca,fotos/claudia.jpg\n'
+                                               '606060,,Danca,fotos/claudia.jpg\n')
+            for imagem in ['ivete.jpg', 'claudia.jpg', 'door.jpg', 'fitdance-3faces.jpg']:
+                arquivo_zip.write(f'./tests/test_images/{imagem}', f'fotos/{imagem}')
+        conteudo.seek(0)
+
+        response = client.post('/alunos/lote/', data={'arquivo': (conteudo, 'alunos.zip')}, content_type='multipart/form-data', headers=headers)
+
+        assert response.status_code == 200
+        assert response.json['registrados'] == 1
+        assert [aluno['status'] for aluno in response.json['alunos']] == ['matricula_duplicada', 'ok', 'sem_face', 'varias_faces',
+                                                                          'imagem_invalida', 'matricula_duplicada', 'dados_invalidos']
+
+        claudia = Aluno.query.filter_by(matricula='202020').first()
+        embedding = process_faces(from_img_dir_to_bytes('./tests/test_images/claudia.jpg'))
+        assert claudia.nome == 'Claudia'
+        assert (decodificar_embedding(claudia.embedding) @ embedding.T / np.linalg.norm(embedding)).item() > 0.999
+
+        # CENÁRIO 2 - Listas de campos no formulário
+        data = {
+            "matricula": ["707070", "808080"],
+            "nome": ["Ivete", "Claudia"],
+            "curso": ["Dança", "Dança"],
+            "imagem_aluno": [(os.path.join("./tests/test_images/ivete.jpg"), 'ivete.jpg'),
+                             (os.path.join("./tests/test_images/claudia.jpg"), 'claudia.jpg')]
+        }
+
+        response = client.post('/alunos/lote/', data=data, content_type='multipart/form-data', headers=headers)
+
+        assert response.status_code == 200
+        assert response.json == {'registrados': 2, 'alunos': [{'matricula': '707070', 'status': 'ok'}, {'matricula': '808080', 'status': 'ok'}]}
+        assert Aluno.query.count() == 4
+
+        # CENÁRIO 3 - Quantidades diferentes de valores nos campos
+        data = {"matricula": ["909090"], "nome": ["Ivete"], "curso": ["Dança"]}
+
+        response = client.post('/alunos/lote/', data=data, content_type='multipart/form-data', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Os campos matricula, nome, curso e imagem_aluno devem ter a mesma quantidade de valores.'
+
+        # CENÁRIO 4 - Arquivo que não é zip
+        data = {'arquivo': (os.path.join("./tests/test_images/ivete.jpg"), 'alunos.zip')}
+
+        response = client.post('/alunos/lote/', data=data, content_type='multipart/form-data', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'O arquivo enviado não é um zip válido.'
+
+        # CLEAN UP
+        clear_data(_db)
+
+    def test_templates(self, get_client_db):
+        # Rotas de templates adicionais
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        _db.session.add(Aluno(nome='Ivete', curso='Danca', matricula='101010',
+                              embedding=serializar_embedding(process_faces(from_img_dir_to_bytes('./tests/test_images/ivete.jpg')))))
+        _db.session.add(Participante(turma_codigo='SCC5900', matricula='101010'))
+        _db.session.commit()
+
+        # CENÁRIO 1 - Aluno inexistente
+        data = {"imagem_aluno": (os.path.join("./tests/test_images/claudia.jpg"), './tests/test_images/claudia.jpg')}
+
+        response = client.post('/alunos/202020/templates/', data=data, content_type='multipart/form-data', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Não existe aluno com essa matricula no banco de dados.'
+
+        # CENÁRIO 2 - Imagem sem rosto
+        data = {"imagem_aluno": (os.path.join("./tests/test_images/door.jpg"), './tests/test_images/door.jpg')}
+
+        response = client.post('/alunos/101010/templates/', data=data, content_type='multipart/form-data', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Foram detectadas nenhuma ou mais de uma face na imagem enviada.'
+
+        # CENÁRIO 3 - OK, com o template incluído na galeria da turma
+        assert obter_galeria_da_turma('SCC5900').matriz.shape == (1, 512)
+
+        data = {"imagem_aluno": (os.path.join("./tests/test_images/claudia.jpg"), './tests/test_images/claudia.jpg')}
+
+        response = client.post('/alunos/101010/templates/', data=data, content_type='multipart/form-data', headers=headers)
+        template_id = response.json['template.id']
+
+        assert response.status_code == 201
+        assert [template['id'] for template in client.get('/alunos/101010/templates/', headers=headers).json] == [template_id]
+        assert obter_galeria_da_turma('SCC5900').matriz.shape == (2, 512)
+
+        # CENÁRIO 4 - Quantidade máxima de templates
+        client.application.config['STUDENT_MAX_TEMPLATES'] = 1
+        try:
+            response = client.post('/alunos/101010/templates/', data=data, content_type='multipart/form-data', headers=headers)
+        finally:
+            client.application.config['STUDENT_MAX_TEMPLATES'] = 10
+
+        assert response.status_code == 400
+        assert response.json['message'] == 'O aluno já possui a quantidade máxima de templates.'
+
+        # CENÁRIO 5 - Remoção do template
+        response = client.delete(f'/alunos/101010/templates/{template_id}/', headers=headers)
+        assert response.status_code == 204
+        assert AlunoTemplate.query.count() == 0
+        assert obter_galeria_da_turma('SCC5900').matriz.shape == (1, 512)
+
+        response = client.delete(f'/alunos/101010/templates/{template_id}/', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Não existe template com esse ID para esse aluno.'
+
+        # CLEAN UP
+        clear_data(_db)
+
+    def test_identificar(self, get_client_db, tmp_path):
+        # Identificação entre todos os alunos
+        client, _db, headers = get_client_db
+        clear_data(_db)
+        indice_alunos.configurar(str(tmp_path / 'indice.npz'))
+
+        try:
+            for matricula, nome in (('101010', 'ivete'), ('202020', 'claudia')):
+                data = {"nome": nome, "curso": "Danca", "matricula": matricula,
+                        "imagem_aluno": (os.path.join(f"./tests/test_images/{nome}.jpg"), f'./tests/test_images/{nome}.jpg')}
+                assert client.post('/alunos/', data=data, content_type='multipart/form-data', headers=headers).status_code == 201
+
+            # CENÁRIO 1 - Imagem sem rosto e quantidade inválida de resultados
+            data = {"imagem_aluno": (os.path.join("./tests/test_images/door.jpg"), './tests/test_images/door.jpg')}
+
+            response = client.post('/alunos/identificar/', data=data, content_type='multipart/form-data', headers=headers)
+            assert response.status_code == 400
+            assert response.json['message'] == 'Não foram detectadas faces na imagem enviada.'
+
+            data = {"imagem_aluno": (os.path.join("./tests/test_images/ivete.jpg"), './tests/test_images/ivete.jpg'), "k": 0}
+
+            response = client.post('/alunos/identificar/', data=data, content_type='multipart/form-data', headers=headers)
+            assert response.status_code == 400
+            assert response.json['message'] == 'O valor de k deve estar entre 1 e 50.'
+
+            # CENÁRIO 2 - OK, com o índice salvo em disco
+            data = {"imagem_aluno": (os.path.join("./tests/test_images/ivete.jpg"), './tests/test_images/ivete.jpg'), "k": 5}
+
+            response = client.post('/alunos/identificar/', data=data, content_type='multipart/form-data', headers=headers)
+            resultados = response.json['resultados']
+
+            assert response.status_code == 200
+            assert [resultado['matricula'] for resultado in resultados] == ['101010', '202020']
+            assert resultados[0]['similaridade'] == pytest.approx(1.0, abs=1e-4)
+            assert os.path.exists(tmp_path / 'indice.npz')
+
+            # CENÁRIO 3 - Alterações nos alunos repassadas ao índice
+            data = {"matricula": "303030", "imagem_aluno": (os.path.join("./tests/test_images/vinicius.png"), './tests/test_images/vinicius.png')}
+            assert client.put('/alunos/202020/', data=data, headers=headers).status_code == 204
+            assert client.delete('/alunos/101010/', headers=headers).status_code == 204
+
+            data = {"imagem_aluno": (os.path.join("./tests/test_images/vinicius.png"), './tests/test_images/vinicius.png')}
+
+            response = client.post('/alunos/identificar/', data=data, content_type='multipart/form-data', headers=headers)
+            resultados = response.json['resultados']
+
+            assert [resultado['matricula'] for resultado in resultados] == ['303030']
+            assert resultados[0]['similaridade'] == pytest.approx(1.0, abs=1e-4)
+            assert len(indice_alunos) == 1
+        finally:
+            indice_alunos.configurar()
+
+        # CLEAN UP
+        clear_data(_db)
+
+    def test_duplicatas(self, get_client_db):
+        # Cadastros da mesma pessoa com matrículas diferentes
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        def dados(matricula):
+            return {"nome": "Ivete", "curso": "Danca", "matricula": matricula,
+                    "imagem_aluno": (os.path.join("./tests/test_images/ivete.jpg"), './tests/test_images/ivete.jpg')}
+
+        assert client.post('/alunos/', data=dados('101010'), content_type='multipart/form-data', headers=headers).status_code == 201
+
+        # CENÁRIO 1 - Cadastros rejeitados, individual e em lote
+        client.application.config['DUPLICATE_IDENTITY_ACTION'] = 'rejeitar'
+        try:
+            response = client.post('/alunos/', data=dados('202020'), content_type='multipart/form-data', headers=headers)
+            assert response.status_code == 400
+            assert response.json['message'] == 'A face enviada é semelhante à de um aluno já cadastrado.'
+
+            response = client.post('/alunos/lote/', data=dados('303030'), content_type='multipart/form-data', headers=headers)
+            assert response.json == {'registrados': 0, 'alunos': [{'matricula': '303030', 'status': 'possivel_duplicata'}]}
+        finally:
+            client.application.config['DUPLICATE_IDENTITY_ACTION'] = 'sinalizar'
+
+        assert Aluno.query.count() == 1
+
+        # CENÁRIO 2 - Cadastro sinalizado
+        response = client.post('/alunos/', data=dados('202020'), content_type='multipart/form-data', headers=headers)
+        suspeitas = client.get('/alunos/duplicatas/', headers=headers).json
+
+        assert response.status_code == 201
+        assert [(suspeita['matricula'], suspeita['matricula_semelhante']) for suspeita in suspeitas] == [('202020', '101010')]
+        assert suspeitas[0]['similaridade'] == pytest.approx(1.0, abs=1e-4)
+
+        # CENÁRIO 3 - Varredura completa
+        response = client.get('/alunos/duplicatas/varredura/', headers=headers)
+
+        assert response.status_code == 200
+        assert [(par['matricula'], par['matricula_semelhante']) for par in response.json] == [('101010', '202020')]
+
+        response = client.get('/alunos/duplicatas/varredura/?threshold=1', headers=headers)
+        assert response.status_code == 200
+
+        response = client.get('/alunos/duplicatas/varredura/?threshold=1.5', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'O threshold deve estar entre 0 e 1.'
+
+        # CLEAN UP
+        clear_data(_db)
+
     def test_put(self, get_client_db):
         # PUT
         client, _db, headers = get_client_db
@@ -3,13 +3,29 @@
 '''
 
 # Frequencias
-from core.models import Professor, Turma, Aluno, Participante, Frequencia
+from core.models import Professor, Turma, Aluno, Participante, Frequencia, Presenca, AnotacaoErros, FaceFrequencia, JobFrequencia, ImagemJobFrequencia, RequisicaoIdempotente
+from core.jobs import executor_de_jobs
 from core.utils import from_img_dir_to_bytes
 from conftest import clear_data
 import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from numpy import array
 from core.utils import process_faces, from_array_to_bytes
 
+def aguardar_job(client, headers, job_id, timeout=60):
+    inicio = time.time()
+    while time.time() - inicio < timeout:
+        job = client.get(f'/turmas/SCC5900/frequencias/jobs/{job_id}/', headers=headers).json
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.1)
+    return job
+
 class Teste_Frequencias:
     def test_get(self, get_client_db):
         # GET
@@ -88,7 +104,324 @@ class Teste_Frequencias:
         # CLEAN UP
         clear_data(_db)
 
+
+    def test_post_varias_imagens(self, get_client_db):
+        # POST com mais de uma foto da mesma aula
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        mock_img = from_img_dir_to_bytes('./tests/test_images/ivete.jpg')
+        mock_face = array(process_faces(mock_img))
+        mock_face_embedding = from_array_to_bytes(mock_face)
+        _db.session.add(Aluno(nome='Ivete', curso='Danca', matricula='101010', embedding=mock_face_embedding))
+        _db.session.add(Participante(turma_codigo='SCC5900', matricula='101010'))
+        _db.session.commit()
+
+        fotos = ['./tests/test_images/ivete-e-boy.jpg', './tests/test_images/fitdance-3faces.jpg', './tests/test_images/door.jpg']
+
+        # CENÁRIO 1 - Mais fotos do que o permitido
+        data = {"imagem_turma": [(foto, foto) for foto in fotos * 2]}
+
+        response = client.post('/turmas/SCC5900/frequencias/', data=data, headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Foram enviadas mais imagens do que o permitido.'
+
+        # CENÁRIO 2 - OK (uma das fotos não tem faces)
+        data = {"imagem_turma": [(foto, foto) for foto in fotos]}
+
+        response = client.post('/turmas/SCC5900/frequencias/', data=data, headers=headers)
+        assert response.status_code == 201
+        assert Frequencia.query.count() == 1
+        assert Presenca.query.filter_by(frequencia_id=response.json['frequencia.id']).count() == 1
+
+        # CENÁRIO 3 - Assíncrono com várias fotos
+        data = {"imagem_turma": [(foto, foto) for foto in fotos[:2]]}
+
+        response = client.post('/turmas/SCC5900/frequencias/?assincrono=true', data=data, headers=headers)
+        assert response.status_code == 202
+
+        job = aguardar_job(client, headers, response.json['job.id'])
+        assert job['status'] == 'done'
+        assert Frequencia.query.count() == 2
+
+        # CLEAN UP
+        clear_data(_db)
+
+    def test_post_imagens_adicionais(self, get_client_db):
+        # POST de fotos adicionais para uma frequência já registrada
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        file = os.path.join("./tests/test_images/ivete-e-boy.jpg")
+        data = {"imagem_turma": (file, './tests/test_images/ivete-e-boy.jpg')}
+
+        # CENÁRIO 1 - Tentativa com turma não registrada
+        response = client.post('/turmas/SCC5900/frequencias/1/imagens/', data=data, headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Não existe turma com esse codigo no banco de dados.'
+
+        # CENÁRIO 2 - Tentativa com frequência não registrada
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        _db.session.commit()
+
+        response = client.post('/turmas/SCC5900/frequencias/1/imagens/', data=data, headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Não existe frequencia com esse ID no banco de dados.'
+
+        # CENÁRIO 3 - OK: a aluna ausente passa a presente e o restante da frequência é mantido
+        for nome, matricula, foto in [('Ivete', '101010', 'ivete.jpg'), ('Claudia', '202020', 'claudia.jpg')]:
+            mock_face = array(process_faces(from_img_dir_to_bytes(f'./tests/test_images/{foto}')))
+            _db.session.add(Aluno(nome=nome, curso='Danca', matricula=matricula, embedding=from_array_to_bytes(mock_face)))
+            _db.session.add(Participante(turma_codigo='SCC5900', matricula=matricula))
+        _db.session.add(Frequencia(turma_codigo='SCC5900', imagem_turma=from_img_dir_to_bytes('./tests/test_images/claudia.jpg')))
+        _db.session.add(Presenca(frequencia_id=1, participante_id=1, status=False))
+        _db.session.add(Presenca(frequencia_id=1, participante_id=2, status=True))
+        _db.session.add(AnotacaoErros(frequencia_id=1, falsos_positivos=0, falsos_negativos=1))
+        _db.session.commit()
+
+        response = client.post('/turmas/SCC5900/frequencias/1/imagens/', data=data, headers=headers)
+        assert response.status_code == 200
+        assert response.json['matriculas'] == ['101010']
+        assert Presenca.query.filter_by(frequencia_id=1, participante_id=1).first().status == True
+        assert Presenca.query.filter_by(frequencia_id=1, participante_id=2).first().status == True
+        assert AnotacaoErros.query.filter_by(frequencia_id=1).first().falsos_negativos == 1
+
+        # CLEAN UP
+        clear_data(_db)
+
+    def test_rematch(self, get_client_db):
+        # POST na rota de rematch
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        for nome, matricula, foto in [('Ivete', '101010', 'ivete.jpg'), ('Claudia', '202020', 'claudia.jpg')]:
+            mock_face = array(process_faces(from_img_dir_to_bytes(f'./tests/test_images/{foto}')))
+            _db.session.add(Aluno(nome=nome, curso='Danca', matricula=matricula, embedding=from_array_to_bytes(mock_face)))
+        _db.session.add(Participante(turma_codigo='SCC5900', matricula='101010'))
+        _db.session.add(Frequencia(turma_codigo='SCC5900', imagem_turma=from_img_dir_to_bytes('./tests/test_images/claudia.jpg')))
+        _db.session.commit()
+
+        # CENÁRIO 1 - Frequência registrada sem faces armazenadas
+        response = client.post('/turmas/SCC5900/frequencias/1/rematch/', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Não existem faces armazenadas para essa frequencia.'
+
+        # CENÁRIO 2 - Threshold inválido
+        response = client.post('/turmas/SCC5900/frequencias/1/rematch/?threshold=1.5', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'O threshold deve estar entre 0 e 1.'
+
+        # CENÁRIO 3 - O registro da frequência armazena as faces e a similaridade de cada presença
+        file = os.path.join("./tests/test_images/ivete-e-boy.jpg")
+        data = {"imagem_turma": (file, './tests/test_images/ivete-e-boy.jpg')}
+
+        frequencia_id = client.post('/turmas/SCC5900/frequencias/', data=data, headers=headers).json['frequencia.id']
+        similaridade = Presenca.query.filter_by(frequencia_id=frequencia_id).first().similaridade
+
+        assert FaceFrequencia.query.filter_by(frequencia_id=frequencia_id).count() > 0
+        assert similaridade is not None
+
+        # CENÁRIO 4 - Threshold acima e abaixo da similaridade armazenada
+        response = client.post(f'/turmas/SCC5900/frequencias/{frequencia_id}/rematch/?threshold={(similaridade + 1) / 2}', headers=headers)
+        assert response.status_code == 204
+        assert Presenca.query.filter_by(frequencia_id=frequencia_id).first().status == False
+
+        response = client.post(f'/turmas/SCC5900/frequencias/{frequencia_id}/rematch/?threshold=1', headers=headers)
+        assert response.status_code == 204
+        assert Presenca.query.filter_by(frequencia_id=frequencia_id).first().status == False
+
+        response = client.post(f'/turmas/SCC5900/frequencias/{frequencia_id}/rematch/?threshold={similaridade / 2}', headers=headers)
+        assert response.status_code == 204
+        assert Presenca.query.filter_by(frequencia_id=frequencia_id).first().status == True
+
+        # CENÁRIO 5 - Aluna matriculada depois do registro da frequência
+        client.post('/turmas/SCC5900/participantes/', json={'matricula': '202020'}, headers=headers)
+
+        response = client.post(f'/turmas/SCC5900/frequencias/{frequencia_id}/rematch/', headers=headers)
+        assert response.status_code == 204
+        assert Presenca.query.filter_by(frequencia_id=frequencia_id).count() == 2
+
+        # CLEAN UP
+        clear_data(_db)
+
+    def test_post_idempotente(self, get_client_db):
+        # POST com header 'Idempotency-Key'
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        mock_face = array(process_faces(from_img_dir_to_bytes('./tests/test_images/ivete.jpg')))
+        _db.session.add(Aluno(nome='Ivete', curso='Danca', matricula='101010', embedding=from_array_to_bytes(mock_face)))
+        _db.session.add(Participante(turma_codigo='SCC5900', matricula='101010'))
+        _db.session.commit()
+
+        def enviar(imagem, chave, cliente=client):
+            data = {"imagem_turma": (os.path.join(f"./tests/test_images/{imagem}"), f'./tests/test_images/{imagem}')}
+            return cliente.post('/turmas/SCC5900/frequencias/', data=data, headers=dict(headers, **{'Idempotency-Key': chave}))
+
+        # CENÁRIO 1 - Repetição da requisição recebe a mesma resposta sem registrar outra frequência
+        primeira = enviar('ivete-e-boy.jpg', 'chave-1')
+        repeticao = enviar('ivete-e-boy.jpg', 'chave-1')
+
+        assert primeira.status_code == 201
+        assert repeticao.status_code == 201
+        assert repeticao.json == primeira.json
+        assert repeticao.headers['Idempotency-Replayed'] == 'true'
+        assert Frequencia.query.count() == 1
+
+        # CENÁRIO 2 - Mesma chave com outra imagem
+        response = enviar('ivete.jpg', 'chave-1')
+
+        assert response.status_code == 422
+        assert response.json['message'] == 'Essa Idempotency-Key já foi usada em uma requisição diferente.'
+
+        # CENÁRIO 3 - Erros de validação também são reaproveitados
+        for _ in range(2):
+            response = enviar('door.jpg', 'chave-2')
+            assert response.status_code == 400
+            assert response.json['message'] == 'Não foram detectadas faces na imagem enviada.'
+
+        # CENÁRIO 4 - Requisições simultâneas com a mesma chave executam o reconhecimento uma única vez
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            respostas = list(executor.map(lambda _: enviar('ivete-e-boy.jpg', 'chave-3', client.application.test_client()), range(3)))
+
+        assert [response.status_code for response in respostas] == [201, 201, 201]
+        assert len({response.json['frequencia.id'] for response in respostas}) == 1
+        assert Frequencia.query.count() == 2
+
+        # Reservas deixadas 'running' por processos que pararam no meio da pipeline, com a mesma impressão da requisição
+        escopo, impressao = _db.session.query(RequisicaoIdempotente.escopo, RequisicaoIdempotente.impressao).filter_by(chave='chave-3').first()
+        processo_encerrado = subprocess.Popen([sys.executable, '-c', 'pass'])
+        processo_encerrado.wait()
+
+        def reservar(chave, dono, heartbeat):
+            _db.session.add(RequisicaoIdempotente(escopo=escopo, chave=chave, impressao=impressao, status='running',
+                                                  dono=dono, heartbeat=heartbeat))
+            _db.session.commit()
+
+        client.application.config['IDEMPOTENCY_WAIT_SECONDS'] = 0.5
+        try:
+            # CENÁRIO 5 - Lease expirado: a repetição assume a reserva e executa a rota
+            reservar('chave-4', 'outro-host:1234:abcd1234', datetime.utcnow() - timedelta(minutes=5))
+            response = enviar('ivete-e-boy.jpg', 'chave-4')
+
+            assert response.status_code == 201
+            assert 'Idempotency-Replayed' not in response.headers
+            assert RequisicaoIdempotente.query.filter_by(chave='chave-4').first().status == 'done'
+
+            # CENÁRIO 6 - Dono encerrado no mesmo host, ainda dentro do lease
+            if os.name == 'posix':
+                reservar('chave-5', f'{socket.gethostname()}:{processo_encerrado.pid}:abcd1234', datetime.utcnow())
+                assert enviar('ivete-e-boy.jpg', 'chave-5').status_code == 201
+
+            # CENÁRIO 7 - Reserva de outro host com lease válido continua aguardando
+            reservar('chave-6', 'outro-host:1234:abcd1234', datetime.utcnow())
+            response = enviar('ivete-e-boy.jpg', 'chave-6')
+
+            assert response.status_code == 409
+            assert RequisicaoIdempotente.query.filter_by(chave='chave-6').first().dono == 'outro-host:1234:abcd1234'
+        finally:
+            client.application.config['IDEMPOTENCY_WAIT_SECONDS'] = 300
+
+        # CLEAN UP
+        clear_data(_db)
+
+    def test_post_assincrono(self, get_client_db):
+        # POST com 'assincrono=true'
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        mock_img = from_img_dir_to_bytes('./tests/test_images/ivete.jpg')
+        mock_face = array(process_faces(mock_img))
+        mock_face_embedding = from_array_to_bytes(mock_face)
+        _db.session.add(Aluno(nome='Ivete', curso='Danca', matricula='101010', embedding=mock_face_embedding))
+        _db.session.add(Participante(turma_codigo='SCC5900', matricula='101010'))
+        _db.session.commit()
+
+        # CENÁRIO 1 - Job inexistente
+        response = client.get('/turmas/SCC5900/frequencias/jobs/1/', headers=headers)
+        assert response.status_code == 400
+        assert response.json['message'] == 'Não existe job com esse ID no banco de dados.'
+
+        # CENÁRIO 2 - Imagem sem faces
+        file = os.path.join("./tests/test_images/door.jpg")
+        data = {"imagem_turma": (file, './tests/test_images/door.jpg')}
+
+        response = client.post('/turmas/SCC5900/frequencias/?assincrono=true', data=data, headers=headers)
+        assert response.status_code == 202
+
+        job = aguardar_job(client, headers, response.json['job.id'])
+        assert job['status'] == 'failed'
+        assert job['erro'] == 'Não foram detectadas faces na imagem enviada.'
+
+        # CENÁRIO 3 - OK
+        file = os.path.join("./tests/test_images/ivete-e-boy.jpg")
+        data = {"imagem_turma": (file, './tests/test_images/ivete-e-boy.jpg')}
+
+        response = client.post('/turmas/SCC5900/frequencias/?assincrono=true', data=data, headers=headers)
+        assert response.status_code == 202
+
+        job = aguardar_job(client, headers, response.json['job.id'])
+        assert job['status'] == 'done'
+        assert job['frequencia_id'] == 1
+
+        # CLEAN UP
+        clear_data(_db)
     
+    def test_retomada_de_jobs(self, get_client_db):
+        # Jobs pendentes de outros processos
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        _db.session.commit()
+
+        # Processo já encerrado no mesmo host
+        processo = subprocess.Popen([sys.executable, '-c', 'pass'])
+        processo.wait()
+
+        agora = datetime.utcnow()
+        donos = {'ativo': ('outro-host:1234:abcd', agora),
+                 'encerrado': (f'{socket.gethostname()}:{processo.pid}:abcd', agora),
+                 'lease_expirado': ('outro-host:1234:abcd', agora - timedelta(seconds=2 * executor_de_jobs.validade_lease))}
+
+        jobs = {}
+        for nome, (dono, heartbeat) in donos.items():
+            job = JobFrequencia(turma_codigo='SCC5900', status='running', dono=dono, heartbeat=heartbeat,
+                                imagens=[ImagemJobFrequencia(imagem_turma=from_img_dir_to_bytes('./tests/test_images/door.jpg'))])
+            _db.session.add(job)
+            _db.session.commit()
+            jobs[nome] = job.id
+
+        # CENÁRIO 1 - Apenas os jobs com dono encerrado ou lease expirado são retomados
+        executor_de_jobs.retomar_pendentes()
+
+        for nome in ('encerrado', 'lease_expirado'):
+            job = aguardar_job(client, headers, jobs[nome])
+            assert job['status'] == 'failed'
+            assert job['erro'] == 'Não foram detectadas faces na imagem enviada.'
+
+        job = JobFrequencia.query.get(jobs['ativo'])
+        assert (job.status, job.dono) == ('running', 'outro-host:1234:abcd')
+
+        # CENÁRIO 2 - Job de outro processo nunca é executado por este
+        executor_de_jobs._executar(jobs['ativo'])
+
+        _db.session.expire_all()
+        assert JobFrequencia.query.get(jobs['ativo']).status == 'running'
+
+        # CLEAN UP
+        clear_data(_db)
+
     def test_put(self, get_client_db):
         # PUT
         client, _db, headers = get_client_db
@@ -4,8 +4,10 @@
 
 # Participantes
 from core.models import Professor, Turma, Aluno, Participante
-from core.utils import from_img_dir_to_bytes
+from core.utils import from_img_dir_to_bytes, serializar_embedding, obter_galeria_da_turma
+from core.galeria import cache_galerias
 from conftest import clear_data
+import numpy as np
 
 class Teste_Participantes:
     def test_get(self, get_client_db):
@@ -134,4 +136,36 @@ class Teste_Participantes:
         clear_data(_db)
 
 
-    
\ No newline at end of file
+    
+
+    def test_galeria_alterada_por_outro_processo(self, get_client_db, monkeypatch):
+        client, _db, headers = get_client_db
+        clear_data(_db)
+
+        _db.session.add(Professor(nome='AAA', departamento='AAA', instituicao='AAA'))
+        _db.session.add(Turma(nome='Metodologia Cientifica', codigo='SCC5900', semestre="2020.2", professor_id=1))
+        _db.session.add(Aluno(nome='Ivete', curso='Danca', matricula='101010', embedding=serializar_embedding(np.eye(1, 512, 0, dtype=np.float32))))
+        _db.session.add(Aluno(nome='Claudia', curso='Danca', matricula='202020', embedding=serializar_embedding(np.eye(1, 512, 1, dtype=np.float32))))
+        _db.session.add(Participante(turma_codigo='SCC5900', matricula='101010'))
+        _db.session.commit()
+
+        # CENÁRIO 1 - Galeria reaproveitada enquanto a turma não muda
+        galeria = obter_galeria_da_turma('SCC5900')
+
+        assert galeria.matriculas == ['101010']
+        assert obter_galeria_da_turma('SCC5900') is galeria
+
+        # As rotas passam a ser atendidas por "outro processo": o cache deste processo não é invalidado diretamente
+        monkeypatch.setattr(cache_galerias, 'invalidar', lambda turma_codigo: None)
+        monkeypatch.setattr(cache_galerias, 'invalidar_matricula', lambda matricula: None)
+
+        # CENÁRIO 2 - Participante incluído
+        assert client.post('/turmas/SCC5900/participantes/', json={'matricula': '202020'}, headers=headers).status_code == 201
+        assert sorted(obter_galeria_da_turma('SCC5900').matriculas) == ['101010', '202020']
+
+        # CENÁRIO 3 - Aluno excluído (participação removida em cascata)
+        assert client.delete('/alunos/101010/', headers=headers).status_code == 204
+        assert obter_galeria_da_turma('SCC5900').matriculas == ['202020']
+
+        # CLEAN UP
+        clear_data(_db)
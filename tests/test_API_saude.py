@@ -0,0 +1,19 @@
+'''
+    Testes para cada endpoint da API
+'''
+
+# Saude
+from core.modelos import modelos
+
+class Teste_Saude:
+    def test_get(self, get_client_db):
+        # GET
+        client, _db, headers = get_client_db
+
+        # CENÁRIO 1 - Rota acessível sem token
+        response = client.get('/saude/')
+
+        assert response.status_code == 200
+        assert response.json['status'] == 'ok'
+        assert response.json['precisao'] == modelos.precisao
+        assert response.json['workers_inferencia'] == 0
@@ -0,0 +1,707 @@
+'''
+    Testes para as funções da pipeline de reconhecimento facial
+'''
+
+from core.utils import from_img_dir_to_bytes, from_array_to_bytes, find_faces, get_face_features, obter_presenca, detectar_caixas, detectar_em_tiles, detectar_lote_de_tiles, process_faces, normalizar_embeddings, processar_faces_localmente, deduplicar_faces, extrair_faces, processar_imagens, associar_faces, pares_semelhantes, extrair_faces_unicas
+from core.galeria import Galeria, CacheDeGalerias
+from core.cache_resultados import CacheDeResultados, cache_resultados
+from core.indice_alunos import IndiceAlunos
+from core.embeddings import codificar_embedding, decodificar_embedding, formato_compacto
+from core.modelos import ModelosReconhecimento
+from core.pesos import empacotar_pesos, verificar_pesos
+from core.inferencia import ServicoInferencia, servico_inferencia, threads_por_worker
+from core.quantizacao import avaliar_quantizacao
+from core.torchscript import exportar_torchscript
+from core.deteccao import avaliar_deteccao, iou
+from core.imagem import ImagemProcessada
+from core.importar_alunos import ler_alunos, importar_alunos, configuracoes_do_servico
+from core.models import Aluno
+from conftest import clear_data
+from core import utils
+from PIL import Image
+import io
+import pytest
+import numpy as np
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import sys
+
+def vetor(*componentes):
+    # Vetor de 512 posições com as componentes informadas e o restante da norma unitária no eixo seguinte
+    v = np.zeros(512, dtype=np.float32)
+    v[:len(componentes)] = componentes
+    v[len(componentes)] = np.sqrt(1 - np.sum(np.square(componentes)))
+    return v
+
+class Teste_Reconhecimento:
+    def test_get_face_features(self):
+        # CENÁRIO 1 - Nenhuma face
+        embeddings = get_face_features([])
+
+        assert embeddings.shape == (0, 512)
+        assert embeddings.dtype == np.float32
+
+        # CENÁRIO 2 - Lote único e lotes de tamanho 1 geram os mesmos embeddings
+        faces = find_faces(from_img_dir_to_bytes('./tests/test_images/fitdance-3faces.jpg'))
+        embeddings = get_face_features(faces)
+        embeddings_em_lotes = get_face_features(faces, batch_size=1)
+
+        assert embeddings.shape == (len(faces), 512)
+        assert embeddings.dtype == np.float32
+        assert embeddings.flags['C_CONTIGUOUS']
+        assert np.allclose(embeddings, embeddings_em_lotes, atol=1e-5)
+
+    def test_recorte_em_lote(self):
+        import torch
+        import torchvision.transforms as transforms
+
+        imagem = ImagemProcessada(from_img_dir_to_bytes('./tests/test_images/random_class.jpg'))
+        caixas = detectar_caixas(imagem)
+
+        # CENÁRIO 1 - Recorte vetorizado equivalente ao recorte e redimensionamento do PIL
+        faces_pil = torch.stack([transforms.ToTensor()(face) for face in imagem.recortar_faces(caixas)])
+        faces_lote = imagem.recortar_faces_em_lote(caixas)
+
+        assert faces_lote.shape == (len(caixas), 3, 160, 160)
+        assert (faces_lote - faces_pil).abs().mean() < 0.02
+
+        similaridades = np.sum(normalizar_embeddings(get_face_features(faces_pil)) * normalizar_embeddings(get_face_features(faces_lote)), axis=1)
+        assert (similaridades > 0.98).all()
+
+        # CENÁRIO 2 - Caixa parcialmente fora da imagem e nenhuma caixa
+        largura, altura = imagem.imagem.size
+        faces_borda = imagem.recortar_faces_em_lote(np.array([[largura - 40, altura - 40, largura + 40, altura + 40]], dtype=np.float32))
+
+        assert faces_borda.shape == (1, 3, 160, 160)
+        assert faces_borda[:, :, 100:, 100:].abs().max() == 0
+        assert imagem.recortar_faces_em_lote(None).shape == (0, 3, 160, 160)
+
+    def test_recorte_em_lote_de_faces_grandes(self, monkeypatch):
+        import torch
+        import torchvision.ops
+        import torchvision.transforms as transforms
+
+        # Foto ampliada 12x, com faces de várias centenas de pixels
+        original = Image.open('./tests/test_images/random_class.jpg').convert('RGB')
+        ampliada = original.resize((original.width * 12, original.height * 12), resample=Image.BICUBIC)
+        buffer = io.BytesIO()
+        ampliada.save(buffer, format='JPEG', quality=95)
+        imagem = ImagemProcessada(buffer.getvalue())
+        caixas = detectar_caixas(ImagemProcessada(from_img_dir_to_bytes('./tests/test_images/random_class.jpg'))) * 12
+
+        lotes = []
+        roi_align = torchvision.ops.roi_align
+        monkeypatch.setattr(torchvision.ops, 'roi_align', lambda regioes, *args, **kwargs: lotes.append(regioes.shape) or roi_align(regioes, *args, **kwargs))
+
+        # CENÁRIO 1 - O lote não cresce com o tamanho das faces
+        faces_lote = imagem.recortar_faces_em_lote(caixas)
+
+        assert (caixas[:, 2:] - caixas[:, :2]).max() > 320
+        assert lotes[0][2] <= 321 and lotes[0][3] <= 321
+
+        # CENÁRIO 2 - Recortes equivalentes ao recorte e redimensionamento do PIL
+        faces_pil = torch.stack([transforms.ToTensor()(face) for face in imagem.recortar_faces(caixas)])
+
+        assert faces_lote.shape == (len(caixas), 3, 160, 160)
+        assert (faces_lote - faces_pil).abs().mean() < 0.02
+
+    def test_deduplicar_faces(self):
+        # Foto 0: pessoas A e B; foto 1: pessoa A (ligeiramente diferente) e pessoa C
+        embeddings = np.stack([vetor(1.0), vetor(0.0, 1.0), vetor(0.95), vetor(0.0, 0.0, 1.0)])
+        origens = [0, 0, 1, 1]
+
+        # CENÁRIO 1 - A mesma pessoa em fotos diferentes vira um único embedding
+        unicas = deduplicar_faces(embeddings, origens, limiar=0.6)
+
+        assert unicas.shape == (3, 512)
+        assert np.allclose(np.linalg.norm(unicas, axis=1), 1.0)
+        assert np.allclose(unicas[0], (embeddings[0] + embeddings[2]) / np.linalg.norm(embeddings[0] + embeddings[2]), atol=1e-6)
+
+        # CENÁRIO 2 - Faces parecidas na mesma foto continuam separadas
+        unicas = deduplicar_faces(embeddings, [0, 0, 0, 0], limiar=0.6)
+
+        assert unicas.shape == (4, 512)
+
+    def test_pares_semelhantes(self):
+        aleatorio = np.random.default_rng(2)
+        matriz = normalizar_embeddings(aleatorio.normal(size=(50, 512)))
+        matriz[[10, 30, 45]] = matriz[3] # Mesma face em linhas de blocos diferentes
+        similaridades = matriz @ matriz.T
+
+        # CENÁRIO 1 - Mesmos pares da matriz completa, com blocos menores que a matriz
+        linhas, colunas, valores = pares_semelhantes(matriz, 0.1, tamanho_bloco=16)
+        esperados = {(i, j) for i, j in zip(*np.nonzero(similaridades >= 0.1)) if i < j}
+
+        assert set(zip(linhas.tolist(), colunas.tolist())) == esperados
+        assert len(linhas) == len(esperados)
+        assert np.allclose(valores, similaridades[linhas, colunas], atol=1e-6)
+
+        # CENÁRIO 2 - Apenas as faces repetidas acima de um limiar alto
+        linhas, colunas, _ = pares_semelhantes(matriz, 0.99, tamanho_bloco=16)
+
+        assert set(zip(linhas.tolist(), colunas.tolist())) == {(3, 10), (3, 30), (3, 45), (10, 30), (10, 45), (30, 45)}
+
+    def test_obter_presenca(self):
+        alunos = [vetor(1.0).reshape(1, 512), vetor(0.0, 1.0).reshape(1, 512)]
+        
+        # CENÁRIO 1 - Atribuição gulosa deixaria o segundo aluno ausente
+        faces = np.stack([vetor(0.7, 0.6), vetor(0.65, 0.1)])
+        status, similaridades = obter_presenca(['101010', '202020'], alunos, faces, threshold=0.49)
+
+        assert status == {'101010': True, '202020': True}
+        assert np.isclose(similaridades['101010'], 0.7)
+        assert np.isclose(similaridades['202020'], 0.6)
+
+        # CENÁRIO 2 - Similaridade abaixo do threshold
+        faces = np.stack([vetor(0.3, 0.2)])
+        status, _ = obter_presenca(['101010', '202020'], alunos, faces, threshold=0.49)
+
+        assert status == {'101010': False, '202020': False}
+
+    def test_galeria_com_templates(self):
+        templates = [np.stack([vetor(1.0), vetor(0.0, 1.0)]), np.stack([vetor(0.0, 0.0, 1.0)])]
+        faces = np.stack([vetor(0.1, 0.9)])
+
+        # CENÁRIO 1 - Maior similaridade entre os templates de cada aluno
+        galeria = Galeria.de_templates(templates, ['101010', '202020'], [1, 2])
+        status, similaridades = associar_faces(galeria.matriculas, galeria.similaridades(faces))
+
+        assert galeria.matriz.shape == (3, 512)
+        assert np.allclose(galeria.similaridades(faces), [[0.9, np.sqrt(0.18)]])
+        assert galeria.similaridades(np.empty((0, 512), dtype=np.float32)).shape == (0, 2)
+        assert status == {'101010': True, '202020': False}
+        assert np.isclose(similaridades['101010'], 0.9)
+
+        # CENÁRIO 2 - Centroide dos templates
+        galeria = Galeria.de_templates(templates, ['101010', '202020'], [1, 2], agregacao='centroide')
+
+        assert galeria.matriz.shape == (2, 512)
+        assert np.allclose(galeria.similaridades(faces), [[1 / np.sqrt(2), np.sqrt(0.18)]])
+
+    def test_deteccao_com_resolucao_limitada(self, tmp_path):
+        # Versão 4x maior de uma imagem de teste, simulando uma foto de celular
+        img = Image.open('./tests/test_images/fitdance-3faces.jpg')
+        buffer = io.BytesIO()
+        img.resize((img.width * 4, img.height * 4), Image.BICUBIC).save(buffer, format='JPEG', quality=95)
+        img_bytes = buffer.getvalue()
+
+        # CENÁRIO 1 - A imagem de detecção respeita o limite e a escala aponta para a resolução original
+        original = ImagemProcessada(img_bytes).imagem
+        reduzida, escala = ImagemProcessada(img_bytes).para_deteccao(512)
+
+        assert original.size == (img.width * 4, img.height * 4)
+        assert max(reduzida.size) <= 512
+        assert np.allclose(escala * reduzida.size, original.size)
+
+        # CENÁRIO 2 - Caixas detectadas na imagem reduzida voltam para as coordenadas da resolução original
+        caixas_originais = detectar_caixas(img_bytes, lado_maximo=0)
+        caixas_reduzidas = detectar_caixas(img_bytes, lado_maximo=512)
+
+        assert len(caixas_reduzidas) == len(caixas_originais) == 3
+        assert (iou(caixas_originais, caixas_reduzidas).max(axis=1) > 0.5).all()
+
+        # CENÁRIO 3 - Recortes continuam com 160x160 e a medição cobre cada limite informado
+        assert all(face.size == (160, 160) for face in find_faces(img_bytes))
+
+        (tmp_path / 'foto.jpg').write_bytes(img_bytes)
+        resultado = avaliar_deteccao(str(tmp_path), [512])['foto.jpg']
+
+        assert resultado['faces'] == 3
+        assert resultado['limites'][512]['recall'] == 1.0
+
+    def test_deteccao_em_tiles(self, monkeypatch):
+        # Mosaico 2x2 de uma imagem de teste (12 faces), detectado em tiles bem menores que a imagem
+        img = Image.open('./tests/test_images/fitdance-3faces.jpg').convert('RGB')
+        mosaico = Image.new('RGB', (img.width * 2, img.height * 2))
+        for x in (0, img.width):
+            for y in (0, img.height):
+                mosaico.paste(img, (x, y))
+        buffer = io.BytesIO()
+        mosaico.save(buffer, format='JPEG', quality=95)
+        img_bytes = buffer.getvalue()
+
+        caixas_inteira = detectar_caixas(img_bytes, lado_maximo=0)
+
+        for chave, valor in dict(DETECTION_TILE_MIN_PIXELS=1, DETECTION_TILE_SIZE=400, DETECTION_TILE_OVERLAP=150, DETECTION_TILE_BATCH=4).items():
+            monkeypatch.setitem(utils._configuracoes_sem_app, chave, valor)
+
+        # CENÁRIO 1 - Detecção automática em tiles encontra as mesmas faces, sem duplicatas na região de sobreposição
+        caixas_tiles = detectar_caixas(img_bytes)
+
+        assert len(caixas_inteira) == len(caixas_tiles) == 12
+        assert (iou(caixas_inteira, caixas_tiles).max(axis=1) > 0.5).all()
+
+        # CENÁRIO 2 - Lotes de tiles executados fora da thread atual (como no serviço de inferência)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            caixas_executor = detectar_em_tiles(ImagemProcessada(img_bytes), detectar_lote=lambda tiles: executor.submit(detectar_lote_de_tiles, tiles))
+
+        assert len(caixas_executor) == 12
+        assert (iou(caixas_tiles, caixas_executor).max(axis=1) > 0.9).all()
+
+        # CENÁRIO 3 - Face maior que a sobreposição, cortada em todos os tiles, é encontrada pela passada na imagem reduzida
+        face = Image.open('./tests/test_images/ivete.jpg').convert('RGB')
+        face = face.resize((face.width * 3 // 2, face.height * 3 // 2), Image.BICUBIC)
+        buffer = io.BytesIO()
+        face.save(buffer, format='JPEG', quality=95)
+        caixa_face = detectar_caixas(buffer.getvalue(), lado_maximo=0)[0] + [300, 100, 300, 100]
+
+        canvas = Image.new('RGB', (2400, 1200), (120, 120, 120))
+        canvas.paste(face, (300, 100))
+        buffer = io.BytesIO()
+        canvas.save(buffer, format='JPEG', quality=95)
+
+        monkeypatch.setitem(utils._configuracoes_sem_app, 'DETECTION_MAX_SIDE', 1200)
+        monkeypatch.setitem(utils._configuracoes_sem_app, 'DETECTION_TILE_SIZE', 600)
+        caixas_grande = detectar_caixas(buffer.getvalue())
+
+        assert caixas_grande is not None
+        assert iou(caixas_grande, caixa_face[None]).max() > 0.7
+        assert not utils.pedacos_de_faces(caixas_grande, caixa_face[None]).any()
+
+    def test_imagem_processada(self, monkeypatch):
+        img = Image.open('./tests/test_images/fitdance-3faces.jpg').convert('RGB')
+
+        # Foto salva "deitada" com a orientação EXIF indicando a rotação de 90 graus, como fazem as câmeras de celular
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        buffer = io.BytesIO()
+        img.transpose(Image.ROTATE_90).save(buffer, format='JPEG', quality=95, exif=exif)
+        img_bytes = buffer.getvalue()
+
+        # CENÁRIO 1 - A orientação EXIF é aplicada antes da detecção
+        imagem = ImagemProcessada(img_bytes, com_miniatura=True)
+
+        assert imagem.imagem.size == img.size
+        assert len(find_faces(imagem)) == 3
+
+        # CENÁRIO 2 - Detecção, recortes e miniatura usam uma única decodificação da imagem
+        aberturas = []
+        abrir = Image.open
+        monkeypatch.setattr(Image, 'open', lambda *args, **kwargs: aberturas.append(args) or abrir(*args, **kwargs))
+
+        imagem = ImagemProcessada(img_bytes, com_miniatura=True)
+        embeddings = process_faces(imagem)
+        miniatura = Image.open(io.BytesIO(imagem.miniatura()))
+
+        assert embeddings.shape == (3, 512)
+        assert miniatura.size == (512, 256)
+        assert len(aberturas) == 2 # A imagem enviada e a verificação da miniatura acima
+
+
+class Teste_Cache_Galerias:
+    def test_lru_e_invalidacao(self):
+        cache = CacheDeGalerias()
+        galeria_1 = Galeria(np.stack([vetor(1.0)]), ['101010'], [1])
+        galeria_2 = Galeria(np.stack([vetor(0.0, 1.0)]), ['202020'], [2])
+        galeria_3 = Galeria(np.stack([vetor(1.0)]), ['101010'], [3])
+        limite = galeria_1.nbytes + galeria_2.nbytes
+
+        # CENÁRIO 1 - Turma menos usada recentemente é descartada ao exceder o limite
+        cache.adicionar('SCC5900', galeria_1, limite_bytes=limite)
+        cache.adicionar('SCC5901', galeria_2, limite_bytes=limite)
+        cache.obter('SCC5900')
+        cache.adicionar('SCC5902', galeria_3, limite_bytes=limite)
+
+        assert cache.obter('SCC5901') is None
+        assert cache.obter('SCC5900') is galeria_1
+        assert cache.obter('SCC5902') is galeria_3
+
+        # CENÁRIO 2 - Alteração de um aluno invalida todas as turmas em que participa
+        cache.invalidar_matricula('101010')
+
+        assert cache.obter('SCC5900') is None
+        assert cache.obter('SCC5902') is None
+
+        # CENÁRIO 3 - Galeria armazenada com uma versão anterior à da turma (alterada por outro processo ou durante a montagem)
+        cache.adicionar('SCC5900', galeria_1, limite_bytes=limite, versao=1)
+
+        assert cache.obter('SCC5900', versao=1) is galeria_1
+        assert cache.obter('SCC5900', versao=2) is None
+        assert cache.obter('SCC5900', versao=1) is None
+
+
+class Teste_Cache_Resultados:
+    def test_lru_e_versao(self, tmp_path):
+        caminho = str(tmp_path / 'resultados.db')
+        embeddings, caixas = np.stack([vetor(1.0)]), np.array([[1, 2, 3, 4]], dtype=np.float32)
+        tamanho = embeddings.nbytes + caixas.nbytes
+
+        cache = CacheDeResultados()
+        cache.configurar(caminho, limite_bytes=2 * tamanho, versao='v1')
+
+        # CENÁRIO 1 - Resultado lido pelo conteúdo da imagem, inclusive por outra instância usando o mesmo arquivo
+        cache.adicionar(b'imagem 1', embeddings, caixas)
+        outra_instancia = CacheDeResultados()
+        outra_instancia.configurar(caminho, limite_bytes=2 * tamanho, versao='v1')
+        lido_embeddings, lido_caixas = outra_instancia.obter(b'imagem 1')
+
+        assert cache.obter(b'imagem 2') is None
+        assert np.array_equal(lido_embeddings, embeddings)
+        assert np.array_equal(lido_caixas, caixas)
+
+        # CENÁRIO 2 - Imagem usada há mais tempo é descartada ao exceder o limite
+        cache.adicionar(b'imagem 2', embeddings, caixas)
+        cache.obter(b'imagem 1')
+        cache.adicionar(b'imagem 3', embeddings, caixas)
+
+        assert cache.obter(b'imagem 2') is None
+        assert cache.obter(b'imagem 1') is not None
+        assert cache.obter(b'imagem 3') is not None
+
+        # CENÁRIO 3 - Outra versão da pipeline não reaproveita os resultados
+        outra_instancia.configurar(caminho, limite_bytes=2 * tamanho, versao='v2')
+
+        assert outra_instancia.obter(b'imagem 1') is None
+
+    def test_reconhecimento_com_cache(self, tmp_path, monkeypatch):
+        img_turma = from_img_dir_to_bytes('./tests/test_images/ivete-e-boy.jpg')
+        img_aluno = from_img_dir_to_bytes('./tests/test_images/ivete.jpg')
+
+        cache_resultados.configurar(str(tmp_path / 'resultados.db'), limite_bytes=1024 * 1024)
+        try:
+            embeddings, caixas = extrair_faces(img_turma)
+
+            def inferir(*args):
+                raise AssertionError('As redes não deveriam ser executadas para imagens em cache.')
+
+            # CENÁRIO 1 - Reenvio da mesma imagem não passa pelas redes
+            monkeypatch.setattr(utils, '_inferir_faces', inferir)
+            lido_embeddings, lido_caixas = extrair_faces(img_turma)
+
+            assert np.array_equal(lido_embeddings, embeddings)
+            assert np.array_equal(lido_caixas, caixas)
+            monkeypatch.undo()
+
+            # CENÁRIO 2 - Várias fotos, uma delas em cache
+            varias_embeddings, varias_caixas, origens = processar_imagens([ImagemProcessada(img_turma), ImagemProcessada(img_aluno)])
+
+            assert np.allclose(varias_embeddings[origens == 0], embeddings)
+            assert np.array_equal(varias_caixas[origens == 0], caixas)
+            assert np.allclose(cache_resultados.obter(img_aluno)[0], varias_embeddings[origens == 1])
+        finally:
+            cache_resultados.configurar(None)
+
+
+class Teste_Indice_Alunos:
+    def test_busca_e_persistencia(self, tmp_path):
+        aleatorio = np.random.default_rng(1)
+        centros = normalizar_embeddings(aleatorio.normal(size=(40, 512)))
+        vetores = normalizar_embeddings(centros[aleatorio.integers(0, 40, 3000)] + 0.05 * aleatorio.normal(size=(3000, 512)))
+        matriculas = [str(100000 + i) for i in range(3000)]
+
+        def carregar_do_banco():
+            return matriculas, vetores
+
+        indice = IndiceAlunos()
+        indice.configurar(str(tmp_path / 'indice.npz'), nprobe=8, tamanho_minimo=1000)
+        indice.preparar(carregar_do_banco, lambda: len(vetores))
+
+        # CENÁRIO 1 - Índice dividido em listas, com os mesmos resultados da busca exata para consultas próximas dos vetores
+        consultas = normalizar_embeddings(vetores[:100] + 0.02 * aleatorio.normal(size=(100, 512)))
+        acertos = sum(indice.buscar(consulta, 1)[0][0] == matriculas[np.argmax(vetores @ consulta)] for consulta in consultas)
+
+        assert len(indice.centroides) > 1
+        assert acertos >= 95
+
+        # CENÁRIO 2 - Alterações incrementais
+        indice.atualizar({'100000'}, ['100000', '100000'], vetores[[1, 2]], carregar_do_banco)
+        resultados = dict(indice.buscar(vetores[2], 3))
+
+        assert len(indice) == 3001
+        assert resultados['100000'] == pytest.approx(1.0, abs=1e-5)
+
+        indice.atualizar({'100000'}, [], np.empty((0, 512), dtype=np.float32), carregar_do_banco)
+
+        assert '100000' not in dict(indice.buscar(vetores[2], 3))
+
+        # CENÁRIO 3 - Outra instância lê o índice salvo em vez de reconstruí-lo
+        def reconstruir():
+            raise AssertionError('O índice deveria ser lido do arquivo.')
+
+        outra_instancia = IndiceAlunos()
+        outra_instancia.configurar(str(tmp_path / 'indice.npz'), nprobe=8, tamanho_minimo=1000)
+        outra_instancia.preparar(reconstruir, lambda: 2999)
+
+        assert outra_instancia.buscar(consultas[5], 5) == indice.buscar(consultas[5], 5)
+
+        # CENÁRIO 4 - Quantidade diferente de vetores no banco reconstrói o índice
+        outra_instancia.preparar(carregar_do_banco, lambda: len(vetores))
+
+        assert len(outra_instancia) == 3000
+
+
+class Teste_Formato_Embedding:
+    def test_codificar_decodificar(self):
+        embedding = 3 * vetor(0.6, 0.8).reshape(1, 512)
+
+        # CENÁRIO 1 - float32 normalizado na escrita e lido sem cópia
+        dados = codificar_embedding(embedding)
+        lido = decodificar_embedding(dados)
+
+        assert len(dados) == 4 + 512 * 4
+        assert lido.shape == (1, 512)
+        assert lido.dtype == np.float32
+        assert not lido.flags['OWNDATA']
+        assert np.allclose(lido, vetor(0.6, 0.8))
+
+        # CENÁRIO 2 - float16
+        dados = codificar_embedding(embedding, dtype='float16')
+
+        assert len(dados) == 4 + 512 * 2
+        assert np.allclose(decodificar_embedding(dados), vetor(0.6, 0.8), atol=1e-3)
+
+        # CENÁRIO 3 - Blob legado gerado com np.save
+        assert np.allclose(decodificar_embedding(from_array_to_bytes(embedding)), embedding)
+
+        # CENÁRIO 4 - Precisão armazenada, usada pela migração para converter apenas os blobs com outra precisão
+        assert formato_compacto(dados) and formato_compacto(dados, 'float16')
+        assert not formato_compacto(codificar_embedding(embedding), 'float16')
+        assert not formato_compacto(from_array_to_bytes(embedding), 'float32')
+
+
+class Teste_Carregamento_Modelos:
+    def test_importacao_sem_torch(self):
+        # As rotas que não fazem reconhecimento facial não devem importar o torch
+        codigo = "import sys; import core.utils; assert 'torch' not in sys.modules"
+        assert subprocess.run([sys.executable, '-c', codigo]).returncode == 0
+
+    def test_diretorio_local_de_pesos(self, tmp_path):
+        diretorio = str(tmp_path)
+        empacotar_pesos(diretorio)
+
+        # CENÁRIO 1 - Pesos lidos do diretório geram os mesmos embeddings
+        modelos_locais = ModelosReconhecimento()
+        modelos_locais.configurar(diretorio_pesos=diretorio)
+        modelos_locais.carregar()
+
+        faces = find_faces(from_img_dir_to_bytes('./tests/test_images/ivete.jpg'))
+        esperado = get_face_features(faces)
+
+        import torch
+        import torchvision.transforms as transforms
+        with torch.no_grad():
+            obtido = modelos_locais.feature_extractor(torch.stack([transforms.ToTensor()(face) for face in faces])).numpy()
+
+        assert np.allclose(esperado, obtido, atol=1e-5)
+
+        # CENÁRIO 2 - Arquivo de pesos corrompido
+        with open(tmp_path / 'pnet.bin', 'r+b') as arquivo:
+            arquivo.write(b'\xff')
+
+        with pytest.raises(ValueError):
+            verificar_pesos(diretorio)
+
+    def test_servico_inferencia(self, tmp_path):
+        diretorio = str(tmp_path)
+        empacotar_pesos(diretorio)
+
+        img_bytes = from_img_dir_to_bytes('./tests/test_images/fitdance-3faces.jpg')
+        esperado = processar_faces_localmente(img_bytes)
+
+        servico = ServicoInferencia()
+        servico.iniciar(num_workers=1, threads=1, opcoes_modelos=dict(diretorio_pesos=diretorio))
+
+        try:
+            obtido, caixas, miniatura = servico.submeter(img_bytes).result()
+            faces, caixas_deteccao, miniatura_deteccao = servico.submeter_deteccao(img_bytes, gerar_miniatura=True).result()
+            obtido_em_lote = servico.submeter_faces(faces).result()
+        finally:
+            servico.encerrar()
+
+        assert obtido.shape == esperado.shape
+        assert np.allclose(esperado, obtido, atol=1e-4)
+        assert caixas.shape == caixas_deteccao.shape == (len(esperado), 4)
+        assert miniatura is None
+        assert miniatura_deteccao is not None
+        assert np.allclose(esperado, obtido_em_lote, atol=1e-4)
+
+    def test_cadastro_com_imagem_truncada(self, tmp_path):
+        diretorio = str(tmp_path)
+        empacotar_pesos(diretorio)
+
+        img_bytes = from_img_dir_to_bytes('./tests/test_images/ivete.jpg')
+        fotos = [img_bytes[:len(img_bytes) // 2], img_bytes]
+
+        # CENÁRIO 1 - Sem o serviço de inferência, a foto truncada é descartada na decodificação
+        sem_servico = extrair_faces_unicas([ImagemProcessada(foto) for foto in fotos])
+
+        # CENÁRIO 2 - Com o serviço ativo, a foto só falha no processo de inferência e recebe o mesmo resultado
+        servico_inferencia.iniciar(1, threads=1, opcoes_modelos=dict(diretorio_pesos=diretorio))
+        try:
+            com_servico = extrair_faces_unicas([ImagemProcessada(foto) for foto in fotos])
+        finally:
+            servico_inferencia.encerrar()
+
+        for resultados in (sem_servico, com_servico):
+            assert resultados[0] == (None, None)
+            assert resultados[1][0] == 1
+
+        assert np.allclose(sem_servico[1][1], com_servico[1][1], atol=1e-4)
+
+    def test_limite_de_workers(self, monkeypatch, caplog):
+        monkeypatch.setattr('os.cpu_count', lambda: 4)
+        servico = ServicoInferencia()
+
+        # CENÁRIO 1 - Mais processos que núcleos: a quantidade é limitada, sem ultrapassar os núcleos no total de threads
+        servico.iniciar(num_workers=8, threads=2)
+        try:
+            assert servico.num_workers == 4
+            assert servico.num_workers * threads_por_worker(servico.num_workers, 2) <= 4
+            assert 'INFERENCE_WORKERS (8)' in caplog.text
+        finally:
+            servico.encerrar()
+
+    def test_quantizacao_int8(self, tmp_path):
+        import shutil
+        import torch
+        from facenet_pytorch import InceptionResnetV1
+        from core.rede_quantizavel import RedeQuantizavel
+
+        # Conjuntos de calibração e de avaliação sem imagens em comum
+        for conjunto, arquivos in dict(calibracao=['claudia.jpg', 'ivete-e-boy.jpg', 'random_class.jpg'],
+                                       avaliacao=['fitdance-3faces.jpg', 'ivete.jpg', 'vinicius.png']).items():
+            (tmp_path / conjunto).mkdir()
+            for arquivo in arquivos:
+                shutil.copy(f'./tests/test_images/{arquivo}', tmp_path / conjunto / arquivo)
+
+        # CENÁRIO 1 - A versão quantizável da rede, antes da quantização, calcula o mesmo embedding da InceptionResnetV1
+        rede = InceptionResnetV1(pretrained='vggface2').eval()
+        entrada = torch.rand(3, 3, 160, 160)
+        with torch.no_grad():
+            assert np.allclose(rede(entrada).numpy(), RedeQuantizavel(rede).eval()(entrada).numpy(), atol=1e-5)
+
+        # CENÁRIO 2 - Embeddings int8 equivalentes aos fp32 nas imagens fora da calibração
+        resultados = avaliar_quantizacao(str(tmp_path / 'avaliacao'), str(tmp_path / 'calibracao'))
+
+        assert set(resultados) == {'fitdance-3faces.jpg', 'ivete.jpg', 'vinicius.png'}
+        assert all(resultado['similaridade_minima'] > 0.95 for resultado in resultados.values())
+
+        with pytest.raises(ValueError):
+            avaliar_quantizacao('./tests/test_images', str(tmp_path / 'calibracao'))
+
+        # CENÁRIO 3 - Convoluções quantizadas (fundidas com a batch normalization) e embeddings no formato da rede fp32
+        modelos_int8 = ModelosReconhecimento()
+        modelos_int8.configurar(precisao='int8', diretorio_calibracao=str(tmp_path / 'calibracao'))
+        extrator = modelos_int8.carregar().feature_extractor
+        camadas = list(extrator.modules())
+
+        assert any(isinstance(camada, torch.nn.quantized.Conv2d) for camada in camadas)
+        assert not any(isinstance(camada, (torch.nn.Conv2d, torch.nn.BatchNorm2d)) for camada in camadas)
+        with torch.no_grad():
+            embeddings = extrator(entrada)
+        assert embeddings.shape == (3, 512) and embeddings.dtype == torch.float32
+
+        # CENÁRIO 4 - Diretório de calibração obrigatório e com faces
+        (tmp_path / 'sem_faces').mkdir()
+        shutil.copy('./tests/test_images/door.jpg', tmp_path / 'sem_faces' / 'door.jpg')
+        modelos_sem_faces = ModelosReconhecimento()
+        modelos_sem_faces.configurar(precisao='int8', diretorio_calibracao=str(tmp_path / 'sem_faces'))
+
+        with pytest.raises(ValueError):
+            modelos_sem_faces.carregar()
+        with pytest.raises(ValueError):
+            ModelosReconhecimento().configurar(precisao='int8')
+
+    def test_torchscript(self, tmp_path):
+        diretorio = str(tmp_path)
+        modelos_eager = ModelosReconhecimento()
+        exportar_torchscript(diretorio, modelos_eager.carregar())
+
+        modelos_torchscript = ModelosReconhecimento()
+        modelos_torchscript.configurar(diretorio_torchscript=diretorio)
+        modelos_torchscript.aquecer()
+
+        # CENÁRIO 1 - Mesmas faces detectadas e mesmos embeddings para lotes de tamanho diferente do usado no tracing
+        from PIL import Image
+        import io
+        import torch
+        img = Image.open(io.BytesIO(from_img_dir_to_bytes('./tests/test_images/fitdance-3faces.jpg')))
+
+        caixas_eager, _ = modelos_eager.face_detector.detect(img)
+        caixas_torchscript, _ = modelos_torchscript.face_detector.detect(img)
+
+        assert np.allclose(caixas_eager, caixas_torchscript, atol=1e-2)
+
+        entrada = torch.rand(3, 3, 160, 160)
+        with torch.no_grad():
+            assert np.allclose(modelos_eager.feature_extractor(entrada).numpy(), modelos_torchscript.feature_extractor(entrada).numpy(), atol=1e-4)
+
+        # CENÁRIO 2 - Precisão diferente da exportada
+        modelos_int8 = ModelosReconhecimento()
+        modelos_int8.configurar(precisao='int8', diretorio_torchscript=diretorio)
+
+        with pytest.raises(ValueError):
+            modelos_int8.carregar()
+
+        # CENÁRIO 3 - Rede quantizada exportada com a calibração já aplicada
+        diretorio_int8 = str(tmp_path / 'int8')
+        modelos_eager_int8 = ModelosReconhecimento()
+        modelos_eager_int8.configurar(precisao='int8', diretorio_calibracao='./tests/test_images')
+        exportar_torchscript(diretorio_int8, modelos_eager_int8.carregar())
+
+        modelos_int8.configurar(precisao='int8', diretorio_torchscript=diretorio_int8)
+        with torch.no_grad():
+            assert np.allclose(modelos_eager_int8.feature_extractor(entrada).numpy(), modelos_int8.carregar().feature_extractor(entrada).numpy(), atol=1e-4)
+
+
+class Teste_Importacao_Alunos:
+    def test_importar_alunos(self, get_client_db, tmp_path, monkeypatch):
+        client, _db, _ = get_client_db
+        clear_data(_db)
+
+        diretorio = str(tmp_path / 'pesos')
+        empacotar_pesos(diretorio)
+
+        with open(tmp_path / 'alunos.csv', 'w') as arquivo:
+            arquivo.write('matricula,nome,curso,imagem\n'
+                          '101010,Ivete,Danca,ivete.jpg\n'
+                          '202020,Claudia,Danca,claudia.jpg\n'
+                          '303030,Porta,Danca,door.jpg\n'
+                          '404040,Fitdance,Danca,fitdance-3faces.jpg\n'
+                          '505050,Sem Foto,Danca,inexistente.jpg\n'
+                          '101010,Ivete,Danca,ivete.jpg\n')
+
+        servico = ServicoInferencia()
+        servico.iniciar(num_workers=2, threads=1, opcoes_modelos=dict(diretorio_pesos=diretorio))
+
+        try:
+            # CENÁRIO 1 - Importação com commits a cada aluno
+            contagem = importar_alunos(ler_alunos(str(tmp_path / 'alunos.csv')), './tests/test_images', servico, tamanho_lote=1)
+
+            assert contagem == {'ok': 2, 'sem_face': 1, 'varias_faces': 1, 'imagem_invalida': 1, 'matricula_duplicada': 1}
+            assert Aluno.query.count() == 2
+
+            # Mesma pipeline das rotas da API
+            esperado = processar_faces_localmente(from_img_dir_to_bytes('./tests/test_images/claudia.jpg'))
+            obtido = decodificar_embedding(Aluno.query.filter_by(matricula='202020').first().embedding)
+            assert np.allclose(obtido, normalizar_embeddings(esperado), atol=1e-4)
+
+            # CENÁRIO 2 - Retomada de uma importação interrompida antes do segundo aluno
+            Aluno.query.filter_by(matricula='202020').delete()
+            _db.session.commit()
+
+            contagem = importar_alunos(ler_alunos(str(tmp_path / 'alunos.csv')), './tests/test_images', servico)
+
+            assert contagem['ok'] == 1
+            assert contagem['matricula_duplicada'] == 2
+            assert Aluno.query.count() == 2
+
+            # CENÁRIO 3 - Configurações da aplicação diferentes dos valores padrão são repassadas aos processos de inferência
+            servico.encerrar()
+            clear_data(_db)
+
+            app = client.application
+            monkeypatch.setitem(app.config, 'MODEL_WEIGHTS_DIR', diretorio)
+            monkeypatch.setitem(app.config, 'DETECTION_MAX_SIDE', 300)
+
+            servico.iniciar(num_workers=1, threads=1, **configuracoes_do_servico(app.config))
+            contagem = importar_alunos(ler_alunos(str(tmp_path / 'alunos.csv')), './tests/test_images', servico)
+            assert contagem['ok'] == 2
+
+            with app.app_context():
+                esperado = processar_faces_localmente(from_img_dir_to_bytes('./tests/test_images/claudia.jpg'))
+            obtido = decodificar_embedding(Aluno.query.filter_by(matricula='202020').first().embedding)
+            assert np.allclose(obtido, normalizar_embeddings(esperado), atol=1e-4)
+        finally:
+            servico.encerrar()
+            clear_data(_db)